@@ -26,6 +26,11 @@ TACACSRC_PASSPHRASE = 'bacon is awesome, son.'
 # general use within the .tacacsrc
 DEFAULT_REALM = 'aol'
 
+# Credentials read from .tacacsrc are cached in memory and shared by every
+# connection in the process. Set this to a number of seconds to re-read the
+# file after that long, or None to only read it once.
+CREDENTIALS_TTL = None
+
 # Location of firewall policies
 FIREWALL_DIR = '/data/firewalls'
 
@@ -74,6 +79,22 @@ DEFAULT_TIMEOUT = 5 * 60
 # Default timeout in seconds for initial telnet connections. 
 TELNET_TIMEOUT  = 60
 
+# Set to True to log everything sent and received in each session. This is slow
+# for large outputs, so only turn it on while debugging.
+TWISTER_DEBUG = False
+
+# Maximum number of new connections per second started by Commando and
+# load_acl, so that big runs don't overwhelm the AAA servers. None for no limit.
+CONNECTION_RATE = None
+
+# Number of connections that may be started at once before CONNECTION_RATE
+# applies.
+CONNECTION_BURST = 1
+
+# Maximum number of connections running at once to devices in the same 'site',
+# 'group' or with the same 'vendor', e.g. {'site': 5}. See trigger.cmds.Scheduler.
+CONNECTION_LIMITS = {}
+
 # Add manufacturers that support SSH logins here. Only add one if ALL devices of that 
 # manufacturer have SSH logins enabled. Adding CISCO SYSTEMS to this list will
 # require a lot of work! (Don't forget the trailing comma when you add a new entry.)
@@ -124,6 +145,11 @@ VALID_OWNERS = (
     'Enterprise Networking',
 )
 
+# Path to the SQLite interface index written by 'netindex --build' and read by
+# trigger.netindex.InterfaceIndex.load() to find which device and interface
+# an address lives on.
+INTERFACE_INDEX_FILE = os.path.join(PREFIX, 'netindex.db')
+
 
 #===============================
 # Redis Settings
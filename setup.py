@@ -91,6 +91,7 @@ setup(
         'bin/gnng',
         'bin/load_acl',
         'bin/netdev',
+        'bin/netindex',
         'bin/optimizer',
         'bin/find_access',
         'tools/gen_tacacsrc.py',
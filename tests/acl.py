@@ -8,10 +8,15 @@ __copyright__ = 'Copyright 2005-2011 AOL Inc.'
 __version__ = '1.29'
 
 from StringIO import StringIO
+import random
 import unittest
 from trigger import acl
+from trigger.acl import engine, optimizer
+from trigger.acl.tools import (check_access, create_trigger_term,
+                               read_flows, AccessChecker)
 
 EXAMPLES_FILE = 'tests/data/junos-examples.txt'
+ACL_FILE = 'tests/data/acl.test'
 
 # Some representative match clauses:
 ios_matches = ('tcp 192.0.2.0 0.0.0.255 any gt 65530',                # 1
@@ -673,6 +678,240 @@ class CheckMiscIOS(unittest.TestCase):
        t.output_ios()  # should not raise VendorSupportLackingError
 
 
+class CheckCompiledACL(unittest.TestCase):
+
+    def setUp(self):
+        self.acl = acl.parse(file(ACL_FILE))
+        rng = random.Random(1337)
+        addrs = set()
+        for t in self.acl.terms:
+            for key in ('source-address', 'destination-address'):
+                for net in t.match.get(key, []):
+                    addrs.add(net.net().strNormal())
+                    addrs.add(net.broadcast().strNormal())
+        addrs = sorted(addrs) + ['192.0.2.1']
+        self.flows = []
+        for i in range(300):
+            self.flows.append(engine.make_flow(rng.choice(addrs),
+                rng.choice(addrs), rng.choice(['tcp', 'udp', 'icmp', 'gre']),
+                rng.choice([22, 53, 80, 123, 1024, 1646, 6000]),
+                rng.choice([53, 88, 123, 1023, 40000])))
+
+    def _check_access(self, flow):
+        t = create_trigger_term(
+            source_ips=[acl.IP(flow.source)],
+            dest_ips=[acl.IP(flow.destination)],
+            protocols=[acl.Protocol(flow.protocol)],
+            dest_ports=[flow.destination_port],
+            source_ports=[flow.source_port])
+        return check_access(self.acl.terms, t)
+
+    def testUnsupportedTerms(self):
+        """Make sure terms with tcp-flags or ICMP types are not compiled."""
+        specs = engine.compile_terms(self.acl.terms)
+        self.assertFalse(specs[0].supported)    # tcp established
+        self.assertFalse(specs[1].supported)    # icmp echo-reply
+        self.assert_(specs[5].supported)
+
+    def testExceptAndEitherKeys(self):
+        """Test normalization of -except and address/port matches."""
+        t = acl.Term()
+        t.match['address'] = ['10.0.0.0/8']
+        t.match['destination-port-except'] = [(0, 1023)]
+        boxes = engine.normalize_term(t)
+        self.assertEqual(len(boxes), 2)
+        self.assertEqual(boxes[0]['destination-port'], [(1024, 65535)])
+        self.assert_(engine.flow_matches_box(
+            engine.make_flow('192.0.2.1', '10.1.1.1', 'tcp', 8080), boxes[1]))
+
+    def testCheckAccessParity(self):
+        """Compare the ACL engines to check_access() on random flows."""
+        expected = [self._check_access(f) for f in self.flows]
+        self.assertEqual(
+            engine.InterpretedACL(self.acl).permitted(self.flows), expected)
+        self.assertEqual(
+            engine.ACLDecisionTree(self.acl).permitted(self.flows), expected)
+        try:
+            compiled = engine.CompiledACL(self.acl, batch_size=64)
+        except ImportError:
+            self.skipTest('CompiledACL requires NumPy')
+        self.assertEqual(compiled.permitted(self.flows), expected)
+
+    def testDecisionTreeParity(self):
+        """Compare ACLDecisionTree to InterpretedACL on random flows."""
+        flows = self.flows + [engine.make_flow('192.0.2.1', None, 'tcp', 80),
+                              engine.make_flow(None, None, None, None)]
+        tree = engine.ACLDecisionTree(self.acl)
+        self.assertEqual(tree.match(flows),
+                         engine.InterpretedACL(self.acl).match(flows))
+
+    def testShadowedTerms(self):
+        """Make sure ACLDecisionTree reports terms that can never match."""
+        a = acl.ACL(name='shadow', format='junos')
+        for name, dst, proto, action in (
+                ('ta', ['10.0.0.0/8'], ['tcp'], 'accept'),
+                ('tb', ['10.1.0.0/16'], ['tcp'], 'discard'),
+                ('tc', ['10.0.0.0/9', '10.128.0.0/9'], None, 'accept'),
+                ('td', ['10.0.0.0/8'], ['udp'], 'discard'),
+                ('te', ['192.0.2.0/24'], None, 'discard')):
+            t = acl.Term(name=name, action=action)
+            t.match['destination-address'] = dst
+            if proto:
+                t.match['protocol'] = proto
+            a.terms.append(t)
+        a.terms[1].match['destination-port'] = [80]
+        tree = engine.ACLDecisionTree(a)
+        self.assertEqual([t.name for t in tree.shadowed], ['tb', 'td'])
+        self.assertEqual(tree.match([('10.1.1.1', '10.1.1.1', 'tcp', 80),
+                                     ('10.1.1.1', '10.1.1.1', 'udp', 53),
+                                     ('10.1.1.1', '192.0.2.9', 'udp', 53),
+                                     ('10.1.1.1', '172.16.0.1', 'udp', 53)]),
+                         [0, 2, 4, -1])
+
+    def testAccessChecker(self):
+        """Test batch checking of flows read from CSV against several ACLs."""
+        flows = StringIO("""source,destination,protocol,destination_port
+46.31.162.158,10.0.0.1,tcp,80
+# comment
+192.0.2.1,10.0.0.1,udp,any
+""")
+        checker = AccessChecker(engine='python', batch_size=1)
+        checker.add('acl.test', self.acl)
+        checker.add('acl.empty', acl.ACL())
+        results = list(checker.check(read_flows(flows)))
+        self.assertEqual([(r.acl, r.permitted) for r in results],
+                         [('acl.test', True), ('acl.empty', None),
+                          ('acl.test', False), ('acl.empty', None)])
+        self.assertEqual(results[0].term, self.acl.terms[5])
+        self.assertEqual(results[2].flow.destination_port, None)
+
+    def testReadFlowsBadRows(self):
+        """Test that rows that aren't valid flows are reported and skipped."""
+        flows = StringIO("""192.0.2.1,10.0.0.1,tcp,80
+10.0.0.0/24,10.0.0.1,tcp,80
+192.0.2.1,10.0.0.1,bogus,80
+192.0.2.2,10.0.0.1,udp,53
+""")
+        errors = []
+        read = list(read_flows(flows,
+                               on_error=lambda *args: errors.append(args)))
+        self.assertEqual(read, [engine.make_flow('192.0.2.1', '10.0.0.1',
+                                                 'tcp', 80),
+                                engine.make_flow('192.0.2.2', '10.0.0.1',
+                                                 'udp', 53)])
+        self.assertEqual([line for line, err in errors], [2, 3])
+        flows.seek(0)
+        self.assertRaises(ValueError, list, read_flows(flows))
+
+
+class CheckACLAnalysis(unittest.TestCase):
+
+    def setUp(self):
+        self.acl = acl.ACL(name='analysis', format='junos')
+        for name, dst, proto, action in (
+                ('ta', ['10.0.0.0/8'], ['tcp'], 'accept'),
+                ('tb', ['10.1.0.0/16'], ['tcp'], 'discard'),
+                ('tc', ['10.0.0.0/9', '10.128.0.0/9'], None, 'accept'),
+                ('td', ['192.0.2.0/25'], None, 'discard'),
+                ('te', ['192.0.2.0/24'], None, 'discard'),
+                ('tf', ['192.0.3.0/24'], None, 'discard')):
+            t = acl.Term(name=name, action=action)
+            t.match['destination-address'] = dst
+            if proto:
+                t.match['protocol'] = proto
+            self.acl.terms.append(t)
+        self.terms = dict([(t.name, t) for t in self.acl.terms])
+
+    def testShadowedAndRedundant(self):
+        """Test detection of shadowed and redundant terms."""
+        report = self.acl.analyze()
+        self.assertEqual([(f.term.name, [t.name for t in f.related])
+                          for f in report.shadowed], [('tb', ['ta'])])
+        self.assertEqual([(f.term.name, [t.name for t in f.related])
+                          for f in report.redundant], [('td', ['te'])])
+        self.assertEqual(report.removable, [self.terms['tb']])
+
+    def testRedundantPastUnsupported(self):
+        """A term isn't redundant if an unsupported term between overlaps it."""
+        a = acl.ACL(name='flags', format='junos')
+        for name, dst, action in (('ta', ['10.0.0.0/8'], 'accept'),
+                                  ('tb', None, 'discard'),
+                                  ('tc', None, 'accept')):
+            t = acl.Term(name=name, action=action)
+            t.match['protocol'] = ['tcp']
+            if dst:
+                t.match['destination-address'] = dst
+            a.terms.append(t)
+        a.terms[1].match['tcp-flags'] = ['syn']
+        report = a.analyze()
+        self.assertEqual(report.redundant, [])
+        self.assertEqual(report.unsupported, [a.terms[1]])
+        # Out of the way, the unsupported term doesn't change anything.
+        a.terms[1].match['destination-address'] = ['192.0.2.0/24']
+        self.assertEqual([(f.term.name, [t.name for t in f.related])
+                          for f in a.analyze().redundant], [('ta', ['tc'])])
+
+    def testMergeable(self):
+        """Test grouping of terms that differ in a single match key."""
+        report = self.acl.analyze()
+        self.assertEqual([(g.key, [t.name for t in g.terms])
+                          for g in report.mergeable],
+                         [('destination-address', ['td', 'te', 'tf'])])
+        self.assertEqual(report.output()[-1],
+                         'mergeable on destination-address: td, te, tf')
+
+    def testNothingToReport(self):
+        """An ACL with no problems makes an empty report."""
+        report = acl.ACL(name='empty', format='junos').analyze()
+        self.assertFalse(report)
+        self.assertEqual(report.output(), [])
+
+class CheckOptimizer(unittest.TestCase):
+
+    def setUp(self):
+        self.acl = acl.ACL(name='optimize', format='junos')
+        for name, src, dst, port in (
+                ('t1', '10.1.0.0/16', '192.0.2.1', 80),
+                ('t2', '10.2.0.0/16', '192.0.2.1', 80),
+                ('t3', '10.3.0.0/16', '192.0.2.1', 80),
+                ('t4', '10.1.0.0/16', '192.0.2.2', 80),
+                ('t5', '10.1.0.0/16', '192.0.2.1', 443)):
+            t = acl.Term(name=name)
+            t.match['source-address'] = [src]
+            t.match['destination-address'] = [dst]
+            t.match['protocol'] = ['tcp']
+            t.match['destination-port'] = [port]
+            self.acl.terms.append(t)
+
+    def testMergeTerms(self):
+        """Test that a run of mergeable terms collapses into the last one."""
+        terms = optimizer.merge_terms(self.acl.terms, 'source-address')
+        self.assertEqual([t.name for t in terms], ['t3', 't4', 't5'])
+        self.assertEqual(len(terms[0].match['source-address']), 3)
+        self.assertEqual(str(terms[0].comments[-1]),
+                         'merged [(source-address) 10.1.0.0/16,10.2.0.0/16] from t2')
+
+    def testOptimizeACL(self):
+        """Test that address merging happens before port merging."""
+        a = acl.ACL(name='optimize', format='junos')
+        for name, dst, port in (('a', '192.0.2.1', 80), ('b', '192.0.2.2', 80),
+                                ('c', '192.0.2.1', 443), ('d', '192.0.2.2', 443)):
+            t = acl.Term(name=name)
+            t.match['destination-address'] = [dst]
+            t.match['protocol'] = ['tcp']
+            t.match['destination-port'] = [port]
+            a.terms.append(t)
+        new_acl = optimizer.optimize_acl(a)
+        self.assertEqual([t.name for t in new_acl.terms], ['d'])
+        self.assertEqual(new_acl.terms[0].match['destination-port'], [80, 443])
+        self.assertEqual(len(new_acl.terms[0].match['destination-address']), 2)
+
+    def testNoMergeAcrossDiscard(self):
+        """Terms are never merged across a term with a different action."""
+        self.acl.terms.insert(1, acl.Term(name='drop', action='discard'))
+        terms = optimizer.optimize_terms(self.acl.terms, ['source-address'])
+        self.assertEqual([t.name for t in terms], ['t1', 'drop', 't3', 't4', 't5'])
+
 class CheckParseFile(unittest.TestCase):
 
     def testParaseFile(self):
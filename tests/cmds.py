@@ -0,0 +1,653 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jathan McCollum'
+__maintainer__ = 'Jathan McCollum'
+__copyright__ = 'Copyright 2012 AOL Inc.'
+__version__ = '1.0'
+
+import os
+import random
+import threading
+import time
+import unittest
+from xml.etree.cElementTree import fromstring
+
+from IPy import IP
+from twisted.internet import defer, reactor, task
+from twisted.internet.error import ConnectionLost
+from trigger import cmds
+from trigger.cmds import (Scheduler, device_group, fast_parse_ios_interfaces,
+                          parse_ios_interfaces)
+from trigger.twister import (execute_ioslike, execute_junoscript, LoginTimeout,
+                             SSHConnectionLost)
+
+# Output of "show configuration | include ^(interface | ip address | ..."
+IOS_CONFIG = """\
+!
+interface Port-channel1
+ description gear1-mtc : AE1 : iwslbfa1-mtc-sw0 :  : 1x1000 : 172.20.166.0/24 :  :  :
+ ip address 172.20.166.251 255.255.255.0
+ ip address 10.1.1.1 255.255.255.128 secondary
+ ip access-group 145 in
+ ip access-group 146 out
+!
+interface FastEthernet0/1
+ description\tshutdown
+!
+interface Loopback0
+ ip address 10.10.10.1 255.255.255.255
+!
+interface Vlan12
+ ip access-group BLOCK-IN in
+ ip address 192.168.12.2 255.255.255.0
+!
+"""
+
+FOUNDRY_CONFIG = """\
+!
+Startup-config data location is flash memory
+!
+Startup configuration:
+!
+ver 07.5.05hT53
+!
+module 1 bi-0-port-m4-management-module
+module 2 bi-8-port-gig-module
+!
+interface ethernet 6/6
+ ip access-group 126 in
+ ip address 172.18.48.187/26
+!
+interface ve 12
+ ip address 172.18.49.1/24
+ ip access-group 127 out
+!
+"""
+
+
+def make_ios_config(num_interfaces, rng):
+    """Build an interface config made up of random but well-formed parts."""
+    lines = []
+    for i in xrange(num_interfaces):
+        lines.append('!')
+        lines.append('interface %s' % rng.choice(['GigabitEthernet1/%d',
+                                                  'ethernet 2/%d', 'Vlan%d']) % i)
+        if rng.randint(0, 1):
+            lines.append(' description link %d :  : to\tcore ' % i)
+        if rng.randint(0, 3) == 0:
+            lines.append(' ip access-group ACL%d in' % rng.randint(0, 9))
+        for j in xrange(rng.randint(0, 3)):
+            addr = '10.%d.%d.%d' % (i / 256, i % 256, j * 4 + 1)
+            if rng.randint(0, 1):
+                addr += '/%d' % rng.randint(16, 30)
+            else:
+                addr += ' 255.255.255.%d' % rng.choice([0, 128, 252])
+            lines.append(' ip address %s%s' % (addr, j and ' secondary' or ''))
+        if rng.randint(0, 3) == 0:
+            lines.append(' ip access-group %d out' % rng.randint(100, 199))
+    lines.append('!')
+    return '\n'.join(lines) + '\n'
+
+
+class FakeDevice(object):
+    def __init__(self, nodeName, site='ABC', manufacturer='JUNIPER'):
+        self.nodeName = nodeName
+        self.site = site
+        self.manufacturer = manufacturer
+
+    def __repr__(self):
+        return self.nodeName
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.started = []
+
+    def start(self, dev, job):
+        self.started.append(job)
+
+    def testMaxConns(self):
+        """Test the overall limit on running jobs."""
+        sched = Scheduler(max_conns=2, rate=None, limits={}, clock=self.clock)
+        devs = [FakeDevice('dev%d' % i) for i in range(5)]
+        for i, dev in enumerate(devs):
+            sched.add(dev, i)
+        sched.pump(self.start)
+        self.assertEqual(self.started, [0, 1])
+        self.assertEqual(len(sched), 3)
+
+        sched.done(devs[0])
+        sched.pump(self.start)
+        self.assertEqual(self.started, [0, 1, 2])
+
+    def testRate(self):
+        """Test that starts are spread out by the token bucket."""
+        sched = Scheduler(rate=2, burst=3, limits={}, clock=self.clock)
+        for i in range(10):
+            sched.add(FakeDevice('dev%d' % i), i)
+        sched.pump(self.start)
+        self.assertEqual(len(self.started), 3)
+
+        # Two more every second, without anything having to call pump().
+        self.clock.advance(0.5)
+        self.assertEqual(len(self.started), 4)
+        self.clock.advance(0.5)
+        self.assertEqual(len(self.started), 5)
+        self.clock.pump([0.5] * 10)
+        self.assertEqual(self.started, range(10))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def testLimits(self):
+        """Test per-site and per-group limits."""
+        devs = [FakeDevice('abc1', site='A'), FakeDevice('abc2', site='A'),
+                FakeDevice('xyz1', site='A'), FakeDevice('abc1', site='B')]
+        sched = Scheduler(rate=None, limits={'site': 2, 'group': 1},
+                          clock=self.clock)
+        for dev in devs:
+            sched.add(dev, dev)
+        sched.pump(self.start)
+        # abc1 and abc2 in A are in the same group.
+        self.assertEqual(self.started, [devs[0], devs[2], devs[3]])
+
+        sched.done(devs[0])
+        sched.pump(self.start)
+        self.assertEqual(self.started[-1], devs[1])
+        self.assertEqual(sched.active, 3)
+
+    def testKeyFunction(self):
+        """Test limiting on a function of the device."""
+        sched = Scheduler(rate=None, clock=self.clock,
+                          limits={lambda dev: dev.nodeName[0]: 1})
+        for name in ('a1', 'a2', 'b1'):
+            sched.add(FakeDevice(name), name)
+        sched.pump(self.start)
+        self.assertEqual(self.started, ['a1', 'b1'])
+
+    def testPriority(self):
+        """Test that the lowest priority that may start goes first."""
+        devs = [FakeDevice('a%d' % i, site=site)
+                for i, site in enumerate('AABBB')]
+        sched = Scheduler(rate=None, limits={'site': 1}, clock=self.clock,
+                          priority=lambda dev: -int(dev.nodeName[1]))
+        for dev in devs:
+            sched.add(dev, dev.nodeName)
+        sched.pump(self.start)
+        self.assertEqual(self.started, ['a4', 'a1'])
+        sched.done(devs[4])
+        sched.pump(self.start)
+        self.assertEqual(self.started[-1], 'a3')
+
+    def testLongestFirst(self):
+        durations = {'slow': 60, 'medium': 10, 'fast': 1}
+        devs = [FakeDevice(name, site=site) for name, site in
+                [('fast', 'A'), ('new1', 'A'), ('new2', 'A'), ('new3', 'B'),
+                 ('medium', 'B'), ('slow', 'B')]]
+        sched = Scheduler(max_conns=0, rate=None, limits={}, clock=self.clock,
+                          priority=cmds.longest_first(durations))
+        for dev in devs:
+            sched.add(dev, dev.nodeName)
+        sched.max_conns = None
+        sched.pump(self.start)
+        # Unknown devices are expected to take as long as the slowest, and
+        # devices expected to take as long take turns by site.
+        self.assertEqual(self.started, ['new3', 'new1', 'new2', 'slow',
+                                        'medium', 'fast'])
+
+    def testBetterJobForFreedSlot(self):
+        """Test that a job added after a slot frees up can still take it."""
+        prio = {'a1': 0, 'a2': 2, 'a3': 3, 'a4': 1}
+        devs = [FakeDevice(name, site=site) for name, site in
+                [('a1', 'A'), ('a2', 'B'), ('a3', 'C'), ('a4', 'C')]]
+        sched = Scheduler(rate=None, clock=self.clock,
+                          limits={'site': 2, lambda dev: dev.nodeName[0]: 1},
+                          priority=lambda dev: prio[dev.nodeName])
+        for dev in devs[:3]:
+            sched.add(dev, dev.nodeName)
+        sched.pump(self.start)
+        sched.done(devs[0])
+        sched.add(devs[3], 'a4')
+        sched.pump(self.start)
+        self.assertEqual(self.started, ['a1', 'a4'])
+        sched.done(devs[3])
+        sched.pump(self.start)
+        self.assertEqual(self.started[-1], 'a2')
+
+    def testPerDeviceLimitCost(self):
+        """Test that starting jobs doesn't check every queue each time."""
+        sched = Scheduler(rate=None, clock=self.clock,
+                          limits={'site': 2, lambda dev: dev.nodeName: 1})
+        checks = []
+        blocking = sched._blocking
+        sched._blocking = lambda keys: (checks.append(keys), blocking(keys))[1]
+        devs = [FakeDevice('dev%d' % i) for i in range(300)]
+        for dev in devs:
+            sched.add(dev, dev)
+        running = []
+        sched.pump(lambda dev, job: running.append(dev))
+        while running:
+            sched.done(running.pop(0))
+            sched.pump(lambda dev, job: running.append(dev))
+        self.assertEqual(len(sched), 0)
+        self.assert_(len(checks) < 3 * len(devs))
+
+    def testDeviceGroup(self):
+        self.assertEqual(device_group(FakeDevice('36bit1', site='X')),
+                         ('X', '36biX'))
+        self.assertEqual(device_group(FakeDevice('abce2', site='X')),
+                         ('X', 'abce'))
+
+class ParseIOSInterfacesTest(unittest.TestCase):
+    def assertParity(self, data):
+        for acls_as_list in (True, False):
+            expected = parse_ios_interfaces(data, acls_as_list=acls_as_list)
+            self.assertTrue(expected)
+            self.assertEqual(fast_parse_ios_interfaces(data, acls_as_list),
+                             expected)
+
+    def testIOS(self):
+        self.assertParity(IOS_CONFIG)
+        results = fast_parse_ios_interfaces(IOS_CONFIG)
+        self.assertEqual(sorted(results), ['Loopback0', 'Port-channel1',
+                                           'Vlan12'])
+        self.assertEqual(results['Port-channel1']['acl_out'], ['146'])
+        self.assertEqual(map(str, results['Port-channel1']['subnets']),
+                         ['172.20.166.0/24', '10.1.1.0/25'])
+
+    def testFoundry(self):
+        self.assertParity(FOUNDRY_CONFIG)
+        results = fast_parse_ios_interfaces(FOUNDRY_CONFIG)
+        self.assertEqual(sorted(results), ['ethernet6/6', 've12'])
+
+    def testGenerated(self):
+        self.assertParity(make_ios_config(300, random.Random(1)))
+
+    def testCRLF(self):
+        self.assertParity(IOS_CONFIG.replace('\n', '\r\n'))
+
+    def testUnexpectedLine(self):
+        """Test that the fast parser skips lines it doesn't know."""
+        data = IOS_CONFIG.replace(' ip address 10.10.10.1',
+                                  ' ip address dhcp\n ip address 10.10.10.1')
+        self.assertEqual(parse_ios_interfaces(data), {})
+        self.assertEqual(fast_parse_ios_interfaces(data),
+                         fast_parse_ios_interfaces(IOS_CONFIG))
+
+    def testGrammarCached(self):
+        parse_ios_interfaces(IOS_CONFIG)
+        grammar = cmds._ios_grammars[True]
+        parse_ios_interfaces(FOUNDRY_CONFIG)
+        self.assertTrue(cmds._ios_grammars[True] is grammar)
+
+class MakeIPTest(unittest.TestCase):
+    def assertSameIP(self, got, expected):
+        self.assertEqual(got, expected)
+        self.assertEqual(str(got), str(expected))
+        self.assertEqual(got.version(), expected.version())
+
+    def testParity(self):
+        """Test that addresses and subnets come out the same as from IPy."""
+        rng = random.Random(2)
+        nets = [('10.1.2.3', '255.255.255.0'), ('010.1.2.3', '24'),
+                ('1.2.3.4', '08'), ('1.2.3.4', '0'), ('1.2.3.4', '32'),
+                (u'172.16.0.9', u'30'), ('2001:db8::1', '64')]
+        for i in xrange(500):
+            addr = '.'.join([str(rng.randint(0, 255)) for j in range(4)])
+            bits = rng.randint(0, 32)
+            if rng.randint(0, 1):
+                nets.append((addr, str(bits)))
+            else:
+                nets.append((addr, str(IP('0.0.0.0/%d' % bits).netmask())))
+
+        addrs, subnets = cmds.make_ipy(nets), cmds.make_cidrs(nets)
+        for (addr, mask), ip, subnet in zip(nets, addrs, subnets):
+            self.assertSameIP(ip, IP(addr))
+            self.assertSameIP(subnet, IP(addr).make_net(mask))
+
+    def testInvalid(self):
+        for addr, mask in [('1.2.3.4', '255.0.255.0'), ('1.2.3.4', '33'),
+                           ('1.2.3.256', '24')]:
+            self.assertRaises(ValueError, cmds.make_cidrs, [(addr, mask)])
+
+    def testIPsubnet(self):
+        self.assertSameIP(cmds.NetACLInfo.IPsubnet.im_func(None, '172.20.1.4/24'),
+                          IP('172.20.1.0/24'))
+
+class ParseThreadsTest(unittest.TestCase):
+    def setUp(self):
+        # Commando always loads NetDevices, which we don't need here.
+        self.NetDevices = cmds.NetDevices
+        cmds.NetDevices = lambda production_only=True: None
+
+    def tearDown(self):
+        cmds.NetDevices = self.NetDevices
+
+    def parser(self, commando):
+        def parse(results, dev):
+            commando.set_data(dev, (results, threading.current_thread()))
+            time.sleep(0.01)
+            return True
+        return parse
+
+    def testNoThreads(self):
+        commando = cmds.Commando()
+        self.assertEqual(commando._parse(['out'], self.parser(commando), 'a'),
+                         True)
+        self.assertEqual(commando.data['a'],
+                         (['out'], threading.current_thread()))
+
+    def testThreads(self):
+        """Test that parsing happens in the pool, a bounded number at a time."""
+        commando = cmds.Commando(parse_threads=2, parse_queue=3)
+        parse = self.parser(commando)
+        done = []
+        for i in range(8):
+            commando._parse(['out%d' % i], parse, i).addCallback(done.append)
+        self.assertEqual(len(commando.parse_slots.waiting), 5)
+
+        deadline = time.time() + 10
+        while len(done) < 8 and time.time() < deadline:
+            reactor.iterate(0.01)
+        commando.parse_pool.stop()
+
+        self.assertEqual(done, [True] * 8)
+        self.assertEqual(commando.parse_slots.tokens, 3)
+        for i in range(8):
+            results, thread = commando.data[i]
+            self.assertEqual(results, ['out%d' % i])
+            self.assertNotEqual(thread, threading.current_thread())
+
+class RetryTest(unittest.TestCase):
+    def setUp(self):
+        self.NetDevices = cmds.NetDevices
+        cmds.NetDevices = lambda production_only=True: None
+        self.clock = task.Clock()
+        self.sessions = []
+
+    def tearDown(self):
+        cmds.NetDevices = self.NetDevices
+
+    def execute(self, dev, cmds, **kwargs):
+        d = defer.Deferred()
+        self.sessions.append((dev, d))
+        return d
+
+    def commando(self, devices, **kwargs):
+        commando = cmds.Commando(**kwargs)
+        commando.scheduler = Scheduler(10, clock=self.clock)
+        for dev in devices:
+            commando.jobs.append((dev, self.execute,
+                                  commando._base_generate_cmd,
+                                  commando._base_parse))
+        commando._add_worker()
+        return commando
+
+    def finish(self, dev, result):
+        """Fire the deferred of the running session for dev."""
+        for idx, (session_dev, d) in enumerate(self.sessions):
+            if session_dev is dev:
+                del self.sessions[idx]
+                if isinstance(result, Exception):
+                    d.errback(result)
+                else:
+                    d.callback(result)
+                return
+        self.fail('No session for %s' % dev)
+
+    def testOrder(self):
+        """Test that jobs run in the order given and record durations."""
+        devs = [FakeDevice('a'), FakeDevice('b'), FakeDevice('c')]
+        commando = self.commando(devs)
+        self.assertEqual([dev for dev, d in self.sessions], devs)
+        self.clock.advance(2)
+        self.finish(devs[1], ['ok'])
+        self.clock.advance(3)
+        self.finish(devs[0], ['ok'])
+        self.finish(devs[2], ValueError('bad'))
+        self.assertEqual(commando.durations, {'a': 5, 'b': 2})
+
+    def testBackoff(self):
+        """Test that transient errors are retried with growing delays."""
+        a, b = FakeDevice('a'), FakeDevice('b')
+        commando = self.commando([a, b], retries=cmds.TRANSIENT_RETRIES,
+                                 retry_delay=1, retry_backoff=2)
+        self.finish(a, ['ok'])
+        self.finish(b, LoginTimeout('slow'))
+        self.assertEqual(commando.retrying, 1)
+
+        self.clock.advance(0.9)
+        self.assertEqual(self.sessions, [])
+        self.clock.advance(0.1)
+        self.finish(b, ConnectionLost())
+        self.clock.advance(1.9)
+        self.assertEqual(self.sessions, [])
+        self.clock.advance(0.1)
+        self.finish(b, ['ok too'])
+
+        self.assertEqual(commando.data, {a: ['ok'], b: ['ok too']})
+        self.assertEqual(commando.attempts, {a: 1, b: 3})
+        self.assertEqual(commando.errors, {})
+        self.assertEqual((commando.curr_connections, commando.retrying), (0, 0))
+
+    def testGiveUp(self):
+        """Test that unlisted errors and the last attempt aren't retried."""
+        a, b = FakeDevice('a'), FakeDevice('b')
+        commando = self.commando([a, b], retries={LoginTimeout: 2})
+        self.finish(a, ValueError('bad'))
+        self.finish(b, LoginTimeout('slow'))
+        self.clock.advance(1)
+        self.finish(b, LoginTimeout('slow'))
+        self.clock.advance(60)
+
+        self.assertEqual(self.sessions, [])
+        self.assertTrue(isinstance(commando.errors[a], ValueError))
+        self.assertTrue(isinstance(commando.errors[b], LoginTimeout))
+        self.assertEqual(commando.attempts, {a: 1, b: 2})
+        self.assertEqual(commando.retrying, 0)
+
+    def testDeadline(self):
+        """Test that a job is cancelled and not retried past its deadline."""
+        a = FakeDevice('a')
+        commando = self.commando([a], retries={LoginTimeout: 5},
+                                 retry_delay=4, deadline=10)
+        self.clock.advance(5)
+        self.finish(a, LoginTimeout('slow'))
+        self.clock.advance(4)
+        self.clock.advance(1)
+        self.assertTrue(isinstance(commando.errors[a], defer.CancelledError))
+        self.assertEqual(commando.attempts, {a: 2})
+        self.assertEqual(commando.curr_connections, 0)
+
+        b = FakeDevice('b')
+        commando = self.commando([b], deadline=10)
+        self.clock.advance(9)
+        self.finish(b, ['ok'])
+        self.clock.advance(5)
+        self.assertEqual(commando.data, {b: ['ok']})
+        self.assertEqual(commando.errors, {})
+
+class VendorsTest(unittest.TestCase):
+    def setUp(self):
+        self.NetDevices = cmds.NetDevices
+        cmds.NetDevices = lambda production_only=True: None
+
+    def tearDown(self):
+        cmds.NetDevices = self.NetDevices
+
+    def testDefaults(self):
+        commando = cmds.NetACLInfo()
+        dev = FakeDevice('r1', manufacturer='CISCO SYSTEMS')
+        callback = commando._setup_callback(dev)
+        self.assertEqual(callback, [dev, execute_ioslike,
+                                    commando.generate_ios_cmd,
+                                    commando.ios_parse])
+        self.assertEqual(callback[3].im_func, cmds.NetACLInfo.ios_parse.im_func)
+        self.assertTrue(commando._setup_callback(dev)[3] is callback[3])
+        self.assertRaises(KeyError, commando._setup_callback,
+                          FakeDevice('r2', manufacturer='ACME'))
+
+    def testRegister(self):
+        """Test registering a vendor OS on a subclass."""
+        class SRXCommando(cmds.Commando):
+            def srx_parse(self, results, dev):
+                return 'srx'
+
+        SRXCommando.register_vendor('JUNIPER', execute_junoscript,
+                                    lambda self, dev: ['show srx'],
+                                    'srx_parse',
+                                    match=lambda dev: dev.nodeName == 'srx1')
+        SRXCommando.register_vendor('ACME', execute_ioslike,
+                                    'generate_ios_cmd', 'ios_parse')
+
+        commando = SRXCommando()
+        srx, mx = FakeDevice('srx1'), FakeDevice('mx1')
+        dev, execute, generate, parse = commando._setup_callback(srx)
+        self.assertEqual((generate(srx), parse([], srx)), (['show srx'], 'srx'))
+        self.assertEqual(commando._setup_callback(mx)[3], commando.junos_parse)
+        self.assertEqual(
+            commando._setup_callback(FakeDevice('a', manufacturer='ACME'))[1],
+            execute_ioslike)
+
+        # The parent class is left alone.
+        self.assertFalse('ACME' in cmds.Commando.vendors)
+        self.assertEqual(len(cmds.Commando.vendors['JUNIPER']), 1)
+
+class ShardTestCommando(cmds.Commando):
+    """Pretends to run devices, recording the process each one ran in."""
+    def __init__(self, **kwargs):
+        NetDevices = cmds.NetDevices
+        cmds.NetDevices = lambda production_only=True: None
+        try:
+            cmds.Commando.__init__(self, **kwargs)
+        finally:
+            cmds.NetDevices = NetDevices
+
+    def execute(self, dev, commands, **kwargs):
+        if dev.nodeName.startswith('xml'):
+            # What execute_junoscript returns.
+            return defer.succeed([fromstring('<rpc-reply><ok/></rpc-reply>')])
+        if dev.nodeName.startswith('lambda'):
+            return defer.succeed(lambda: None)
+        return defer.succeed((os.getpid(), self.max_conns))
+
+    def _setup_jobs(self):
+        for name in self.devices:
+            if name.startswith('bad'):
+                # Not picklable, as it has a different constructor.
+                self.errors[name] = SSHConnectionLost(255, 'lost')
+                continue
+            self.jobs.append([FakeDevice(name, site=name[0]), self.execute,
+                              self._base_generate_cmd, self._base_parse])
+
+class ShardedCommandoTest(unittest.TestCase):
+    def setUp(self):
+        self.devices = [FakeDevice(name, site=name[0]) for name in
+                        ('a1', 'a2', 'a3', 'b1', 'b2', 'c1', 'bad1')]
+
+    def testShards(self):
+        """Test that sites are kept together and shards are balanced."""
+        sharded = cmds.ShardedCommando(ShardTestCommando, self.devices,
+                                       processes=3)
+        self.assertEqual(sharded.shards(), [['a1', 'a2', 'a3'],
+                                            ['b1', 'b2', 'bad1'], ['c1']])
+        sharded = cmds.ShardedCommando(ShardTestCommando, self.devices[:2],
+                                       processes=3)
+        self.assertEqual(sharded.shards(), [['a1', 'a2']])
+
+    def testBudget(self):
+        """Test that concurrency limits are split between processes."""
+        sharded = cmds.ShardedCommando(ShardTestCommando, self.devices,
+                                       processes=4, max_conns=40, rate=8,
+                                       burst=4, limits={'site': 2,
+                                                        'vendor': 8},
+                                       timeout=5)
+        self.assertEqual(sharded.processes, 4)
+        workers = sharded.worker_kwargs(3)
+        self.assertEqual([(kw['max_conns'], kw['burst']) for kw in workers],
+                         [(14, 2), (13, 1), (13, 1)])
+        self.assertEqual(sum([kw['rate'] for kw in workers]), 8)
+        self.assertEqual([kw['limits'] for kw in workers],
+                         [{'site': 2, 'vendor': 3}, {'site': 2, 'vendor': 3},
+                          {'site': 2, 'vendor': 2}])
+        self.assertEqual(workers[0]['timeout'], 5)
+
+    def testSmallBudget(self):
+        """Test that a budget smaller than processes means fewer workers."""
+        sharded = cmds.ShardedCommando(ShardTestCommando, self.devices,
+                                       processes=8, max_conns=2)
+        self.assertEqual(sharded.processes, 2)
+        self.assertEqual(len(sharded.shards()), 2)
+        self.assertEqual([kw['max_conns'] for kw in sharded.worker_kwargs(2)],
+                         [1, 1])
+        sharded = cmds.ShardedCommando(ShardTestCommando, self.devices,
+                                       processes=8, rate=5, burst=3,
+                                       limits={'vendor': 4})
+        self.assertEqual(sharded.processes, 3)
+        sharded = cmds.ShardedCommando(ShardTestCommando, self.devices,
+                                       processes=8, max_conns=None,
+                                       limits={'site': 1})
+        self.assertEqual(sharded.processes, 7)
+
+    def testRun(self):
+        sharded = cmds.ShardedCommando(ShardTestCommando, self.devices,
+                                       processes=2, max_conns=8)
+        sharded.run()
+        self.assertEqual(set(sharded.data), set(self.devices[:-1]))
+        pids = set([pid for pid, max_conns in sharded.data.values()])
+        self.assertEqual(len(pids), 2)
+        self.assertFalse(os.getpid() in pids)
+        self.assertEqual(set([m for p, m in sharded.data.values()]), set([4]))
+        self.assertEqual(sharded.errors, {self.devices[-1]: 'lost'})
+        self.assertEqual(sorted(sharded.durations),
+                         ['a1', 'a2', 'a3', 'b1', 'b2', 'c1'])
+
+    def testUnpicklable(self):
+        """Test that a value that can't be pickled only fails its device."""
+        devices = [FakeDevice(name, site='a') for name in
+                   ('a1', 'xml1', 'lambda1')]
+        sharded = cmds.ShardedCommando(ShardTestCommando, devices,
+                                       processes=1)
+        sharded.run()
+        a1, xml1, lambda1 = devices
+        self.assertEqual(set(sharded.data), set([a1, xml1]))
+        self.assertEqual(sharded.data[xml1][0].tag, 'rpc-reply')
+        self.assertEqual(sharded.data[xml1][0][0].tag, 'ok')
+        self.assertEqual(sharded.errors.keys(), [lambda1])
+        self.assertTrue(sharded.errors[lambda1].startswith(
+            'Result could not be pickled'))
+
+class IncrementalTest(unittest.TestCase):
+    def setUp(self):
+        self.NetDevices = cmds.NetDevices
+        cmds.NetDevices = lambda production_only=True: None
+
+    def tearDown(self):
+        cmds.NetDevices = self.NetDevices
+
+    def testIOS(self):
+        dev = FakeDevice('router1', manufacturer='CISCO SYSTEMS')
+        first = cmds.NetACLInfo(known_hashes={})
+        first.ios_parse([IOS_CONFIG], dev)
+        self.assertEqual(first.config[dev], parse_ios_interfaces(IOS_CONFIG))
+        self.assertEqual(first.unchanged, set())
+
+        second = cmds.NetACLInfo(known_hashes=first.hashes)
+        second.ios_parse([IOS_CONFIG], dev)
+        self.assertEqual(second.config, {})
+        self.assertEqual(second.unchanged, set(['router1']))
+        self.assertEqual(second.hashes, first.hashes)
+
+        third = cmds.NetACLInfo(known_hashes=first.hashes)
+        third.ios_parse([IOS_CONFIG.replace('145', '150')], dev)
+        self.assertEqual(third.config[dev]['Port-channel1']['acl_in'], ['150'])
+        self.assertNotEqual(third.hashes, first.hashes)
+
+    def testJunosHandlers(self):
+        """Test that incremental runs keep the whole Junos reply."""
+        self.assertEqual(cmds.NetACLInfo(known_hashes={}).xml_handlers('r1'),
+                         None)
+        self.assertTrue(cmds.NetACLInfo().xml_handlers('r1'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jathan McCollum'
+__maintainer__ = 'Jathan McCollum'
+__copyright__ = 'Copyright 2012 AOL Inc.'
+__version__ = '1.0'
+
+import os
+import tempfile
+import unittest
+
+from trigger.cmds import parse_ios_interfaces
+from trigger.netindex import Entry, InterfaceIndex
+
+IOS_CONFIG = """\
+!
+interface Port-channel1
+ ip address 172.20.166.251 255.255.255.0
+ ip address 10.1.1.1 255.255.255.128 secondary
+ ip access-group 145 in
+ ip access-group 146 out
+!
+interface Loopback0
+ ip address 10.10.10.1 255.255.255.255
+!
+interface Vlan12
+ ip access-group BLOCK-IN in
+ ip address 192.168.12.2 255.255.255.0
+!
+"""
+
+
+class InterfaceIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = InterfaceIndex()
+        self.index.add_config({'router1': parse_ios_interfaces(IOS_CONFIG)})
+
+    def testLookup(self):
+        """Test longest-prefix matches on addresses and subnets."""
+        lookup = self.index.lookup
+        self.assertEqual(lookup('172.20.166.9'),
+                         [Entry('router1', 'Port-channel1', '172.20.166.251',
+                                '172.20.166.0/24', ('145',), ('146',))])
+        self.assertEqual(lookup('172.20.166.251')[0].network, '172.20.166.251')
+        self.assertEqual(lookup('10.1.1.64/26')[0].network, '10.1.1.0/25')
+        self.assertEqual(lookup('10.10.10.1')[0].interface, 'Loopback0')
+        self.assertEqual(lookup('192.168.12.0/24')[0].acl_in, ('BLOCK-IN',))
+        self.assertEqual(lookup('10.1.1.128'), [])
+        self.assertEqual(lookup('10.1.0.0/16'), [])
+        self.assertEqual(lookup('2001:db8::1'), [])
+
+    def testLoopback(self):
+        """Test that a host route is only indexed once."""
+        self.assertEqual(self.index.lookup('10.10.10.1'),
+                         [Entry('router1', 'Loopback0', '10.10.10.1',
+                                '10.10.10.1', (), ())])
+        self.index.add('router2', 'lo0.0', '2001:db8::1', '2001:db8::1/128')
+        self.assertEqual(len(self.index.lookup('2001:db8::1')), 1)
+
+    def testShared(self):
+        """Test that every device on a shared subnet is returned."""
+        self.index.add('router2', 'Vlan12', '192.168.12.3', '192.168.12.0/24')
+        self.assertEqual([e.device for e in self.index.lookup('192.168.12.9')],
+                         ['router1', 'router2'])
+        self.assertEqual(self.index.lookup('192.168.12.3')[0].device, 'router2')
+
+    def testReplace(self):
+        """Test that adding a device's config replaces its old entries."""
+        config = parse_ios_interfaces(IOS_CONFIG.replace('172.20.166',
+                                                         '172.20.167'))
+        self.index.add_config({'router1': config})
+        self.assertEqual(self.index.lookup('172.20.166.9'), [])
+        self.assertEqual(self.index.lookup('172.20.167.9')[0].device, 'router1')
+
+        self.index.remove_devices(['router1'])
+        self.assertEqual(len(self.index), 0)
+        self.assertEqual(self.index.lookup('172.20.167.9'), [])
+
+    def testSaveLoad(self):
+        self.index.add('router2', 'ge-0/0/0.0', '2001:db8::1', '2001:db8::/64')
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.index.save(filename)
+            loaded = InterfaceIndex.load(filename)
+        finally:
+            os.unlink(filename)
+        self.assertEqual(len(loaded), len(self.index))
+        for query in ('172.20.166.9', '10.1.1.1', '10.10.10.1',
+                      '192.168.12.0/25', '2001:db8::5'):
+            self.assertEqual(loaded.lookup(query), self.index.lookup(query))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,10 +8,17 @@ __maintainer__ = 'Jathan McCollum'
 __copyright__ = 'Copyright 2005-2011 AOL Inc.'
 __version__ = '1.1'
 
+import imp
 import os
+import subprocess
+import tempfile
 import unittest
 
+from trigger.cmds import parse_ios_interfaces
+
 ACLCONV = 'bin/aclconv'
+CHECK_ACCESS = 'bin/check_access'
+GNNG = 'bin/gnng'
 
 os.environ['PYTHONPATH'] = os.getcwd()
 
@@ -40,5 +47,137 @@ replace:
         self.assertEqual(child_out.read(), correct_output)
         self.assertEqual(child_out.close(), None)
 
+class CheckAccess(unittest.TestCase):
+    def testBadFlowRow(self):
+        """Test that a bad row in --flows mode doesn't stop the others."""
+        proc = subprocess.Popen([CHECK_ACCESS, '-e', 'python', '-f', '-',
+                                 'tests/data/acl.test'],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate('46.31.162.158,10.0.0.1,tcp,80\n'
+                                    '10.0.0.0/24,10.0.0.1,tcp,80\n'
+                                    '193.49.20.164,10.0.0.1,tcp,22\n')
+        self.assertEqual(proc.returncode, 1)
+        self.assertEqual([row.split(',')[-1] for row in out.splitlines()],
+                         ['permit', 'permit'])
+        self.assert_(err.startswith('-, line 2: '))
+
+IOS_CONFIG = """\
+!
+interface Port-channel1
+ ip address 172.20.166.251 255.255.255.0
+ ip access-group 145 in
+!
+interface Vlan12
+ ip access-group BLOCK-IN in
+ ip address 192.168.12.2 255.255.255.0
+!
+"""
+
+def load_gnng():
+    """Load bin/gnng as a module, without running it."""
+    gnng = imp.new_module('gnng')
+    execfile(GNNG, gnng.__dict__)
+    return gnng
+
+class Gnng(unittest.TestCase):
+    def setUp(self):
+        self.gnng = load_gnng()
+        fd, self.sqlfile = tempfile.mkstemp()
+        os.close(fd)
+        self.rows = self.gnng.make_rows('router1',
+                                        parse_ios_interfaces(IOS_CONFIG))
+
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.sqlfile + suffix):
+                os.unlink(self.sqlfile + suffix)
+
+    def read(self, dev):
+        connection = self.gnng.open_sqldb(self.sqlfile)
+        rows = self.gnng.read_rows(connection, dev)
+        connection.close()
+        return rows
+
+    def testIncrementalArgs(self):
+        """Test that --incremental is only allowed when writing the db."""
+        parse_args = self.gnng.parse_args
+        opts, args = parse_args(['gnng', '-s', self.sqlfile, '-i', 'router1'])
+        self.assert_(opts.incremental)
+        for argv in (['-i'], ['-s', self.sqlfile, '-i', '--csv'],
+                     ['-s', self.sqlfile, '-i', '--dotty']):
+            self.assertRaises(SystemExit, parse_args,
+                              ['gnng'] + argv + ['router1'])
+
+    def testMakeRows(self):
+        self.assertEqual(self.rows, [
+            ['Port-channel1', '172.20.166.251', '172.20.166.0/24', '145', '',
+             ''],
+            ['Vlan12', '192.168.12.2', '192.168.12.0/24', 'BLOCK-IN', '', '']])
+
+    def testBatches(self):
+        """Test that no more than batch_size rows are written per commit."""
+        events = []
+        class Writer(self.gnng.SQLWriter):
+            def _write(self, connection, op, values):
+                events.append('write')
+                self.__class__.__bases__[0]._write(self, connection, op,
+                                                   values)
+            def _commit(self, connection):
+                events.append('commit')
+                self.__class__.__bases__[0]._commit(self, connection)
+
+        writer = Writer(self.sqlfile, batch_size=2)
+        for i in range(5):
+            writer.insert('router%d' % i, self.rows[:1])
+        writer.close()
+        self.assertEqual(events.count('write'), 5)
+        self.assertEqual(events[-1], 'commit')
+        self.failIf('write,write,write' in ','.join(events))
+        for i in range(5):
+            self.assertEqual(self.read('router%d' % i).keys(),
+                             ['Port-channel1'])
+
+    def testLost(self):
+        """Test that a failed write loses only the device it was for."""
+        writer = self.gnng.SQLWriter(self.sqlfile)
+        writer.insert('router1', self.rows)
+        # The second row has a column missing, after the first is inserted.
+        writer.insert('router2', [self.rows[0], self.rows[1][:-1]])
+        writer.insert('router3', self.rows)
+        writer.update_hashes({'router1': 'a', 'router2': 'b', 'router3': 'c'})
+        writer.close()
+
+        self.assertEqual(writer.lost.keys(), ['router2'])
+        self.assertEqual(len(self.read('router1')), 2)
+        self.assertEqual(self.read('router2'), {})
+        self.assertEqual(len(self.read('router3')), 2)
+        self.assertEqual(self.gnng.read_hashes(self.sqlfile),
+                         {'router1': 'a', 'router3': 'c'})
+
+    def testIncremental(self):
+        """Test that only changed interfaces are rewritten."""
+        writer = self.gnng.SQLWriter(self.sqlfile)
+        writer.insert('router1', self.rows)
+        writer.update_hashes({'router1': 'a'})
+        writer.close()
+        self.assertEqual(self.gnng.read_hashes(self.sqlfile), {'router1': 'a'})
+
+        current = self.read('router1')
+        self.assertEqual(self.gnng.diff_rows(current, self.rows), ([], []))
+        rows = [self.rows[0][:-1] + ['changed']]
+        added, removed = self.gnng.diff_rows(current, rows)
+        self.assertEqual(added, [tuple(rows[0])])
+        self.assertEqual(sorted(removed), ['Port-channel1', 'Vlan12'])
+
+        writer = self.gnng.SQLWriter(self.sqlfile)
+        connection = self.gnng.open_sqldb(self.sqlfile)
+        self.gnng.write_rows(writer, 'router1', rows, connection)
+        connection.close()
+        writer.update_hashes({'router1': 'b'})
+        writer.close()
+        self.assertEqual(self.read('router1'), {'Port-channel1': tuple(rows[0])})
+        self.assertEqual(self.gnng.read_hashes(self.sqlfile), {'router1': 'b'})
+
 if __name__ == "__main__":
     unittest.main()
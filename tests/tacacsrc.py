@@ -9,9 +9,10 @@ __version__ = '1.5'
 
 from StringIO import StringIO
 import os
+import threading
 import unittest
 
-from trigger.tacacsrc import Tacacsrc
+from trigger.tacacsrc import Tacacsrc, Credentials, CredentialProvider
 
 RIGHT_CREDS = ('jschmoe', 'abc123')
 RIGHT_TACACSRC = {
@@ -50,6 +51,44 @@ class TacacsrcTest(unittest.TestCase):
         self.assertEqual(output, RIGHT_TACACSRC)
         self.assertEqual(output, miniparser(file(os.getenv('TACACSRC')).read()))
 
+class FakeTacacsrc(object):
+    loads = 0
+    def __init__(self):
+        FakeTacacsrc.loads += 1
+        self.creds = {'aol': Credentials('jschmoe', 'abc123', 'aol')}
+
+class CredentialProviderTest(unittest.TestCase):
+    def setUp(self):
+        FakeTacacsrc.loads = 0
+
+    def testCached(self):
+        """Test that .tacacsrc is only read once by all threads."""
+        provider = CredentialProvider(loader=FakeTacacsrc)
+        results = []
+        def worker():
+            for i in range(50):
+                results.append(provider.get('aol'))
+        threads = [threading.Thread(target=worker) for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(FakeTacacsrc.loads, 1)
+        self.assertEqual(len(results), 500)
+        self.assertEqual(set(r[:2] for r in results), set([RIGHT_CREDS]))
+
+    def testTTL(self):
+        """Test that .tacacsrc is read again after the TTL or invalidate()."""
+        provider = CredentialProvider(ttl=0, loader=FakeTacacsrc)
+        provider.get('aol')
+        provider.get('aol')
+        self.assertEqual(FakeTacacsrc.loads, 2)
+        provider = CredentialProvider(ttl=3600, loader=FakeTacacsrc)
+        provider.get('aol')
+        provider.invalidate()
+        provider.get('aol')
+        self.assertEqual(FakeTacacsrc.loads, 4)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,598 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jathan McCollum'
+__maintainer__ = 'Jathan McCollum'
+__copyright__ = 'Copyright 2012 AOL Inc.'
+__version__ = '1.0'
+
+import re
+import unittest
+
+from twisted.internet import defer, task
+from twisted.internet.error import ConnectionLost
+from twisted.python import log
+from twisted.python.failure import Failure
+from trigger import twister
+from xml.etree.ElementTree import Element
+from trigger.twister import (IoslikeSendExpect, PromptBuffer, SessionPool,
+                             SessionStats, SSHMultiplexer, TriggerClientFactory,
+                             TriggerSSHChannelFactory,
+                             TriggerSSHJunoscriptChannel,
+                             TriggerSSHMultiplexFactory)
+
+IOS_PROMPT = re.compile('[a-zA-Z0-9-_]+(@[a-zA-Z0-9-_]+)?(\(config(-[a-z]+)?\))?#', re.M)
+NETSCALER_PROMPT = re.compile('\sDone\n$')
+
+
+def feed_all(buf, data, size):
+    """Feed data to buf in chunks of size, returning the last result."""
+    for i in xrange(0, len(data), size):
+        end = buf.feed(data[i:i+size])
+        if end is not None:
+            return end
+    return None
+
+class PromptBufferTest(unittest.TestCase):
+    def testSplitPrompt(self):
+        """Test finding a prompt split across many small chunks."""
+        data = 'show version\n' + 'line of output\n' * 500 + 'router1(config-if)#'
+        for size in (1, 3, 7, 64, 4096):
+            buf = PromptBuffer(IOS_PROMPT, overlap=32)
+            end = feed_all(buf, data, size)
+            self.assertEqual(end, data.rfind('\nrouter1') + 1)
+            self.assertEqual(buf.getvalue()[:end], data[:end])
+
+    def testSameAsFullSearch(self):
+        """Test that offsets match searching the whole output."""
+        data = 'x' * 3000 + '\n' + 'ns Done' + ' ' * 2000 + 'Done\n'
+        buf = PromptBuffer(NETSCALER_PROMPT, overlap=16)
+        self.assertEqual(feed_all(buf, data, 5),
+                         NETSCALER_PROMPT.search(data).start())
+
+    def testNewlineBeforeSplitPrompt(self):
+        """Test a prompt that matches the newline ending the last chunk."""
+        buf = PromptBuffer(NETSCALER_PROMPT)
+        self.assertEqual(buf.feed('x' * 300 + '\n'), None)
+        self.assertEqual(buf.feed('Done\n'), 300)
+
+    def testClear(self):
+        """Test clear() and startswith()."""
+        buf = PromptBuffer(NETSCALER_PROMPT)
+        buf.feed('ERR')
+        buf.feed('OR: bad')
+        self.assert_(buf.startswith('ERROR:'))
+        buf.clear()
+        self.assertEqual(len(buf), 0)
+        self.assertEqual(buf.getvalue(), '')
+        self.assertFalse(buf.startswith('ERROR:'))
+
+class Unprintable(object):
+    def __repr__(self):
+        raise AssertionError('formatted a debug message')
+
+class DebugLogTest(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+        self.old_debug = twister.DEBUG
+        log.addObserver(self.events.append)
+
+    def tearDown(self):
+        log.removeObserver(self.events.append)
+        twister.DEBUG = self.old_debug
+
+    def testDisabled(self):
+        """Test that nothing is formatted or logged with DEBUG off."""
+        twister.DEBUG = False
+        twister._debug('data: %r', Unprintable())
+        self.assertEqual(self.events, [])
+
+    def testEnabled(self):
+        twister.DEBUG = True
+        twister._debug('got %r and %d', 'abc', 2)
+        self.assertEqual(self.events[0]['message'], ("got 'abc' and 2",))
+        self.assert_(self.events[0]['debug'])
+
+    def testSessionStats(self):
+        """Test that session stats are only logged with DEBUG on."""
+        factory = TriggerClientFactory(defer.Deferred(), creds=('a', 'b'))
+        factory.cancelled = True
+        twister.DEBUG = False
+        factory.clientConnectionLost(None, Failure(ConnectionLost()))
+        self.assertEqual(self.events, [])
+        twister.DEBUG = True
+        factory.clientConnectionLost(None, Failure(ConnectionLost()))
+        stats = [e for e in self.events if 'session_stats' in e]
+        self.assertEqual(stats[0]['session_stats'], factory.stats)
+
+class SessionStatsTest(unittest.TestCase):
+    def testCounts(self):
+        stats = SessionStats()
+        stats.received('abc')
+        stats.received('de')
+        stats.sent('show version\n')
+        self.assertEqual((stats.bytes_received, stats.packets_received), (5, 2))
+        self.assertEqual((stats.bytes_sent, stats.packets_sent), (13, 1))
+        self.assert_('received 5 bytes in 2 packets' in repr(stats))
+
+class FakeDevice(object):
+    manufacturer = 'CISCO SYSTEMS'
+
+    def __init__(self, nodeName='router1'):
+        self.nodeName = nodeName
+
+    def __str__(self):
+        return self.nodeName
+
+    def is_firewall(self):
+        return False
+
+    def is_netscaler(self):
+        return False
+
+def paced_session(clock, commands, interval, on_result=None):
+    """
+    Return an IoslikeSendExpect talking to a fake device on clock, which
+    echoes each command back followed by a prompt.
+    """
+    session = IoslikeSendExpect(FakeDevice(), commands,
+                                command_interval=interval, on_result=on_result)
+    session.callLater = clock.callLater
+    session.factory = TriggerClientFactory(defer.Deferred(), creds=('a', 'b'))
+    session.done = False
+    def write(data):
+        session.dataReceived(data + 'output\nrouter1#')
+    def loseConnection():
+        session.done = True
+    session.written = []
+    session.write = lambda data: (session.written.append(data), write(data))
+    session.loseConnection = loseConnection
+    session.connectionMade()
+    session.dataReceived('router1#')
+    return session
+
+class CommandIntervalTest(unittest.TestCase):
+    def testConcurrentPacing(self):
+        """Test that paced sessions wait alongside each other."""
+        clock = task.Clock()
+        commands = ['show version', 'show clock', 'show users']
+        sessions = [paced_session(clock, commands, 1) for i in range(10)]
+
+        # Each session waits once after the login prompt, once after setting
+        # the terminal length and once after each command.
+        for elapsed in range(len(commands) + 2):
+            self.assertFalse([s for s in sessions if s.done])
+            clock.advance(1)
+        self.assertEqual([s for s in sessions if not s.done], [])
+        for s in sessions:
+            self.assertEqual(s.results, ['output\n'] * len(commands))
+
+    def testCancelOnDisconnect(self):
+        clock = task.Clock()
+        session = paced_session(clock, ['show version'], 5)
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+        session.connectionLost(None)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+class FakeConnector(object):
+    def __init__(self, factory):
+        self.factory = factory
+        self.disconnected = False
+
+    def disconnect(self):
+        self.disconnected = True
+
+class FakeReactor(object):
+    def __init__(self):
+        self.connectors = []
+
+    def connectTCP(self, host, port, factory):
+        self.connectors.append(FakeConnector(factory))
+        return self.connectors[-1]
+
+class CancelTest(unittest.TestCase):
+    def setUp(self):
+        self.reactor = twister.reactor
+        twister.reactor = FakeReactor()
+
+    def tearDown(self):
+        twister.reactor = self.reactor
+
+    def testCancel(self):
+        """Test that cancelling an execute_*() Deferred hangs up."""
+        juniper = FakeDevice('router2')
+        juniper.manufacturer = 'JUNIPER'
+        for execute, dev in ((twister.execute_ioslike, FakeDevice()),
+                             (twister.execute_junoscript, juniper)):
+            failures = []
+            d = execute(dev, ['show version'], creds=('a', 'b'))
+            d.addErrback(failures.append)
+            d.cancel()
+            connector = twister.reactor.connectors[-1]
+            self.assertTrue(connector.disconnected)
+            self.assertTrue(failures[0].check(defer.CancelledError))
+
+            # The connection closing afterwards is ignored.
+            connector.factory.clientConnectionLost(None,
+                                                   Failure(ConnectionLost()))
+            self.assertEqual(len(failures), 1)
+
+class FakePool(SessionPool):
+    """SessionPool that logs in to fake devices that echo commands."""
+    # Seconds a hangup takes to be noticed, if not right away.
+    hangup_delay = None
+
+    def __init__(self, *args, **kwargs):
+        SessionPool.__init__(self, *args, **kwargs)
+        self.logins = []
+        self.connections = {}
+        self.sent = []
+
+    def _connect(self, device, port, factory):
+        action = factory.action
+        def write(data):
+            self.sent.append(data)
+            action.dataReceived(data + 'output\n%s#' % device.nodeName)
+        def connectionLost():
+            factory.clientConnectionLost(None, Failure(ConnectionLost()))
+        def loseConnection():
+            if self.hangup_delay is None:
+                connectionLost()
+            else:
+                self.clock.callLater(self.hangup_delay, connectionLost)
+        action.write = write
+        action.loseConnection = loseConnection
+        action.callLater = self.clock.callLater
+        self.logins.append(device.nodeName)
+        self.connections[device.nodeName] = action
+        action.connectionMade()
+        action.dataReceived('%s#' % device.nodeName)
+
+class SessionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.pool = FakePool(max_sessions=2, idle_timeout=60, creds=('a', 'b'),
+                             probe_interval=30, probe_timeout=5,
+                             clock=self.clock)
+        self.results = []
+
+    def execute(self, name, commands):
+        d = self.pool.execute(FakeDevice(name), commands)
+        d.addBoth(self.results.append)
+        return d
+
+    def testReuse(self):
+        """Test that batches to one device share a session."""
+        self.execute('r1', ['show version'])
+        self.execute('r1', ['show clock', 'show users'])
+        self.assertEqual(self.pool.logins, ['r1'])
+        self.assertEqual(self.results, [['output\n'], ['output\n'] * 2])
+        self.assertEqual(len(self.pool), 1)
+
+    def testIdleTimeout(self):
+        self.execute('r1', ['show version'])
+        self.clock.advance(59)
+        self.assertEqual(len(self.pool), 1)
+        self.clock.advance(1)
+        self.assertEqual(len(self.pool), 0)
+        self.execute('r1', ['show version'])
+        self.assertEqual(self.pool.logins, ['r1', 'r1'])
+
+    def testMaxSessions(self):
+        """Test that the least recently used idle session is closed."""
+        self.execute('r1', ['show version'])
+        self.clock.advance(1)
+        self.execute('r2', ['show version'])
+        self.execute('r3', ['show version'])
+        self.assertEqual(sorted(self.pool.sessions), ['r2', 'r3'])
+        self.assertEqual(len(self.results), 3)
+
+    def testDeadSession(self):
+        """Test that a dropped session is replaced."""
+        self.execute('r1', ['show version'])
+        self.pool.connections['r1'].loseConnection()
+        self.assertEqual(len(self.pool), 0)
+        self.execute('r1', ['show version'])
+        self.assertEqual(self.pool.logins, ['r1', 'r1'])
+        self.assertEqual(self.results, [['output\n'], ['output\n']])
+
+    def testClosingCounted(self):
+        """Test that closing sessions count until they hang up."""
+        self.pool.hangup_delay = 1
+        self.execute('r1', ['show version'])
+        self.pool.sessions['r1'].close()
+        self.execute('r1', ['show version'])
+        self.assertEqual(self.pool.logins, ['r1', 'r1'])
+        self.assertEqual(len(self.pool), 2)
+
+        self.execute('r2', ['show version'])
+        self.assertEqual(self.pool.logins, ['r1', 'r1'])
+        self.assertEqual(len(self.results), 2)
+
+        self.clock.advance(1)
+        self.assertEqual(self.pool.logins, ['r1', 'r1', 'r2'])
+        self.assertEqual(len(self.pool), 1)
+        self.assertEqual(len(self.results), 3)
+
+    def testProbe(self):
+        """Test that sessions unused for a while are checked first."""
+        self.execute('r1', ['show version'])
+        self.clock.advance(29)
+        self.execute('r1', ['show clock'])
+        self.assertEqual(self.pool.sent[-2:], ['show version\n',
+                                               'show clock\n'])
+        self.clock.advance(30)
+        self.execute('r1', ['show users'])
+        self.assertEqual(self.pool.sent[-2:], ['\n', 'show users\n'])
+        self.assertEqual(self.pool.logins, ['r1'])
+
+    def testDeadProbe(self):
+        """Test that a session that doesn't answer the probe is replaced."""
+        self.execute('r1', ['show version'])
+        self.clock.advance(30)
+        self.pool.connections['r1'].write = self.pool.sent.append
+        self.execute('r1', ['show clock'])
+        self.assertEqual(self.pool.sent[-1], '\n')
+        self.assertEqual(len(self.results), 1)
+
+        self.clock.advance(5)
+        self.assertEqual(self.pool.logins, ['r1', 'r1'])
+        self.assertEqual(self.results, [['output\n'], ['output\n']])
+
+class FakeNetscaler(FakeDevice):
+    manufacturer = 'CITRIX'
+
+    def is_netscaler(self):
+        return True
+
+class FakeNetscalerConnection(object):
+    """
+    Enough of an SSH connection for a pooled channel to a fake NetScaler,
+    which only says Done after a command.
+    """
+    def __init__(self, pool, factory):
+        self.pool = pool
+        self.factory = factory
+        self.transport = self
+
+    def sendRequest(self, channel, request, data):
+        pass
+
+    def sendData(self, channel, data):
+        self.pool.sent.append(data)
+        if data.strip():
+            channel.dataReceived('output\n Done\n')
+        else:
+            channel.dataReceived('\n> ')
+
+    def loseConnection(self):
+        self.factory.clientConnectionLost(None, Failure(ConnectionLost()))
+
+class FakeNetscalerPool(FakePool):
+    """SessionPool that logs in to fake NetScalers over SSH."""
+    def _connect(self, device, port, factory):
+        channel = factory.channel(conn=FakeNetscalerConnection(self, factory))
+        channel.factory = factory
+        channel.remoteWindowLeft = channel.remoteMaxPacket = 2 ** 20
+        channel.callLater = self.clock.callLater
+        self.logins.append(device.nodeName)
+        channel.channelOpen('')
+        channel.dataReceived(' Done\n')
+
+class NetscalerPoolTest(unittest.TestCase):
+    def testProbe(self):
+        """Test that a probed NetScaler session stays in the pool."""
+        clock = task.Clock()
+        pool = FakeNetscalerPool(idle_timeout=60, creds=('a', 'b'),
+                                 probe_interval=30, probe_timeout=5,
+                                 clock=clock)
+        results = []
+        pool.execute(FakeNetscaler('ns1'),
+                     ['show version']).addBoth(results.append)
+        clock.advance(30)
+        pool.execute(FakeNetscaler('ns1'),
+                     ['show ns ip']).addBoth(results.append)
+        clock.advance(5)
+        self.assertEqual(pool.sent, ['show version\n', 'show ns version\n',
+                                     'show ns ip\n'])
+        self.assertEqual(pool.logins, ['ns1'])
+        self.assertEqual(len(pool), 1)
+        self.assertEqual(results, [['output\n'], ['output\n']])
+
+class FakeFirewall(FakeDevice):
+    manufacturer = 'NETSCREEN TECHNOLOGIES'
+
+    def is_firewall(self):
+        return True
+
+class FakeSSHConnection(object):
+    """Enough of an SSH connection for channels to a fake NetScreen."""
+    def __init__(self):
+        self.channels = []
+
+    def openChannel(self, channel):
+        self.channels.append(channel)
+        channel.remoteWindowLeft = channel.remoteMaxPacket = 2 ** 20
+        channel.channelOpen('')
+        channel.dataReceived('fw1-> ')
+
+    def sendRequest(self, channel, request, data):
+        pass
+
+    def sendData(self, channel, data):
+        channel.dataReceived(data + 'output for %s' % data + 'fw1-> ')
+
+    def sendClose(self, channel):
+        if not channel.localClosed:
+            channel.localClosed = True
+            channel.closed()
+
+class HangupSSHConnection(FakeSSHConnection):
+    """A fake NetScreen that closes the channel instead of answering."""
+    def sendData(self, channel, data):
+        self.sendClose(channel)
+
+class FakeMultiplexer(SSHMultiplexer):
+    connection = FakeSSHConnection
+
+    def _connect(self):
+        self.factory = TriggerSSHMultiplexFactory(defer.Deferred(), self,
+                                                  self.creds)
+        self.connects = getattr(self, 'connects', 0) + 1
+        self.connected(self.connection())
+
+class SSHMultiplexerTest(unittest.TestCase):
+    def testChannels(self):
+        """Test running two batches over one connection."""
+        mux = FakeMultiplexer(FakeFirewall('fw1'), creds=('a', 'b'))
+        results = []
+        mux.execute(['get system'], timeout=None).addBoth(results.append)
+        mux.execute(['get route', 'get arp'],
+                    timeout=None).addBoth(results.append)
+        self.assertEqual(mux.connects, 1)
+        self.assertEqual(len(mux.conn.channels), 2)
+        self.assertEqual(results, [['output for get system\n'],
+                                   ['output for get route\n',
+                                    'output for get arp\n']])
+        self.assertEqual(mux.open_channels, 0)
+
+    def testClosedEarly(self):
+        """Test that a channel closed part way through fails."""
+        mux = FakeMultiplexer(FakeFirewall('fw1'), creds=('a', 'b'))
+        mux.connection = HangupSSHConnection
+        results = []
+        mux.execute(['get system'], timeout=None).addErrback(results.append)
+        self.assert_(results[0].check(ConnectionLost))
+
+JUNOS_NS = 'http://xml.juniper.net/xnm/1.1/xnm'
+
+class FakeJunoscriptConnection(object):
+    """Records RPCs sent to a channel and lets the test answer them."""
+    def __init__(self):
+        self.sent = ''
+        self.transport = self
+        self.closed = False
+
+    def sendRequest(self, channel, request, data):
+        pass
+
+    def sendData(self, channel, data):
+        self.sent += data
+
+    def loseConnection(self):
+        self.closed = True
+
+    def rpcs(self):
+        return self.sent.count('<rpc>')
+
+def junoscript_channel(commands, pipeline, with_errors=False, handlers=None):
+    conn = FakeJunoscriptConnection()
+    factory = TriggerSSHChannelFactory(defer.Deferred(), commands, ('a', 'b'),
+                                       with_errors=with_errors,
+                                       channel=TriggerSSHJunoscriptChannel,
+                                       pipeline=pipeline, handlers=handlers)
+    channel = TriggerSSHJunoscriptChannel(conn=conn)
+    channel.remoteWindowLeft = channel.remoteMaxPacket = 2 ** 20
+    channel.factory = factory
+    channel.channelOpen('')
+    channel.dataReceived('<junoscript xmlns="%s">' % JUNOS_NS)
+    return channel, conn
+
+def reply(channel, body=''):
+    channel.dataReceived('<rpc-reply>%s</rpc-reply>' % body)
+
+class JunoscriptPipelineTest(unittest.TestCase):
+    def commands(self, count):
+        return [Element('get-%d' % i) for i in range(count)]
+
+    def testUnpipelined(self):
+        channel, conn = junoscript_channel(self.commands(3), 1)
+        self.assertEqual(conn.rpcs(), 1)
+        reply(channel)
+        self.assertEqual(conn.rpcs(), 2)
+
+    def testPipelined(self):
+        """Test that replies are matched up in order, Nones included."""
+        commands = self.commands(5)
+        commands.insert(2, None)
+        channel, conn = junoscript_channel(commands, 3)
+        self.assertEqual(conn.rpcs(), 3)
+        for i in range(5):
+            reply(channel, '<n>%d</n>' % i)
+        self.assertEqual(conn.rpcs(), 5)
+        self.assert_(conn.closed)
+        results = [r is not None and r[0].text for r in channel.results]
+        self.assertEqual(results, ['0', '1', False, '2', '3', '4'])
+
+    def testAbort(self):
+        """Test that an error stops the pipeline without with_errors."""
+        channel, conn = junoscript_channel(self.commands(6), 3)
+        # The error and the replies pipelined behind it arrive together.
+        channel.dataReceived('<rpc-reply><xnm:error xmlns:xnm="%s">'
+                             '<message>bad</message></xnm:error></rpc-reply>'
+                             '<rpc-reply/><rpc-reply/>' % JUNOS_NS)
+        reply(channel)
+        self.assert_(conn.closed)
+        self.assertEqual(conn.rpcs(), 3)
+        self.assertEqual(len(channel.results), 1)
+        self.assert_(channel.factory.err is not None)
+
+class ResultStreamTest(unittest.TestCase):
+    def testBackpressure(self):
+        """Test that no command is sent until the consumer is ready."""
+        clock = task.Clock()
+        received = []
+        waiting = []
+        def on_result(index, result):
+            received.append((index, result))
+            waiting.append(defer.Deferred())
+            return waiting[-1]
+
+        session = paced_session(clock, ['show version', 'show clock'], 0,
+                                on_result)
+        self.assertEqual(received, [(0, 'output\n')])
+        self.assertEqual(session.written[-1], 'show version\n')
+        waiting[0].callback(None)
+        self.assertEqual(session.written[-1], 'show clock\n')
+        self.assertFalse(session.done)
+        waiting[1].callback(None)
+        self.assert_(session.done)
+        self.assertEqual(len(session.results), 2)
+        self.assertEqual(list(session.results), [])
+
+    def testConsumerFailure(self):
+        def on_result(index, result):
+            return defer.fail(IOError('disk full'))
+        session = paced_session(task.Clock(), ['show version', 'show clock'],
+                                0, on_result)
+        self.assert_(session.done)
+        self.assert_(session.factory.err.check(IOError))
+
+class ReplyHandlerTest(unittest.TestCase):
+    def testHandlers(self):
+        """Test that handled elements are passed on and dropped."""
+        seen = []
+        handlers = {'configuration/interfaces/interface':
+                    lambda elem: seen.append(elem[0].text)}
+        channel, conn = junoscript_channel([Element('get-configuration')], 1,
+                                           handlers=handlers)
+        builder = channel.xmltb._target
+        channel.dataReceived('<rpc-reply><configuration><interfaces>')
+        channel.dataReceived('<interface><name>ge-0/0/0</name></interface>')
+        self.assertEqual(seen, ['ge-0/0/0'])
+        interfaces = builder.stack[-1]
+        self.assertEqual(len(interfaces), 0)
+        channel.dataReceived('<interface><name>lo0</name></interface>'
+                             '</interfaces><version>1</version>')
+        channel.dataReceived('</configuration></rpc-reply>')
+        self.assertEqual(seen, ['ge-0/0/0', 'lo0'])
+
+        config = channel.results[0][0]
+        self.assertEqual(len(config.find('{%s}interfaces' % JUNOS_NS)), 0)
+        self.assertEqual(config.find('{%s}version' % JUNOS_NS).text, '1')
+        # The session's root element doesn't keep finished replies.
+        self.assertEqual(len(builder.stack[0]), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
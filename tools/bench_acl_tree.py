@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+# bench_acl_tree.py - Builds trigger.acl.engine.ACLDecisionTree and runs
+# trigger.acl.analysis.analyze() on synthetic filters of increasing size to
+# show how they scale, and checks the tree against InterpretedACL. Both should
+# take roughly twice as long when the number of terms doubles.
+
+import random
+import sys
+import time
+
+from trigger.acl import ACL, IP, Term
+from trigger.acl.analysis import analyze
+from trigger.acl.engine import ACLDecisionTree, InterpretedACL, make_flow
+
+
+def make_acl(num_terms, rng):
+    """
+    Build a JunOS-style filter of num_terms terms and a final discard. Half
+    of the terms have no destination and a quarter no source, which is what
+    makes a naive decision tree blow up.
+    """
+    acl = ACL(name='bench', format='junos')
+    for i in xrange(num_terms):
+        t = Term(name='T%d' % i, action=rng.choice(['accept', 'discard']))
+        if rng.randint(0, 3):
+            t.match['source-address'] = ['10.%d.%d.0/24' %
+                                         (rng.randint(0, 255), rng.randint(0, 255))]
+        if rng.randint(0, 1):
+            t.match['destination-address'] = ['192.168.%d.%d/32' %
+                                              (rng.randint(0, 255), rng.randint(1, 254))]
+        t.match['protocol'] = [rng.choice(['tcp', 'udp'])]
+        t.match['destination-port'] = [rng.choice([rng.randint(1, 1023),
+                                                   (1024, 65535)])]
+        acl.terms.append(t)
+    acl.terms.append(Term(name='default', action='discard'))
+    return acl
+
+def make_flows(acl, num_flows, rng):
+    """Flows aimed at the addresses and ports used in acl."""
+    flows = []
+    for i in xrange(num_flows):
+        t = rng.choice(acl.terms[:-1])
+        src = t.match.get('source-address', [IP('10.1.1.0/24')])[0]
+        dst = t.match.get('destination-address', [IP('192.168.1.1')])[0]
+        flows.append(make_flow(src.int() + rng.randint(0, 255), dst.int(),
+                               rng.choice(['tcp', 'udp']),
+                               rng.choice([22, 25, 53, 80, 443, 8080])))
+    return flows
+
+
+if len(sys.argv) < 2:
+    sys.exit("usage: %s <num_terms> [<num_terms> ...]" % sys.argv[0])
+
+rng = random.Random(42)
+print '%8s %10s %12s %10s' % ('terms', 'build (s)', 'lookups/s', 'analyze (s)')
+for num_terms in map(int, sys.argv[1:]):
+    acl = make_acl(num_terms, rng)
+    flows = make_flows(acl, 2000, rng)
+
+    start = time.time()
+    tree = ACLDecisionTree(acl)
+    tree.shadowed
+    build = time.time() - start
+
+    start = time.time()
+    got = tree.match(flows)
+    rate = len(flows) / max(time.time() - start, 1e-9)
+    if got != InterpretedACL(acl).match(flows[:200]) + got[200:]:
+        sys.exit('Tree results differ from InterpretedACL!')
+
+    start = time.time()
+    analyze(acl)
+    analysis = time.time() - start
+    print '%8d %10.2f %12.0f %10.2f' % (num_terms, build, rate, analysis)
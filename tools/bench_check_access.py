@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+# bench_check_access.py - Compares trigger.acl.tools.check_access() against
+# trigger.acl.engine.CompiledACL on a synthetic filter and reports
+# performance stuff
+
+import random
+import sys
+import time
+
+from trigger.acl import ACL, IP, Protocol, Term
+from trigger.acl.engine import CompiledACL, make_flow
+from trigger.acl.tools import check_access, create_trigger_term
+
+
+def make_acl(num_terms, rng):
+    """Build a JunOS-style filter with num_terms accept terms and a final deny."""
+    acl = ACL(name='bench', format='junos')
+    for i in xrange(num_terms):
+        t = Term(name='T%d' % i)
+        t.match['source-address'] = ['10.%d.%d.0/24' % (rng.randint(0, 255), rng.randint(0, 255))]
+        t.match['destination-address'] = ['192.168.%d.%d/32' % (rng.randint(0, 255), rng.randint(1, 254))]
+        t.match['protocol'] = [rng.choice(['tcp', 'udp'])]
+        t.match['destination-port'] = [rng.choice([22, 25, 53, 80, 443, (1024, 65535)])]
+        acl.terms.append(t)
+    acl.terms.append(Term(name='default', action='discard'))
+    return acl
+
+def make_flows(acl, num_flows, rng):
+    """Half of the flows are aimed at a random term, the rest are noise."""
+    flows = []
+    for i in xrange(num_flows):
+        t = rng.choice(acl.terms[:-1])
+        if i % 2:
+            src = IP(t.match['source-address'][0].int() + rng.randint(0, 255))
+            dst = t.match['destination-address'][0]
+        else:
+            src = IP('10.%d.%d.%d' % (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)))
+            dst = IP('192.168.%d.%d' % (rng.randint(0, 255), rng.randint(1, 254)))
+        flows.append(make_flow(src, dst, rng.choice(['tcp', 'udp']),
+                               rng.choice([22, 25, 53, 80, 443, 8080])))
+    return flows
+
+
+if len(sys.argv) < 3:
+    sys.exit("usage: %s <num_terms> <num_flows>" % sys.argv[0])
+
+num_terms, num_flows = int(sys.argv[1]), int(sys.argv[2])
+rng = random.Random(42)
+acl = make_acl(num_terms, rng)
+flows = make_flows(acl, num_flows, rng)
+
+print # check_access()
+print 'Checking %d flows against %d terms using check_access()' % (num_flows, num_terms)
+start = time.time()
+expected = []
+for flow in flows:
+    t = create_trigger_term(source_ips=[IP(flow.source)],
+                            dest_ips=[IP(flow.destination)],
+                            protocols=[Protocol(flow.protocol)],
+                            dest_ports=[flow.destination_port])
+    expected.append(check_access(acl.terms, t))
+slow = time.time() - start
+print 'Done:', slow, 'seconds.'
+
+print # CompiledACL
+print 'Compiling ACL.'
+start = time.time()
+compiled = CompiledACL(acl)
+print 'Done:', time.time() - start, 'seconds.'
+
+print 'Checking %d flows using CompiledACL' % num_flows
+start = time.time()
+got = compiled.permitted(flows)
+fast = time.time() - start
+print 'Done:', fast, 'seconds.'
+
+print
+print 'Results match:', got == expected
+print 'Speedup: %.1fx' % (slow / max(fast, 1e-9))
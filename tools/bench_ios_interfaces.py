@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+# bench_ios_interfaces.py - Compares parse_ios_interfaces() against
+# fast_parse_ios_interfaces() on a synthetic config with lots of interfaces
+# and reports performance stuff
+
+import random
+import sys
+import time
+
+from trigger.cmds import fast_parse_ios_interfaces, parse_ios_interfaces
+
+
+def make_config(num_interfaces, rng):
+    """
+    Build the output of NetACLInfo's "show configuration | include" command
+    for num_interfaces interfaces, with a mix of Cisco and Foundry style
+    names and addresses, descriptions, secondaries and ACLs.
+    """
+    lines = ['!', 'Startup-config data location is flash memory', '!']
+    for i in xrange(num_interfaces):
+        if rng.randint(0, 1):
+            lines.append('interface GigabitEthernet%d/%d' % (i / 48, i % 48))
+        else:
+            lines.append('interface ethernet %d/%d' % (i / 48, i % 48))
+        if rng.randint(0, 3):
+            lines.append(' description %s : AE%d : %s-sw0 :  : 1x1000 :  :' %
+                         ('gear%d' % i, i % 8, 'core%d' % (i % 16)))
+        if rng.randint(0, 4) == 0:
+            lines.append(' ip access-group %d in' % rng.randint(100, 199))
+        for j in xrange(rng.choice([0, 1, 1, 1, 2])):
+            addr = '10.%d.%d.%d' % (i / 256, i % 256, j * 64 + 1)
+            if rng.randint(0, 1):
+                lines.append(' ip address %s/26%s' % (addr, j and ' secondary' or ''))
+            else:
+                lines.append(' ip address %s 255.255.255.192%s' %
+                             (addr, j and ' secondary' or ''))
+        if rng.randint(0, 4) == 0:
+            lines.append(' ip access-group ACL-%d out' % rng.randint(0, 9))
+        lines.append('!')
+    return '\n'.join(lines) + '\n'
+
+
+if len(sys.argv) < 2:
+    sys.exit("usage: %s <num_interfaces> [--no-pyparsing]" % sys.argv[0])
+
+num_interfaces = int(sys.argv[1])
+data = make_config(num_interfaces, random.Random(42))
+print 'Parsing %d interfaces (%d bytes).' % (num_interfaces, len(data))
+
+print # Line-oriented
+start = time.time()
+fast_results = fast_parse_ios_interfaces(data)
+fast = time.time() - start
+print 'fast_parse_ios_interfaces(): %d interfaces in %s seconds.' % \
+    (len(fast_results), fast)
+
+if '--no-pyparsing' not in sys.argv:
+    print # pyparsing, with the grammar built beforehand
+    parse_ios_interfaces('')
+    start = time.time()
+    slow_results = parse_ios_interfaces(data)
+    slow = time.time() - start
+    print 'parse_ios_interfaces(): %d interfaces in %s seconds.' % \
+        (len(slow_results), slow)
+
+    print
+    print 'Results match:', fast_results == slow_results
+    print 'Speedup: %.1fx' % (slow / max(fast, 1e-9))
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+# bench_job_order.py - Simulates a fleet-wide Commando run through the
+# Scheduler with made-up job durations and compares the makespan of running
+# devices in the order given against longest_first()
+
+import random
+import sys
+
+from twisted.internet import task
+
+from trigger.cmds import Scheduler, longest_first
+
+
+class Device(object):
+    def __init__(self, nodeName, site, manufacturer='JUNIPER'):
+        self.nodeName = nodeName
+        self.site = site
+        self.manufacturer = manufacturer
+
+def make_fleet(num_devices, rng):
+    """
+    Return a list of devices and a dict of how long each takes. Most jobs
+    are quick, with a long tail of big configs and slow links.
+    """
+    devices = []
+    durations = {}
+    for i in xrange(num_devices):
+        dev = Device('dev%d' % i, 'SITE%d' % rng.randint(0, num_devices / 20))
+        devices.append(dev)
+        durations[dev.nodeName] = rng.lognormvariate(2, 1.5)
+    return devices, durations
+
+def makespan(devices, durations, max_conns, limits, priority=None):
+    """Return how long the simulated run takes."""
+    clock = task.Clock()
+    sched = Scheduler(max_conns=max_conns, rate=None, limits=limits,
+                      clock=clock, priority=priority)
+
+    def start(dev, job):
+        clock.callLater(durations[dev.nodeName], finish, dev)
+
+    def finish(dev):
+        sched.done(dev)
+        sched.pump(start)
+
+    for dev in devices:
+        sched.add(dev, None)
+    sched.pump(start)
+    while clock.getDelayedCalls():
+        clock.advance(min([c.getTime() for c in clock.getDelayedCalls()]) -
+                      clock.seconds())
+    return clock.seconds()
+
+
+if len(sys.argv) < 2:
+    sys.exit("usage: %s <num_devices> [max_conns]" % sys.argv[0])
+
+num_devices = int(sys.argv[1])
+max_conns = len(sys.argv) > 2 and int(sys.argv[2]) or 30
+devices, durations = make_fleet(num_devices, random.Random(42))
+rng = random.Random(7)
+# Last run's durations, which won't be quite the same this time.
+history = dict([(name, d * rng.uniform(0.7, 1.3))
+                for name, d in durations.iteritems()])
+
+print 'Simulating %d devices, %d at a time, %.0f seconds of work.' % (
+    num_devices, max_conns, sum(durations.values()))
+print 'Lower bound: %.0f seconds.' % max(max(durations.values()),
+                                         sum(durations.values()) / max_conns)
+
+for limits in ({}, {'site': 2}):
+    print
+    print 'Limits:', limits
+    given = makespan(devices, durations, max_conns, limits)
+    longest = makespan(devices, durations, max_conns, limits,
+                       longest_first(history))
+    print 'Order given: %.0f seconds.' % given
+    print 'longest_first(): %.0f seconds.' % longest
+    print 'Speedup: %.2fx' % (given / longest)
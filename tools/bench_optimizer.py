@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+# bench_optimizer.py - Compares the old pairwise term merging from bin/optimizer
+# against trigger.acl.optimizer on a synthetic filter and reports
+# performance stuff
+
+import random
+import sys
+import time
+from copy import deepcopy
+
+from trigger.acl import ACL, Comment, Term
+from trigger.acl.optimizer import chunk_terms, optimize_acl
+
+
+def make_acl(num_terms, rng):
+    """
+    Build a JunOS-style filter of num_terms accept terms drawn from a small
+    pool of sources, destinations and ports so that plenty of them merge,
+    with the occasional discard term to split the filter into chunks.
+    """
+    sources = ['10.%d.%d.0/24' % (rng.randint(0, 255), rng.randint(0, 255))
+               for i in xrange(max(num_terms / 20, 2))]
+    dests = ['192.168.%d.%d/32' % (rng.randint(0, 255), rng.randint(1, 254))
+             for i in xrange(max(num_terms / 50, 2))]
+    acl = ACL(name='bench', format='junos')
+    for i in xrange(num_terms):
+        t = Term(name='T%d' % i)
+        t.match['source-address'] = [rng.choice(sources)]
+        t.match['destination-address'] = [rng.choice(dests)]
+        t.match['protocol'] = [rng.choice(['tcp', 'udp'])]
+        t.match['destination-port'] = [rng.choice([22, 25, 53, 80, 443])]
+        if not rng.randint(0, 200):
+            t.action = 'discard'
+        acl.terms.append(t)
+    return acl
+
+def pairwise_merge(terms, which):
+    """The original O(n^2) optimize_terms() from bin/optimizer."""
+    to_delete = {}
+    if which == 'source-address':
+        other = ['destination-address']
+    elif which == 'destination-address':
+        other = ['source-address']
+    else:
+        other = ['source-address', 'destination-address']
+    chk_keys = ['protocol', 'source-address', 'destination-address',
+                'destination-port']
+    rej_keys = ['reject', 'deny', 'discard']
+
+    for term1 in terms:
+        if 'destination-port' not in term1.match or \
+           'source-port' in term1.match or term1.action[0] in rej_keys:
+            continue
+        for term2 in terms:
+            if term1.name in to_delete or term2.name in to_delete or \
+               term1.name == term2.name or term2.action[0] in rej_keys or \
+               'source-port' in term2.match:
+                continue
+            if [k for k in chk_keys if k not in term1.match or k not in term2.match]:
+                continue
+            p1, p2 = term1.match['protocol'], term2.match['protocol']
+            if len(p1) != len(p2):
+                continue
+            if 'icmp' in p1 or 'icmp' in p2:
+                break
+            if [p for p in p1 if p not in p2]:
+                continue
+            if which != 'destination-port':
+                d1, d2 = term1.match['destination-port'], term2.match['destination-port']
+                if len(d1) != len(d2) or [1 for a in d1 for b in d2 if a != b]:
+                    continue
+            breaker = False
+            for ent in other:
+                e1, e2 = term1.match[ent], term2.match[ent]
+                if len(e1) != len(e2) or [x for x in e1 if x not in e2] or \
+                   [x for x in e2 if x not in e1]:
+                    breaker = True
+                    break
+            if breaker:
+                continue
+
+            for comment in term1.comments:
+                term2.comments.append(comment)
+            ips = []
+            for to_add in term1.match[which]:
+                term2.match[which].append(to_add)
+                ips.append(str(to_add))
+            term2.comments.append(Comment('merged [(%s) %s] from %s' %
+                                          (which, ','.join(ips), term1.name)))
+            to_delete[term1.name] = 1
+
+    return [t for t in terms if t.name not in to_delete]
+
+def pairwise_passes(terms, keys):
+    """Run the pairwise merge until it stops finding anything."""
+    while True:
+        chunks = chunk_terms(terms)
+        for key in keys:
+            for idx, chunk in enumerate(chunks):
+                chunks[idx] = pairwise_merge(chunk, key)
+        new_terms = [t for chunk in chunks for t in chunk]
+        if len(new_terms) == len(terms):
+            return new_terms
+        terms = new_terms
+
+def pairwise_optimize(acl):
+    terms = pairwise_passes(acl.terms, ['source-address', 'destination-address'])
+    return pairwise_passes(terms, ['destination-port'])
+
+
+if len(sys.argv) < 2:
+    sys.exit("usage: %s <num_terms> [--no-pairwise]" % sys.argv[0])
+
+num_terms = int(sys.argv[1])
+acl = make_acl(num_terms, random.Random(42))
+print 'Optimizing a filter with %d terms.' % num_terms
+
+print # trigger.acl.optimizer
+new_acl = deepcopy(acl)
+start = time.time()
+fast_terms = optimize_acl(new_acl).terms
+fast = time.time() - start
+print 'optimize_acl(): %d terms in %s seconds.' % (len(fast_terms), fast)
+
+if '--no-pairwise' not in sys.argv:
+    print # Old optimizer
+    old_acl = deepcopy(acl)
+    start = time.time()
+    slow_terms = pairwise_optimize(old_acl)
+    slow = time.time() - start
+    print 'Pairwise: %d terms in %s seconds.' % (len(slow_terms), slow)
+
+    print
+    render = lambda terms: [t.output_junos() for t in terms]
+    print 'Results match:', render(fast_terms) == render(slow_terms)
+    print 'Speedup: %.1fx' % (slow / max(fast, 1e-9))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+# bench_prompt.py - Feeds a large synthetic 'show running-config' to the
+# old accumulate-and-rescan prompt matching and to trigger.twister.PromptBuffer
+# in small chunks and reports performance stuff
+
+import re
+import sys
+import time
+
+from trigger.twister import PromptBuffer
+
+# Same prompt as IoslikeSendExpect
+PROMPT = re.compile('[a-zA-Z0-9-_]+(@[a-zA-Z0-9-_]+)?(\(config(-[a-z]+)?\))?#', re.M)
+
+
+def make_output(size):
+    """Roughly size bytes of config followed by a prompt."""
+    lines = []
+    total = 0
+    i = 0
+    while total < size:
+        line = ' ip address 10.%d.%d.1 255.255.255.0\n' % (i / 256 % 256, i % 256)
+        lines.append(line)
+        total += len(line)
+        i += 1
+    return 'show running-config\n' + ''.join(lines) + 'router1#'
+
+def rescan(data, chunk_size):
+    """The old way: append to a string and search all of it every time."""
+    buf = ''
+    for i in xrange(0, len(data), chunk_size):
+        buf += data[i:i+chunk_size]
+        m = PROMPT.search(buf)
+        if m:
+            return m.start()
+
+def prompt_buffer(data, chunk_size):
+    buf = PromptBuffer(PROMPT)
+    for i in xrange(0, len(data), chunk_size):
+        end = buf.feed(data[i:i+chunk_size])
+        if end is not None:
+            return end
+
+
+args = [a for a in sys.argv[1:] if not a.startswith('--')]
+if not args:
+    sys.exit("usage: %s <megabytes> [chunk_size] [--no-rescan]" % sys.argv[0])
+
+size = int(float(args[0]) * 1024 * 1024)
+chunk_size = len(args) > 1 and int(args[1]) or 512
+data = make_output(size)
+print 'Feeding %d bytes in %d byte chunks' % (len(data), chunk_size)
+
+funcs = [prompt_buffer]
+if '--no-rescan' not in sys.argv:
+    funcs.append(rescan)
+
+results = []
+for func in funcs:
+    start = time.time()
+    results.append(func(data, chunk_size))
+    print '%s: %s seconds' % (func.__name__, time.time() - start)
+
+print 'Results match:', results == [data.rfind('router1#')] * len(results)
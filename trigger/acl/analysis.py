@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+
+"""
+Static analysis of ACL objects.
+
+Finds terms that are dead weight in a filter:
+
+    shadowed
+        Terms that can never be the first match for any packet because
+        earlier terms cover everything they match.
+
+    redundant
+        Terms that do match packets, but where every such packet would get the
+        same decision from a later term if the term were removed.
+
+    mergeable
+        Groups of terms with the same action that differ in a single match
+        key, and so could be folded into one term (see ``bin/optimizer``).
+
+Shadowed and redundant terms are found by sweeping each term's part of the
+flow space in a decision tree (see :class:`~trigger.acl.engine.ACLDecisionTree`)
+that splits on the dimensions the term matches on first, so the sweep only
+visits the terms that overlap it rather than comparing every pair of terms.
+Mergeable terms are found by hashing each term's match conditions.
+
+>>> from trigger.acl import parse
+>>> acl = parse(open('acl.abc123'))
+>>> report = acl.analyze()
+>>> print report
+"""
+
+__author__ = 'Jathan McCollum'
+__maintainer__ = 'Jathan McCollum'
+__email__ = 'jathan.mccollum@teamaol.com'
+__copyright__ = 'Copyright 2012, AOL Inc.'
+
+from collections import namedtuple
+from trigger.acl.engine import (ACLDecisionTree, TREE_ORDER, term_action,
+                                normalize_term, _intersect)
+
+
+# Exports
+__all__ = ('analyze', 'term_signature', 'ACLAnalysis', 'Finding', 'MergeGroup')
+
+
+# Defaults
+# Match keys that are considered when looking for mergeable terms.
+MERGE_KEYS = ('source-address', 'destination-address', 'destination-port',
+              'source-port', 'protocol')
+
+
+# A shadowed or redundant term, and the terms responsible for it: the earlier
+# terms that shadow it, or the later terms that make it redundant.
+Finding = namedtuple('Finding', 'term related')
+
+# Terms that could be merged into one by combining their values for key.
+MergeGroup = namedtuple('MergeGroup', 'key terms')
+
+
+# Functions
+def term_signature(term, exclude=None):
+    """
+    Return a hashable signature of everything about a term that affects how
+    it is treated, except for its name, comments and the match key given by
+    exclude. Terms with equal signatures are identical apart from exclude.
+
+    :param term: A Term object
+    :param exclude: Name of a match key to leave out
+    """
+    match = []
+    for key, values in term.match.iteritems():
+        if key != exclude:
+            match.append((key, tuple(sorted([str(v) for v in values]))))
+    modifiers = [(k, str(v)) for k, v in term.modifiers.iteritems()]
+    return (term_action(term), tuple(term.action), tuple(sorted(match)),
+            tuple(sorted(modifiers)))
+
+def analyze(acl):
+    """
+    Analyze an ACL and return an ACLAnalysis report.
+
+    :param acl: An ACL object
+    """
+    return ACLAnalysis(acl)
+
+def _find_mergeable(terms):
+    """
+    Group terms that differ only in a single match key. Only terms within a
+    run of the same action are grouped, since moving a term across a term
+    with a different action changes the behavior of the filter.
+    """
+    groups = []
+    run = []
+    last_action = None
+    for term in terms:
+        if term.inactive:
+            continue
+        action = term_action(term)
+        if action != last_action:
+            groups.extend(_group_run(run))
+            run = []
+            last_action = action
+        run.append(term)
+    groups.extend(_group_run(run))
+    return groups
+
+def _group_run(terms):
+    """Hash-group a run of same-action terms for each merge key."""
+    groups = []
+    for key in MERGE_KEYS:
+        buckets = {}
+        order = []
+        for term in terms:
+            if key not in term.match:
+                continue
+            sig = term_signature(term, exclude=key)
+            if sig not in buckets:
+                buckets[sig] = []
+                order.append(sig)
+            buckets[sig].append(term)
+        for sig in order:
+            if len(buckets[sig]) > 1:
+                groups.append(MergeGroup(key, buckets[sig]))
+    return groups
+
+def _boxes_overlap(a, b):
+    """True if some flow falls within both of the boxes a and b."""
+    for dim, intervals in a.iteritems():
+        if dim in b and not _intersect(intervals, b[dim]):
+            return False
+    return True
+
+
+# Classes
+class _RunnerUpTree(ACLDecisionTree):
+    """
+    Decision tree whose leaves keep the first two terms covering each region,
+    so we know what would happen to a packet if the winning term were gone.
+    """
+    depth = 2
+
+class ACLAnalysis(object):
+    """
+    Report of shadowed, redundant and mergeable terms in an ACL.
+
+    Every shadowed term can be removed without changing the behavior of the
+    filter. Each redundant term can be removed on its own, but removing one
+    may change whether another is redundant, so re-run the analysis after
+    removing one.
+
+    :param acl: An ACL object
+
+    :attr shadowed: List of Findings, related being the earlier terms
+        that match the shadowed term's packets.
+    :attr redundant: List of Findings, related being the later terms
+        that would match the redundant term's packets.
+    :attr mergeable: List of MergeGroups.
+    :attr unsupported: List of Terms that use matches we can't analyze
+        (e.g. ``tcp-flags``). They are ignored for shadowing, and an earlier
+        term they overlap is never reported as redundant past them.
+    """
+    def __init__(self, acl):
+        self.acl = acl
+        tree = _RunnerUpTree(acl)
+        self._trees = {tree.order: tree}
+        terms = acl.terms
+        specs = tree.specs
+
+        # Terminal terms we can't model still decide the fate of the packets
+        # they match, so keep a loose outline of each to check overlap with.
+        self._opaque = [(s.index, normalize_term(s.term, loose=True))
+                        for s in specs if not s.supported and s.terminal
+                        and not s.inactive]
+
+        self.shadowed = []
+        self.redundant = []
+        for spec in specs:
+            if not spec.active:
+                continue
+            winners, later = self._check_term(spec)
+            if winners is not None:
+                self.shadowed.append(Finding(spec.term,
+                                     [terms[i] for i in sorted(winners)]))
+            elif later is not None:
+                self.redundant.append(Finding(spec.term,
+                                      [terms[i] for i in sorted(later)]))
+
+        self.mergeable = _find_mergeable(terms)
+        self.unsupported = tree.unsupported
+
+    def _tree_for(self, box):
+        """
+        Return a tree splitting on the dimensions box is constrained on
+        first. A tree whose first split is on a dimension box doesn't
+        constrain would have to visit every one of its branches.
+        """
+        order = tuple([d for d in TREE_ORDER if d in box] +
+                      [d for d in TREE_ORDER if d not in box])
+        if order not in self._trees:
+            self._trees[order] = _RunnerUpTree(self.acl, order)
+        return self._trees[order]
+
+    def _check_term(self, spec):
+        """
+        Sweep the regions a term matches and return (winners, later): the
+        earlier terms matching them if the term is shadowed, or else the
+        terms that would take over if it is redundant. Either is None if the
+        term isn't shadowed or redundant.
+        """
+        terms = self.acl.terms
+        winners = set()
+        later = set()
+        wins = False
+        for box in spec.boxes:
+            tree = self._tree_for(box)
+            for found in tree.regions(box, spec.index):
+                if found[0] != spec.index:
+                    winners.add(found[0])
+                    continue
+                wins = True
+                if len(found) < 2 or \
+                   tree.specs[found[1]].action != spec.action or \
+                   terms[found[1]].action != spec.term.action:
+                    return None, None
+                later.add(found[1])
+        if not wins:
+            return winners, None
+        if self._blocked(spec, max(later)):
+            return None, None
+        return None, later
+
+    def _blocked(self, spec, last):
+        """
+        True if a terminal term we can't model comes after spec and before
+        the term at index last and may match some of spec's packets. Removing
+        spec would hand those packets to it rather than the later terms.
+        """
+        for index, outline in self._opaque:
+            if not spec.index < index < last:
+                continue
+            for box in spec.boxes:
+                for other in outline:
+                    if _boxes_overlap(box, other):
+                        return True
+        return False
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.acl.name)
+
+    def __str__(self):
+        return '\n'.join(self.output())
+
+    def __nonzero__(self):
+        return bool(self.shadowed or self.redundant or self.mergeable)
+
+    @property
+    def removable(self):
+        """Terms that can all be removed at once: the shadowed terms."""
+        return [f.term for f in self.shadowed]
+
+    def output(self):
+        """Return the report as a list of lines."""
+        # IOS-style terms have no names, so fall back to their position.
+        position = dict([(id(t), i) for i, t in enumerate(self.acl.terms)])
+        def name(term):
+            if term.name is None:
+                return '#%d' % (position[id(term)] + 1)
+            return term.name
+        def names(terms):
+            return ', '.join([name(t) for t in terms])
+
+        ret = []
+        for finding in self.shadowed:
+            ret.append('shadowed: %s (by %s)' % (name(finding.term),
+                                                 names(finding.related)))
+        for finding in self.redundant:
+            ret.append('redundant: %s (covered by %s)' % (name(finding.term),
+                                                         names(finding.related)))
+        for group in self.mergeable:
+            ret.append('mergeable on %s: %s' % (group.key, names(group.terms)))
+        for term in self.unsupported:
+            ret.append('not analyzed: %s' % name(term))
+        return ret
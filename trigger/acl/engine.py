@@ -0,0 +1,807 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compiled access-check engines for ACL objects.
+
+:func:`trigger.acl.tools.check_access` walks the term list in Python for every
+question it is asked. That is fine for a single query, but auditing thousands
+of flows against a large filter spends nearly all of its time re-testing the
+same match clauses. The classes in this module compile an :class:`~trigger.acl.ACL`
+once and then answer questions about concrete flows (source, destination,
+protocol, destination port, source port) in bulk.
+
+Every match clause we understand is normalized into integer intervals, so that
+a term becomes a union of "boxes" (one interval list per dimension). A term
+that uses a match we can't evaluate against a flow (``tcp-flags``,
+``icmp-type``, prefix-lists, etc.) is flagged as unsupported and never
+matches, which mirrors how ``check_access()`` treats "complicated" terms.
+
+>>> from trigger.acl import parse
+>>> from trigger.acl.engine import CompiledACL, make_flow
+>>> acl = parse(open('acl.abc123'))
+>>> engine = CompiledACL(acl)
+>>> engine.permitted([make_flow('10.1.1.1', '192.0.2.5', 'tcp', 80)])
+[True]
+"""
+
+__author__ = 'Jathan McCollum'
+__maintainer__ = 'Jathan McCollum'
+__email__ = 'jathan.mccollum@teamaol.com'
+__copyright__ = 'Copyright 2012, AOL Inc.'
+
+from bisect import bisect_right
+from collections import namedtuple
+import IPy
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from trigger.acl.parser import Protocol, do_port_lookup
+
+
+# Exports
+__all__ = ('Flow', 'make_flow', 'normalize_term', 'compile_terms',
+           'compile_acl', 'CompiledACL', 'InterpretedACL', 'ACLDecisionTree',
+           'DIMENSIONS')
+
+
+# Defaults
+DIMENSIONS = ('source-address', 'destination-address', 'protocol',
+              'destination-port', 'source-port')
+DOMAINS = {
+    'source-address':      (0, 2**32 - 1),
+    'destination-address': (0, 2**32 - 1),
+    'protocol':            (0, 255),
+    'destination-port':    (0, 65535),
+    'source-port':         (0, 65535),
+}
+TERMINAL_ACTIONS = ('accept', 'discard', 'reject')
+BATCH_SIZE = 4096
+
+# Order in which ACLDecisionTree splits the flow space. Destination first,
+# since that's what most filters are organized around.
+TREE_ORDER = ('destination-address', 'protocol', 'destination-port',
+              'source-address', 'source-port')
+
+# Match keys that expand to "either source or destination".
+EITHER_KEYS = {
+    'address': ('source-address', 'destination-address'),
+    'port':    ('source-port', 'destination-port'),
+}
+
+
+# A concrete flow to test against an ACL. Any field may be None to mean
+# "unknown"; a term that matches on an unknown field will never match.
+Flow = namedtuple('Flow', 'source destination protocol destination_port source_port')
+
+
+# Exceptions
+class UnsupportedMatch(Exception): pass
+
+
+# Functions
+def _address_int(addr):
+    """Return an IPv4 address (string, int or IP object) as an integer."""
+    if isinstance(addr, (int, long)):
+        return addr
+    if not isinstance(addr, IPy.IP):
+        addr = IPy.IP(addr)
+    if addr.version() != 4 or addr.len() != 1:
+        raise ValueError('Flow addresses must be IPv4 hosts: %s' % addr)
+    return addr.int()
+
+def make_flow(source=None, destination=None, protocol=None,
+              destination_port=None, source_port=None):
+    """
+    Build a :class:`Flow` with every field normalized to an integer (or None).
+
+    :param source: Source IPv4 address
+    :param destination: Destination IPv4 address
+    :param protocol: Protocol name or number (e.g. 'tcp' or 6)
+    :param destination_port: Destination port name or number
+    :param source_port: Source port name or number
+    """
+    if source is not None:
+        source = _address_int(source)
+    if destination is not None:
+        destination = _address_int(destination)
+    if protocol is not None:
+        protocol = int(Protocol(protocol).value)
+    if destination_port is not None:
+        destination_port = int(do_port_lookup(destination_port))
+    if source_port is not None:
+        source_port = int(do_port_lookup(source_port))
+    return Flow(source, destination, protocol, destination_port, source_port)
+
+def _merge_intervals(intervals):
+    """Sort and coalesce a list of (lo, hi) tuples."""
+    merged = []
+    for lo, hi in sorted(intervals):
+        if merged and lo <= merged[-1][1] + 1:
+            if hi > merged[-1][1]:
+                merged[-1] = (merged[-1][0], hi)
+        else:
+            merged.append((lo, hi))
+    return merged
+
+def _complement(intervals, domain):
+    """Return the complement of merged intervals within domain."""
+    dmin, dmax = domain
+    ret = []
+    lo = dmin
+    for ilo, ihi in intervals:
+        if ilo > lo:
+            ret.append((lo, ilo - 1))
+        lo = max(lo, ihi + 1)
+    if lo <= dmax:
+        ret.append((lo, dmax))
+    return ret
+
+def _intersect(a, b):
+    """Intersect two merged interval lists."""
+    ret = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        lo = max(a[i][0], b[j][0])
+        hi = min(a[i][1], b[j][1])
+        if lo <= hi:
+            ret.append((lo, hi))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return ret
+
+def _value_intervals(dim, values):
+    """Convert a RangeList of match arguments into merged intervals."""
+    intervals = []
+    for v in values:
+        if dim.endswith('-address'):
+            if v.version() != 4:
+                raise UnsupportedMatch('IPv6 address %s' % v)
+            base = v.int()
+            intervals.append((base, base + v.len() - 1))
+        elif dim == 'protocol':
+            if isinstance(v, tuple):
+                intervals.append((int(Protocol(v[0]).value),
+                                  int(Protocol(v[1]).value)))
+            else:
+                p = int(Protocol(v).value)
+                intervals.append((p, p))
+        else:
+            if isinstance(v, tuple):
+                intervals.append((int(v[0]), int(v[1])))
+            else:
+                intervals.append((int(v), int(v)))
+    return _merge_intervals(intervals)
+
+def _key_alternatives(key, values):
+    """
+    Return the list of alternative boxes (dicts of dim -> intervals) that a
+    single match key contributes. Most keys contribute one box; 'address' and
+    'port' contribute one for each direction.
+    """
+    negated = key.endswith('-except')
+    base = negated and key[:-7] or key
+
+    if base in EITHER_KEYS:
+        dims = EITHER_KEYS[base]
+    elif base in DOMAINS:
+        dims = (base,)
+    else:
+        raise UnsupportedMatch(key)
+
+    intervals = _value_intervals(dims[0], values)
+    if not negated:
+        # Either direction may match.
+        return [{dim: intervals} for dim in dims]
+
+    # Negation of either-direction means neither direction may match.
+    box = {}
+    for dim in dims:
+        box[dim] = _complement(intervals, DOMAINS[dim])
+    return [box]
+
+def term_action(term):
+    """
+    Return the effective action of a term, honoring the 'trigger: make
+    discard' comment the same way check_access() does.
+    """
+    for comment in term.comments:
+        if 'trigger: make discard' in comment:
+            return 'discard'
+    return term.action[0]
+
+def normalize_term(term, loose=False):
+    """
+    Normalize a Term's match conditions into a list of boxes. A flow matches
+    the term if it falls within any of the boxes. Each box is a dict mapping a
+    dimension from DIMENSIONS to a merged list of (lo, hi) integer intervals;
+    missing dimensions match anything.
+
+    Raises UnsupportedMatch if the term uses a match we can't evaluate, unless
+    loose is set, in which case such matches are left out and the boxes
+    cover at least every flow the term could match.
+    """
+    boxes = [{}]
+    for key, values in term.match.iteritems():
+        try:
+            alternatives = _key_alternatives(key, values)
+        except UnsupportedMatch:
+            if not loose:
+                raise
+            continue
+        new_boxes = []
+        for box in boxes:
+            for alt in alternatives:
+                merged = dict(box)
+                for dim, intervals in alt.iteritems():
+                    if dim in merged:
+                        intervals = _intersect(merged[dim], intervals)
+                    merged[dim] = intervals
+                new_boxes.append(merged)
+        boxes = new_boxes
+
+    # A box with an empty dimension can never match anything.
+    return [b for b in boxes if all(b.values())]
+
+
+class TermSpec(object):
+    """
+    Normalized view of a single Term as used by the engines in this module.
+
+    :param index: Position of the term within the ACL
+    :param term: The Term object
+    """
+    def __init__(self, index, term):
+        self.index = index
+        self.term = term
+        self.action = term_action(term)
+        self.inactive = term.inactive
+        self.terminal = self.action in TERMINAL_ACTIONS
+        try:
+            self.boxes = normalize_term(term)
+            self.supported = True
+        except UnsupportedMatch, err:
+            self.boxes = []
+            self.supported = False
+            self.reason = str(err)
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.term.name)
+
+    @property
+    def active(self):
+        """True if this term can decide the fate of a flow."""
+        return self.supported and self.terminal and not self.inactive
+
+def compile_terms(terms):
+    """Return a list of TermSpec objects for the given list of terms."""
+    return [TermSpec(idx, term) for idx, term in enumerate(terms)]
+
+def flow_matches_box(flow, box):
+    """Pure-Python test of a normalized Flow against a single box."""
+    for dim, intervals in box.iteritems():
+        value = flow[DIMENSIONS.index(dim)]
+        if value is None:
+            return False
+        for lo, hi in intervals:
+            if lo <= value <= hi:
+                break
+        else:
+            return False
+    return True
+
+
+def compile_acl(acl, engine=None):
+    """
+    Compile an ACL using the named engine, one of 'numpy', 'tree' or
+    'python'. By default the NumPy engine is used if NumPy can be imported.
+    """
+    if engine is None:
+        engine = np is not None and 'numpy' or 'python'
+    try:
+        return ENGINES[engine](acl)
+    except KeyError:
+        raise ValueError('Unknown ACL engine: %r' % engine)
+
+
+# Classes
+class BaseEngine(object):
+    """
+    Base class for compiled ACLs. Subclasses must set self.acl and implement
+    match(), which returns the index of the first matching term for each flow
+    (or -1 if no term matches).
+    """
+    def check(self, flows):
+        """Return the first matching Term for each flow, or None."""
+        terms = self.acl.terms
+        return [idx >= 0 and terms[idx] or None for idx in self.match(flows)]
+
+    def permitted(self, flows):
+        """
+        Return True/False for each flow depending on whether the first
+        matching term accepts it, or None if no term matched. This is the
+        batch analog of check_access().
+        """
+        ret = []
+        for term in self.check(flows):
+            if term is None:
+                ret.append(None)
+            else:
+                ret.append(term_action(term) == 'accept')
+        return ret
+
+    @property
+    def unsupported(self):
+        """List of Terms that could not be compiled and are never matched."""
+        return [s.term for s in self.specs if not s.supported]
+
+class InterpretedACL(BaseEngine):
+    """
+    Pure-Python fallback for CompiledACL. Terms are normalized once up front,
+    but each flow is still tested against the terms in order.
+
+    :param acl: An ACL object (or anything with a ``terms`` attribute)
+    """
+    def __init__(self, acl):
+        self.acl = acl
+        self.specs = compile_terms(acl.terms)
+        self.active = [s for s in self.specs if s.active]
+
+    def match(self, flows):
+        ret = []
+        for flow in flows:
+            if not isinstance(flow, Flow):
+                flow = make_flow(*flow)
+            found = -1
+            for spec in self.active:
+                for box in spec.boxes:
+                    if flow_matches_box(flow, box):
+                        found = spec.index
+                        break
+                if found >= 0:
+                    break
+            ret.append(found)
+        return ret
+
+class CompiledACL(BaseEngine):
+    """
+    Columnar, NumPy-backed access checker for an ACL.
+
+    Each dimension is stored as parallel arrays of interval bounds and the box
+    that owns them, so a batch of flows is checked against every term at once
+    and the first matching term is picked with a single ``argmax``.
+
+    :param acl: An ACL object (or anything with a ``terms`` attribute)
+    :param batch_size: Number of flows evaluated per vectorized pass. Memory
+        use is roughly batch_size * number of intervals.
+    """
+    def __init__(self, acl, batch_size=BATCH_SIZE):
+        if np is None:
+            raise ImportError('CompiledACL requires NumPy. Please install it.')
+        self.acl = acl
+        self.batch_size = batch_size
+        self.specs = compile_terms(acl.terms)
+
+        # One column per box, in term order.
+        box_terms = []
+        columns = dict((dim, ([], [], [])) for dim in DIMENSIONS)
+        for spec in self.specs:
+            if not spec.active:
+                continue
+            for box in spec.boxes:
+                box_id = len(box_terms)
+                box_terms.append(spec.index)
+                for dim, intervals in box.iteritems():
+                    los, his, owners = columns[dim]
+                    for lo, hi in intervals:
+                        los.append(lo)
+                        his.append(hi)
+                        owners.append(box_id)
+
+        self.box_terms = np.array(box_terms, dtype=np.int64)
+        self.columns = {}
+        for dim, (los, his, owners) in columns.iteritems():
+            if not owners:
+                continue
+            owners = np.array(owners, dtype=np.int64)
+            # Start offset of each owning box's run of intervals, for reduceat
+            constrained, starts = np.unique(owners, return_index=True)
+            self.columns[dim] = (np.array(los, dtype=np.int64),
+                                 np.array(his, dtype=np.int64),
+                                 constrained, starts)
+
+    def _flow_array(self, flows):
+        """Convert flows to an (N, 5) int64 array; unknown fields become -1."""
+        rows = []
+        for flow in flows:
+            if not isinstance(flow, Flow):
+                flow = make_flow(*flow)
+            rows.append([v is None and -1 or v for v in flow])
+        return np.array(rows, dtype=np.int64).reshape(len(rows), len(DIMENSIONS))
+
+    def _match_batch(self, values):
+        """Return first matching term index for each row in values."""
+        nflows = values.shape[0]
+        nboxes = len(self.box_terms)
+        hits = np.ones((nflows, nboxes), dtype=bool)
+        for dim, (los, his, constrained, starts) in self.columns.iteritems():
+            col = values[:, DIMENSIONS.index(dim)][:, np.newaxis]
+            inside = (col >= los) & (col <= his)
+            hits[:, constrained] &= np.logical_or.reduceat(inside, starts, axis=1)
+
+        first = hits.argmax(axis=1)
+        found = hits[np.arange(nflows), first]
+        return np.where(found, self.box_terms[first], -1)
+
+    def match(self, flows):
+        """
+        Return a NumPy array holding the index (into ``acl.terms``) of the
+        first term matching each flow, or -1 if no term matches.
+
+        :param flows: An iterable of Flow objects or 5-tuples of
+            (source, destination, protocol, destination_port, source_port)
+        """
+        values = self._flow_array(flows)
+        if not len(self.box_terms) or not len(values):
+            return np.repeat(np.int64(-1), len(values))
+
+        results = []
+        for start in xrange(0, len(values), self.batch_size):
+            results.append(self._match_batch(values[start:start+self.batch_size]))
+        return np.concatenate(results)
+
+
+class TreeNode(object):
+    """
+    An interior node of an ACLDecisionTree, splitting the flow space on the
+    dimension for its level. ``children[i]`` holds the terms constrained on
+    that dimension for values from ``starts[i]`` up to (not including)
+    ``starts[i+1]``, and ``wildcard`` the terms that aren't constrained on
+    it, which apply whatever the value is. Both have to be consulted; the
+    first match is the earlier of the two. Children are either TreeNodes or
+    leaves. ``first`` is the lowest term index anywhere below the node.
+    """
+    __slots__ = ('level', 'dim', 'starts', 'children', 'wildcard', 'first')
+
+    def __init__(self, level, dim, starts, children, wildcard, first):
+        self.level = level
+        self.dim = dim
+        self.starts = starts
+        self.children = children
+        self.wildcard = wildcard
+        self.first = first
+
+class ACLDecisionTree(BaseEngine):
+    """
+    Compile an ACL into a decision tree that splits the flow space on each
+    dimension in turn (destination, protocol, destination port, source,
+    source port). Each level is an interval lookup done with a binary search,
+    so finding the first matching term costs roughly O(log n) per dimension
+    instead of O(terms). First-match semantics are preserved because every
+    leaf holds the earliest term covering its region of the flow space.
+
+    Terms that don't match on a node's dimension go into a single wildcard
+    subtree shared by all of its intervals, rather than being copied into
+    each of them, which would make building the tree quadratic. A lookup
+    follows both the matching interval and the wildcard at each level.
+
+    As a by-product, any term that is not the first match anywhere can
+    never match a packet. Those are available as ``shadowed``.
+
+    :param acl: An ACL object (or anything with a ``terms`` attribute)
+    :param order: Sequence of dimensions to split on, most selective first
+    """
+    # Number of distinct covering terms kept at each leaf. With the default
+    # of 1 a leaf is just the index of the winning term; otherwise it is a
+    # tuple of term indices in match order (see trigger.acl.analysis).
+    depth = 1
+
+    def __init__(self, acl, order=TREE_ORDER):
+        self.acl = acl
+        self.order = tuple(order)
+        self.specs = compile_terms(acl.terms)
+        self._dims = [DIMENSIONS.index(d) for d in self.order]
+        self._memo = {}
+
+        candidates = []
+        for spec in self.specs:
+            if spec.active:
+                for box in spec.boxes:
+                    candidates.append((spec.index, box))
+        self.root = self._build(0, tuple(candidates))
+        del self._memo
+        self._reachable = None
+
+    def _covers_rest(self, box, level):
+        """True if box is unconstrained on every dimension below level."""
+        for dim in self.order[level:]:
+            if dim in box:
+                return False
+        return True
+
+    def _leaf(self, level, candidates):
+        """
+        Return the leaf for candidates if the first ``depth`` terms cover
+        everything below level, otherwise None.
+        """
+        winners = []
+        for idx, box in candidates:
+            if idx in winners:
+                continue
+            if level < len(self.order) and not self._covers_rest(box, level):
+                return None
+            winners.append(idx)
+            if len(winners) == self.depth:
+                break
+        if self.depth > 1:
+            return tuple(winners)
+        if not winners:
+            return -1
+        return winners[0]
+
+    def _build(self, level, candidates):
+        """Build the (sub)tree for candidates, which are in term order."""
+        leaf = self._leaf(level, candidates)
+        if leaf is not None:
+            return leaf
+
+        key = (level, tuple([id(box) for idx, box in candidates]))
+        if key in self._memo:
+            return self._memo[key]
+
+        dim = self.order[level]
+        dmin, dmax = DOMAINS[dim]
+        constrained = []
+        wildcard = []
+        wildcard_covered = set()
+        for cand in candidates:
+            idx, box = cand
+            if box.get(dim, [(dmin, dmax)]) == [(dmin, dmax)]:
+                wildcard.append(cand)
+                if self._covers_rest(box, level + 1):
+                    wildcard_covered.add(idx)
+                    # Nothing after this can be among the first matches.
+                    if len(wildcard_covered) == self.depth:
+                        break
+            else:
+                constrained.append(cand)
+
+        if not constrained:
+            node = self._build(level + 1, tuple(wildcard))
+            self._memo[key] = node
+            return node
+
+        points = set([dmin])
+        for idx, box in constrained:
+            for lo, hi in box[dim]:
+                points.add(lo)
+                if hi < dmax:
+                    points.add(hi + 1)
+        starts = sorted(points)
+
+        # Sweep each candidate into the elementary intervals it covers,
+        # closing an interval once ``depth`` candidates cover everything
+        # below it.
+        segments = [[] for i in starts]
+        covered = [set() for i in starts]
+        depth = self.depth
+        for cand in constrained:
+            idx, box = cand
+            covers = self._covers_rest(box, level + 1)
+            for lo, hi in box[dim]:
+                for i in xrange(bisect_right(starts, lo) - 1,
+                                bisect_right(starts, hi)):
+                    if len(covered[i]) < depth:
+                        segments[i].append(cand)
+                        if covers:
+                            covered[i].add(idx)
+
+        # Build the children, merging adjacent intervals with identical
+        # candidate lists.
+        new_starts = []
+        children = []
+        last = None
+        for start, segment in zip(starts, segments):
+            segment = tuple(segment)
+            if segment == last:
+                continue
+            last = segment
+            new_starts.append(start)
+            children.append(self._build(level + 1, segment))
+
+        node = TreeNode(level, self._dims[level], new_starts, children,
+                        self._build(level + 1, tuple(wildcard)),
+                        candidates[0][0])
+        self._memo[key] = node
+        return node
+
+    def _merge(self, found, leaf):
+        """Add the term indices of leaf to the sorted tuple found."""
+        if self.depth == 1:
+            leaf = leaf >= 0 and (leaf,) or ()
+        if not leaf:
+            return found
+        return tuple(sorted(set(found + leaf)))[:self.depth]
+
+    def regions(self, box=None, term=None):
+        """
+        Sweep the regions of the flow space reachable by a real packet and
+        yield the first ``depth`` terms matching each, as a sorted tuple of
+        term indices. Regions where the answer is the same may or may not be
+        merged.
+
+        Subtrees that can't change the answer are skipped, so the sweep only
+        costs as much as the terms that overlap box and come before the first
+        ``depth`` terms matching it.
+
+        :param box: Optional dict mapping dimensions to (lo, hi) intervals
+            (as returned by normalize_term()) to restrict the sweep to.
+        :param term: Optional index of a term matching everywhere in box.
+            Regions where an earlier term is known to match everywhere are
+            then yielded as soon as it is found, with that term first rather
+            than necessarily the first match.
+        """
+        if term is None:
+            return self._sweep([], [self.root], (), box or {}, None)
+        return self._sweep([], [self.root], (term,), box or {}, term)
+
+    def _sweep(self, pending, nodes, found, box, term):
+        """
+        Yield the answers for the regions of box, given the nodes still to
+        be split (pending) and the subtrees reached since the last split.
+        """
+        # Wildcards apply whichever child a region ends up in, so take them
+        # in straight away; the nodes in pending then stand for their
+        # children only.
+        pending = list(pending)
+        while nodes:
+            node = nodes.pop()
+            if isinstance(node, TreeNode):
+                pending.append(node)
+                nodes.append(node.wildcard)
+            else:
+                found = self._merge(found, node)
+        if term is not None and found[0] < term:
+            pending = []
+        elif len(found) == self.depth:
+            pending = [n for n in pending if n.first < found[-1]]
+        if not pending:
+            yield found
+            return
+
+        # Split on the dimension with the fewest boundaries inside box first,
+        # so that terms covering the rest of it are found before splitting
+        # on the others.
+        levels = {}
+        for node in pending:
+            levels.setdefault(node.level, []).append(node)
+        best = None
+        for level, here in levels.iteritems():
+            dim = self.order[level]
+            count = 0
+            for lo, hi in box.get(dim, [DOMAINS[dim]]):
+                for node in here:
+                    count += (bisect_right(node.starts, hi) -
+                              bisect_right(node.starts, lo))
+            if best is None or (count, level) < best:
+                best = (count, level)
+        level = best[1]
+        here = levels.pop(level)
+        rest = [n for nodes in levels.itervalues() for n in nodes]
+        cutoff = found[-1] if len(found) == self.depth else None
+        dim = self.order[level]
+
+        for intervals, following in self._split(
+                here, box.get(dim, [DOMAINS[dim]]), cutoff):
+            narrowed = dict(box)
+            narrowed[dim] = intervals
+            for region in self._sweep(rest, following, found, narrowed, term):
+                yield region
+
+    def _split(self, nodes, intervals, cutoff):
+        """
+        Split intervals where the children of nodes change, and yield each
+        piece with the children covering it, leaving out those whose terms
+        all come after cutoff. Adjacent pieces with the same children are
+        merged.
+        """
+        last = None
+        for lo, hi in intervals:
+            # Walk the boundaries of every node at once, so callers that stop
+            # early don't pay for the whole interval.
+            positions = [bisect_right(node.starts, lo) for node in nodes]
+            start = lo
+            while start <= hi:
+                following = []
+                end = hi
+                for i, node in enumerate(nodes):
+                    pos = positions[i]
+                    child = node.children[pos - 1]
+                    if cutoff is None or not isinstance(child, TreeNode) or \
+                       child.first < cutoff:
+                        following.append(child)
+                    if pos < len(node.starts) and node.starts[pos] <= end:
+                        end = node.starts[pos] - 1
+                ids = [id(n) for n in following]
+                if last is None or ids != last[0]:
+                    if last is not None:
+                        yield last[1], last[2]
+                    last = (ids, [(start, end)], following)
+                elif last[1][-1][1] + 1 == start:
+                    last[1][-1] = (last[1][-1][0], end)
+                else:
+                    last[1].append((start, end))
+
+                start = end + 1
+                for i, node in enumerate(nodes):
+                    if positions[i] < len(node.starts) and \
+                       node.starts[positions[i]] == start:
+                        positions[i] += 1
+        if last is not None:
+            yield last[1], last[2]
+
+    @property
+    def reachable(self):
+        """Set of indices of the terms that are the first match somewhere."""
+        if self._reachable is None:
+            self._reachable = self._find_reachable()
+        return self._reachable
+
+    def _find_reachable(self):
+        reachable = set()
+        for spec in self.specs:
+            if not spec.active:
+                continue
+            for box in spec.boxes:
+                for found in self.regions(box, spec.index):
+                    if found[0] == spec.index:
+                        reachable.add(spec.index)
+                        break
+                if spec.index in reachable:
+                    break
+        return reachable
+
+    @property
+    def shadowed(self):
+        """List of active Terms that can never be the first match."""
+        return [s.term for s in self.specs
+                if s.active and s.index not in self.reachable]
+
+    def lookup(self, flow):
+        """Return the index of the first term matching a single Flow, or -1."""
+        found = -1
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if not isinstance(node, TreeNode):
+                if self.depth > 1:
+                    node = node[0] if node else -1
+                if node >= 0 and (found < 0 or node < found):
+                    found = node
+                continue
+            if found >= 0 and node.first >= found:
+                continue
+            stack.append(node.wildcard)
+            value = flow[node.dim]
+            if value is not None:
+                stack.append(node.children[bisect_right(node.starts, value) - 1])
+        return found
+
+    def match(self, flows):
+        ret = []
+        for flow in flows:
+            if not isinstance(flow, Flow):
+                flow = make_flow(*flow)
+            ret.append(self.lookup(flow))
+        return ret
+
+
+ENGINES = {
+    'numpy':  CompiledACL,
+    'python': InterpretedACL,
+    'tree':   ACLDecisionTree,
+}
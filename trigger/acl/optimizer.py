@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+
+"""
+ACL optimizer. This is the library behind ``bin/optimizer``.
+
+Terms with the same action that differ in only one of source address,
+destination address or destination port are merged into a single term. Rather
+than comparing every term against every other term, each term is reduced to a
+canonical signature of everything that has to be equal for a merge, leaving
+out the dimension being merged, and terms are hashed into groups by that
+signature. Merging is then a single pass over each group.
+
+>>> from trigger.acl import parse
+>>> from trigger.acl.optimizer import optimize_acl
+>>> acl = parse(open('acl.abc123'))
+>>> new_acl = optimize_acl(acl)
+>>> len(acl.terms), len(new_acl.terms)
+(1200, 870)
+"""
+
+__author__ = 'Jathan McCollum, Mark Ellzey Thomas'
+__maintainer__ = 'Jathan McCollum'
+__email__ = 'jathan.mccollum@teamaol.com'
+__copyright__ = 'Copyright 2003-2012, AOL Inc.'
+
+from copy import copy
+import IPy
+from trigger.acl.parser import ACL, Comment
+
+
+# Exports
+__all__ = ('focus_terms', 'chunk_terms', 'merge_terms', 'optimize_terms',
+           'optimize_acl', 'MERGE_KEYS')
+
+
+# Defaults
+# Keys to optimize on, in the order the phases are run.
+MERGE_KEYS = ('source-address', 'destination-address', 'destination-port')
+
+# Keys a term must have to be considered for merging.
+CHECK_KEYS = ('protocol', 'source-address', 'destination-address',
+              'destination-port')
+
+REJECT_ACTIONS = ('reject', 'deny', 'discard')
+
+
+# Functions
+def focus_terms(pcount, terms):
+    """
+    Return a dict of the names of terms that match on a destination port used
+    by at least pcount terms, for the optimizer to 'focus' in on.
+
+    :param pcount: Minimum number of terms a port must be found in
+    :param terms: List of Term objects
+    """
+    focused = {}
+    ports = {}
+
+    for term in terms:
+        if 'source-port' in term.match or \
+           'destination-port' not in term.match:
+            continue
+        for port in term.match['destination-port']:
+            if port == 0:
+                continue
+            ports[port] = ports.get(port, 0) + 1
+
+    matched_ports = set([p for p, cnt in ports.iteritems() if cnt >= pcount])
+
+    for term in terms:
+        if 'source-port' in term.match or \
+           'destination-port' not in term.match:
+            continue
+        for port in term.match['destination-port']:
+            if port in matched_ports:
+                focused[term.name] = 1
+                break
+
+    return focused
+
+def chunk_terms(terms):
+    """
+    In order to achieve true optimization we must break our filter up
+    into chunks that are the aggregate of the same modifier. What this
+    means is if we have the following term structure::
+
+        term1 { accept }
+        term2 { accept }
+        term3 { accept }
+        term4 { deny }
+        term5 { deny }
+        term6 { accept }
+        term7 { accept }
+        term8 { deny }
+
+    We would break it up as so::
+
+        chunks = [[term1, term2, term3], [term4, term5], [term6, term7], [term8]]
+
+    We then only optimize on chunks of terms so that we don't accidently
+    optimize something accepted above a deny to an accept below the deny.
+    """
+    ret = []
+    current_chunk = []
+    current_modifier = None
+
+    for term in terms:
+        if current_modifier is None:
+            current_modifier = term.action[0]
+        if current_modifier != term.action[0]:
+            ret.append(copy(current_chunk))
+            current_chunk = []
+            current_modifier = term.action[0]
+        current_chunk.append(term)
+
+    ret.append(copy(current_chunk))
+    return ret
+
+def _expires(term):
+    """True if the term has an expiration date in its comments."""
+    for c in term.comments:
+        if 'UNTIL' in c and 'Never' not in c:
+            return True
+    return False
+
+def _values(values):
+    """Order-insensitive key for a list of match values."""
+    return len(values), frozenset([str(v) for v in values])
+
+def _addresses(values):
+    """
+    Key for a list of addresses. Two lists are considered equal if they are
+    the same length and every address in each is within an address in the
+    other, which is the same as having the same outermost networks.
+    """
+    outer = []
+    end = None
+    for ip in sorted(values, key=lambda ip: (ip.version(), ip.int(), ip.prefixlen())):
+        last = ip.int() + ip.len() - 1
+        if end is None or ip.version() != end[0] or ip.int() > end[1]:
+            outer.append(str(ip))
+            end = (ip.version(), last)
+    return len(values), frozenset(outer)
+
+def _signature(term, key):
+    """
+    Return everything that has to be equal for two terms to be merged on key,
+    or None if the term can't be merged with anything on key.
+    """
+    match = term.match
+    sig = [_values(match['protocol'])]
+
+    # Destination ports only merge if every port in both terms is the same.
+    if key != 'destination-port':
+        ports = _values(match['destination-port'])
+        if len(ports[1]) > 1:
+            return None
+        sig.append(ports)
+
+    if key == 'source-address':
+        others = ('destination-address',)
+    elif key == 'destination-address':
+        others = ('source-address',)
+    else:
+        others = ('source-address', 'destination-address')
+    for other in others:
+        sig.append(_addresses(match[other]))
+
+    return tuple(sig)
+
+def merge_terms(terms, key, focused=None, no_expires=False):
+    """
+    Merge terms that are identical except for key, returning the new list of
+    terms. Terms are expected to have the same action (see chunk_terms()).
+    The values and comments of a merged term are appended to the surviving
+    term, along with a comment saying what was merged.
+
+    Each term is merged into the first other term with the same signature,
+    so a run of mergeable terms collapses into the last of them. Terms are
+    identified by name, so names should be unique.
+
+    :param terms: List of Term objects
+    :param key: The match key to merge on
+    :param focused: Optional dict of term names to restrict merging to
+    :param no_expires: If set, terms with an expiration date are not merged
+        into other terms
+    """
+    groups = {}
+    order = []
+    # As a historical quirk, the search for a term to merge into stops at the
+    # first ICMP term with the same number of protocols. Remember where
+    # those are so we make the same decisions.
+    blockers = {}
+
+    for pos, term in enumerate(terms):
+        match = term.match
+        if focused and term.name not in focused:
+            continue
+        if term.action[0] in REJECT_ACTIONS or 'source-port' in match:
+            continue
+        if [k for k in CHECK_KEYS if k not in match]:
+            continue
+        if 'icmp' in match['protocol']:
+            blockers.setdefault(len(match['protocol']), pos)
+            continue
+
+        sig = _signature(term, key)
+        if sig is None:
+            continue
+        if sig not in groups:
+            groups[sig] = []
+            order.append(sig)
+        groups[sig].append((pos, term))
+
+    to_delete = set()
+    for sig in order:
+        group = groups[sig]
+        head = 0
+        for pos, term1 in group:
+            if term1.name in to_delete:
+                continue
+            if no_expires and _expires(term1):
+                continue
+
+            # Find the first remaining term other than term1.
+            while group[head][1].name in to_delete:
+                head += 1
+            target = head
+            while target < len(group) and \
+                  (group[target][1].name in to_delete or
+                   group[target][1].name == term1.name):
+                target += 1
+            if target == len(group):
+                continue
+            tpos, term2 = group[target]
+            if tpos > blockers.get(len(term1.match['protocol']), tpos):
+                continue
+
+            for comment in term1.comments:
+                term2.comments.append(comment)
+            ips = []
+            for to_add in term1.match[key]:
+                term2.match[key].append(to_add)
+                ips.append(str(to_add))
+            term2.comments.append(Comment('merged [(%s) %s] from %s' %
+                                          (key, ','.join(ips), term1.name)))
+            to_delete.add(term1.name)
+
+    return [t for t in terms if t.name not in to_delete]
+
+def optimize_terms(terms, keys=MERGE_KEYS, focused=None, no_expires=False):
+    """
+    Make a single optimization pass over terms, merging on each of keys in
+    turn within each chunk of same-action terms. Returns the new list of
+    terms.
+
+    Terms that are missing a source or destination address being optimized
+    on are given 0.0.0.0/0.
+    """
+    for key in keys:
+        if key == 'destination-port':
+            continue
+        for term in terms:
+            if key not in term.match:
+                term.match[key] = [IPy.IP('0.0.0.0/0')]
+
+    chunks = chunk_terms(terms)
+    for key in keys:
+        for idx, chunk in enumerate(chunks):
+            chunks[idx] = merge_terms(chunk, key, focused, no_expires)
+
+    return [term for chunk in chunks for term in chunk]
+
+def _optimize_passes(terms, keys, passes, focused, no_expires, stop):
+    """Run optimization passes until nothing changes or we run out."""
+    count = 1
+    while True:
+        if stop is not None and stop():
+            break
+        new_terms = optimize_terms(terms, keys, focused, no_expires)
+        if passes and count >= passes:
+            return new_terms
+        if len(terms) == len(new_terms):
+            return new_terms
+        terms = new_terms
+        count += 1
+    return terms
+
+def optimize_acl(acl, keys=MERGE_KEYS, passes=0, focused=None,
+                 no_expires=False, stop=None):
+    """
+    Optimize an ACL and return a new ACL object with the merged terms.
+    Address optimizations are repeated until no more terms are merged, and
+    destination ports are always optimized last.
+
+    The terms of the original ACL are modified in place.
+
+    :param acl: An ACL object
+    :param keys: Match keys to optimize on
+    :param passes: Maximum number of passes per phase, 0 for no limit
+    :param focused: Optional dict of term names to restrict merging to
+    :param no_expires: If set, terms with an expiration date are not merged
+    :param stop: Optional callable; optimization stops early once it returns
+        True
+    """
+    address_keys = [k for k in keys if k != 'destination-port']
+    terms = _optimize_passes(acl.terms, address_keys, passes, focused,
+                             no_expires, stop)
+    if 'destination-port' in keys:
+        terms = _optimize_passes(terms, ['destination-port'], passes, focused,
+                                 no_expires, stop)
+
+    new_acl = ACL()
+    new_acl.policers = acl.policers
+    new_acl.format = acl.format
+    new_acl.comments = acl.comments
+    new_acl.name = acl.name
+    new_acl.terms = terms
+    return new_acl
@@ -670,6 +670,14 @@ class ACL(object):
     def __str__(self):
         return '\n'.join(self.output(format=self.format, family=self.family))
 
+    def analyze(self):
+        """
+        Find shadowed, redundant and mergeable terms. Returns a
+        :class:`~trigger.acl.analysis.ACLAnalysis` report.
+        """
+        from trigger.acl.analysis import analyze
+        return analyze(self)
+
     def output(self, format=None, *largs, **kwargs):
         """
         Output the ACL data in the specified format.
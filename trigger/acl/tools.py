@@ -10,7 +10,8 @@ __maintainer__ = 'Jathan McCollum'
 __email__ = 'jathan.mccollum@teamaol.com'
 __copyright__ = 'Copyright 2010-2011, AOL Inc.'
 
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+import csv
 import datetime
 import IPy
 import os
@@ -18,6 +19,8 @@ import re
 import sys
 import tempfile
 from trigger.acl.parser import *
+from trigger.acl.engine import compile_acl, make_flow, term_action
+from trigger.acl.exceptions import ACLError
 from trigger.conf import settings
 
 
@@ -25,12 +28,20 @@ from trigger.conf import settings
 DEBUG = False
 DATE_FORMAT = "%Y-%m-%d"
 DEFAULT_EXPIRE = 6 * 30 # 6 months
+FLOW_BATCH_SIZE = 4096
+FLOW_FIELDS = ('source', 'destination', 'protocol', 'destination_port',
+               'source_port')
 
 
 # Exports
 __all__ = ('create_trigger_term', 'create_access', 'check_access', 'ACLScript',
           'process_bulk_loads', 'get_bulk_acls', 'get_comment_matches', 
-           'write_tmpacl', 'diff_files', 'worklog')
+           'write_tmpacl', 'diff_files', 'worklog', 'read_flows',
+           'AccessChecker', 'AccessResult')
+
+
+# Result of checking a single flow against a single ACL.
+AccessResult = namedtuple('AccessResult', 'flow acl term permitted')
 
 
 # Functions
@@ -146,6 +157,33 @@ def create_access(terms_to_check, new_term):
 
     return ret
 
+def read_flows(fileobj, on_error=None):
+    """
+    Read flow queries from a CSV file object and yield Flow objects. Each row
+    is ``source,destination[,protocol[,destination_port[,source_port]]]``.
+    Empty fields or 'any' mean "unknown". Blank lines, comments (#) and a
+    header row starting with 'source' are skipped.
+
+    :param fileobj: An open file object (e.g. sys.stdin)
+    :param on_error: Optional function called with the line number and the
+        exception for each row that isn't a valid flow, which is then
+        skipped. If not given, the exception is raised.
+    """
+    reader = csv.reader(fileobj)
+    for row in reader:
+        if not row or row[0].startswith('#') or row[0].strip() == 'source':
+            continue
+        fields = [f.strip() for f in row[:len(FLOW_FIELDS)]]
+        fields = [(f and f != 'any') and f or None for f in fields]
+        try:
+            flow = make_flow(*fields)
+        except (ValueError, ACLError), err:
+            if on_error is None:
+                raise
+            on_error(reader.line_num, err)
+            continue
+        yield flow
+
 def get_bulk_acls():
     """
     Returns a dict of acls with an applied count over settings.AUTOLOAD_BULK_THRESH
@@ -513,3 +551,76 @@ class ACLScript:
     def get_dst_ports(self):
         return self.dest_ports
 
+
+class AccessChecker(object):
+    """
+    Answer a stream of flow queries against a set of ACLs. Each ACL is parsed
+    and compiled once (see :mod:`trigger.acl.engine`), so the cost of
+    preprocessing is amortized over every flow that is checked.
+
+    >>> from trigger.acl.tools import AccessChecker, read_flows
+    >>> checker = AccessChecker()
+    >>> checker.load('/data/firewalls/acl.abc123')
+    >>> for result in checker.check(read_flows(sys.stdin)):
+    ...     print result.acl, result.term, result.permitted
+
+    :param engine: Name of the engine used to compile the ACLs; defaults to
+        NumPy if it is available. See :func:`trigger.acl.engine.compile_acl`.
+    :param batch_size: Number of flows read from the stream per pass.
+    """
+    def __init__(self, engine=None, batch_size=FLOW_BATCH_SIZE):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.acls = []
+
+    def add(self, name, acl):
+        """
+        Compile and add an already-parsed ACL object.
+
+        :param name: Label for results (e.g. the ACL file name)
+        :param acl: ACL object
+        """
+        self.acls.append((name, compile_acl(acl, self.engine)))
+
+    def load(self, acl_file, name=None):
+        """
+        Parse and compile an ACL file. Parser errors are passed up to the
+        caller.
+
+        :param acl_file: Path to the ACL file
+        :param name: Label for results; defaults to acl_file
+        """
+        self.add(name or acl_file, parse(file(acl_file)))
+
+    def _check_batch(self, flows):
+        results = []
+        for name, compiled in self.acls:
+            results.append((name, compiled.check(flows)))
+        for idx, flow in enumerate(flows):
+            for name, terms in results:
+                term = terms[idx]
+                permitted = None
+                if term is not None:
+                    permitted = term_action(term) == 'accept'
+                yield AccessResult(flow, name, term, permitted)
+
+    def check(self, flows):
+        """
+        Generate an AccessResult for every (flow, ACL) pair. Results are
+        ordered by flow, then by the order in which the ACLs were added. If no
+        term in an ACL matches the flow, term and permitted are None.
+
+        :param flows: An iterable of Flow objects or 5-tuples, such as the
+            output of :func:`read_flows`. It is consumed in batches, so it may
+            be an unbounded stream.
+        """
+        batch = []
+        for flow in flows:
+            batch.append(flow)
+            if len(batch) >= self.batch_size:
+                for result in self._check_batch(batch):
+                    yield result
+                batch = []
+        if batch:
+            for result in self._check_batch(batch):
+                yield result
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+"""
+Index of interface addresses and subnets, for finding which device and
+interface an address lives on.
+
+The index is built from the config gathered by
+:class:`~trigger.cmds.NetACLInfo` and can be saved to and loaded from a
+SQLite file. Each interface address is indexed as a host route, along with
+the subnet it's on, and lookups return the interfaces with the longest
+matching prefix. Lookups are done in memory with one dict lookup per prefix
+length in the index.
+
+>>> from trigger.cmds import NetACLInfo
+>>> from trigger.netindex import InterfaceIndex
+>>> n = NetACLInfo(devices=['router1.net.aol.com'])
+>>> n.run()
+>>> index = InterfaceIndex()
+>>> index.add_config(n.config)
+>>> index.lookup('10.1.2.3')
+[Entry(device='router1.net.aol.com', interface='ge-0/0/0.0',
+       address='10.1.2.1', network='10.1.2.0/24', acl_in=('abc123',),
+       acl_out=())]
+>>> index.save('netindex.db')
+"""
+
+__author__ = 'Jathan McCollum'
+__maintainer__ = 'Jathan McCollum'
+__email__ = 'jathan.mccollum@teamaol.com'
+__copyright__ = 'Copyright 2012, AOL Inc.'
+
+from collections import namedtuple
+from IPy import IP
+
+
+# Exports
+__all__ = ('InterfaceIndex', 'Entry')
+
+
+# An interface that matched a lookup. network is the prefix that matched:
+# either the interface address itself, or its subnet.
+Entry = namedtuple('Entry', 'device interface address network acl_in acl_out')
+
+
+# Classes
+class InterfaceIndex(object):
+    """
+    Longest-prefix-match index of interface addresses and subnets.
+
+    :attr prefixes: Dict of (IP version, prefix length) to dicts of network
+        addresses as integers to lists of Entry objects.
+    """
+    def __init__(self):
+        self.prefixes = {}
+        # Prefix lengths in the index for each IP version, longest first.
+        self._lengths = {}
+
+    def __len__(self):
+        return sum([len(nets) for nets in self.prefixes.itervalues()])
+
+    def _add(self, ip, entry):
+        key = (ip.version(), ip.prefixlen())
+        if key not in self.prefixes:
+            self.prefixes[key] = {}
+            lengths = self._lengths.setdefault(key[0], [])
+            lengths.append(key[1])
+            lengths.sort(reverse=True)
+        self.prefixes[key].setdefault(ip.int(), []).append(entry)
+
+    def add(self, device, interface, address, subnet, acl_in=(), acl_out=()):
+        """
+        Add an interface address and the subnet it is on.
+
+        :param device: Device name or NetDevice object
+        :param interface: Interface name
+        :param address: Interface address, as an IPy.IP object or string
+        :param subnet: Subnet of address, as an IPy.IP object or string
+        :param acl_in: List of inbound ACL names
+        :param acl_out: List of outbound ACL names
+        """
+        address, subnet = IP(address), IP(subnet)
+        device, acl_in, acl_out = str(device), tuple(acl_in), tuple(acl_out)
+        self._add(address, Entry(device, interface, str(address),
+                                 str(address), acl_in, acl_out))
+        # A /32 (or /128) is its own subnet, so it only gets one entry.
+        if subnet.prefixlen() != address.prefixlen():
+            self._add(subnet, Entry(device, interface, str(address),
+                                    str(subnet), acl_in, acl_out))
+
+    def add_config(self, config):
+        """
+        Add interfaces from NetACLInfo.config, replacing anything already in
+        the index for the same devices.
+
+        :param config: Dict of devices to dicts of interfaces, as gathered by
+            NetACLInfo
+        """
+        self.remove_devices(config.keys())
+        for device, interfaces in config.iteritems():
+            for name, iface in interfaces.iteritems():
+                for address, subnet in zip(iface['addr'], iface['subnets']):
+                    self.add(device, name, address, subnet,
+                             iface.get('acl_in', ()), iface.get('acl_out', ()))
+
+    def remove_devices(self, devices):
+        """
+        Remove everything in the index for devices.
+
+        :param devices: List of device names or NetDevice objects
+        """
+        names = set([str(dev) for dev in devices])
+        if not names:
+            return
+        for key, nets in self.prefixes.items():
+            for net, entries in nets.items():
+                entries = [e for e in entries if e.device not in names]
+                if entries:
+                    nets[net] = entries
+                else:
+                    del nets[net]
+            if not nets:
+                del self.prefixes[key]
+                self._lengths[key[0]].remove(key[1])
+
+    def lookup(self, ip):
+        """
+        Return the entries for the longest prefix in the index that contains
+        ip, or an empty list if none does.
+
+        :param ip: Address or network, as an IPy.IP object, string or integer
+        """
+        ip = IP(ip)
+        version, num, prefixlen = ip.version(), ip.int(), ip.prefixlen()
+        bits = version == 4 and 32 or 128
+        for length in self._lengths.get(version, ()):
+            if length > prefixlen:
+                continue
+            net = num >> (bits - length) << (bits - length)
+            entries = self.prefixes[(version, length)].get(net)
+            if entries:
+                return list(entries)
+        return []
+
+    def entries(self):
+        """Iterate over every (version, prefixlen, network int, Entry)."""
+        for (version, length), nets in self.prefixes.iteritems():
+            for net, entries in nets.iteritems():
+                for entry in entries:
+                    yield version, length, net, entry
+
+    def save(self, filename):
+        """
+        Write the index to a SQLite file, replacing whatever is in it.
+
+        :param filename: Path to the file
+        """
+        from sqlite3 import dbapi2 as sqlite
+        connection = sqlite.connect(filename)
+        connection.execute('DROP TABLE IF EXISTS prefixes')
+        connection.execute('''
+        CREATE TABLE prefixes (
+            version     INTEGER,
+            prefixlen   INTEGER,
+            net         TEXT,
+            network     TEXT,
+            device      TEXT,
+            interface   TEXT,
+            address     TEXT,
+            acl_in      TEXT,
+            acl_out     TEXT
+        );
+        ''')
+        # Networks are stored as text, as IPv6 ones don't fit in an INTEGER.
+        connection.executemany('''
+            INSERT INTO prefixes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);''',
+            ((version, length, str(net), e.network, e.device, e.interface,
+              e.address, ' '.join(e.acl_in), ' '.join(e.acl_out))
+             for version, length, net, e in self.entries()))
+        connection.commit()
+        connection.close()
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Read an index written by save().
+
+        :param filename: Path to the file
+        """
+        from sqlite3 import dbapi2 as sqlite
+        index = cls()
+        connection = sqlite.connect(filename)
+        connection.text_factory = str
+        rows = connection.execute('''
+            SELECT version, prefixlen, net, device, interface, address,
+                   network, acl_in, acl_out
+            FROM prefixes''')
+        for version, length, net, device, iface, address, network, acl_in, \
+            acl_out in rows:
+            key = (version, length)
+            if key not in index.prefixes:
+                index.prefixes[key] = {}
+                index._lengths.setdefault(version, []).append(length)
+            entry = Entry(device, iface, address, network,
+                          tuple(acl_in.split()), tuple(acl_out.split()))
+            index.prefixes[key].setdefault(long(net), []).append(entry)
+        connection.close()
+
+        for lengths in index._lengths.itervalues():
+            lengths.sort(reverse=True)
+        return index
@@ -21,12 +21,24 @@ from time import strftime, localtime
 import os
 import pwd
 import sys
+import threading
+import time
 from trigger.conf import settings
 from twisted.python import log
 
 # Exports
 __all__ = ('get_device_password', 'prompt_credentials', 'convert_tacacsrc',
-           'update_credentials', 'Tacacsrc')
+           'update_credentials', 'get_credential_provider', 'Tacacsrc',
+           'CredentialProvider')
+
+# Defaults
+# How long (in seconds) the process-wide credential cache trusts what it read
+# from .tacacsrc before reading it again. None means forever.
+CREDENTIALS_TTL = getattr(settings, 'CREDENTIALS_TTL', None)
+
+# The process-wide CredentialProvider, see get_credential_provider().
+_provider = None
+_provider_lock = threading.Lock()
 
 # Credential object stored in Tacacsrc.creds
 #Credentials = namedtuple('Credentials', 'username password')
@@ -41,27 +53,31 @@ class VersionMismatch(TacacsrcError): pass
 
 
 # Functions
+def get_credential_provider():
+    """
+    Return the process-wide CredentialProvider, creating it on first use.
+    All connections made by :mod:`trigger.twister` share it, so .tacacsrc is
+    only read and decrypted once per process (or once per
+    ``settings.CREDENTIALS_TTL`` seconds).
+    """
+    global _provider
+    with _provider_lock:
+        if _provider is None:
+            _provider = CredentialProvider(ttl=CREDENTIALS_TTL)
+        return _provider
+
 def get_device_password(device=None):
     """
     Fetch the password for a device/realm or create a new entry for it.
     If device is not passed, `settings.DEFAULT_REALM is used, which is default
     realm for most devices.
 
+    Credentials come from the process-wide cache (see
+    get_credential_provider()).
+
     :param device: Realm or device name to updated
     """
-    tcrc = Tacacsrc()
-
-    # If device isn't passed, assume we are initializing the .tacacsrc.
-    try:
-        creds = tcrc.creds[device]
-        print '\nFetching credentials from %s' % tcrc.file_name
-    except KeyError:
-        print '\nCredentials not found for device/realm %r, prompting...' % device
-        creds = prompt_credentials(device)
-        tcrc.creds[device] = creds
-        tcrc.write()
-
-    return creds
+    return get_credential_provider().get(device)
 
 def prompt_credentials(device, user=None):
     """
@@ -125,6 +141,7 @@ def update_credentials(device, username=None):
 
     tcrc.update_creds(tcrc.creds, mycreds.realm, username)
     tcrc.write()
+    get_credential_provider().invalidate()
 
     return True
 
@@ -437,3 +454,64 @@ class Tacacsrc(object):
             return True
 
         return False
+
+class CredentialProvider(object):
+    """
+    Thread-safe, in-memory cache of the credentials in .tacacsrc.
+
+    The file is read (and decrypted, which with GPG means running gpg2) the
+    first time credentials are asked for, and the credentials for each
+    device/realm are then served from memory. If ttl is set, the file is read
+    again once it is older than ttl seconds, so changes made by other
+    processes are eventually picked up.
+
+    You usually want the shared instance from get_credential_provider()
+    rather than creating your own.
+
+    :param ttl: Seconds to cache .tacacsrc for, or None to cache forever
+    :param loader: Callable that returns a Tacacsrc object
+    """
+    def __init__(self, ttl=None, loader=Tacacsrc):
+        self.ttl = ttl
+        self.loader = loader
+        self.lock = threading.RLock()
+        self.tcrc = None
+        self.loaded = None
+
+    def _tacacsrc(self):
+        """Return the cached Tacacsrc, reading it if needed. Hold the lock!"""
+        now = time.time()
+        if self.tcrc is None or \
+           (self.ttl is not None and now - self.loaded >= self.ttl):
+            log.msg('Reading credentials', debug=True)
+            self.tcrc = self.loader()
+            self.loaded = now
+        return self.tcrc
+
+    def get(self, device=None):
+        """
+        Return the Credentials for a device/realm, prompting for them and
+        saving them to .tacacsrc if they aren't there.
+
+        :param device: Realm or device name; defaults to
+            settings.DEFAULT_REALM
+        """
+        if device is None:
+            device = settings.DEFAULT_REALM
+
+        with self.lock:
+            tcrc = self._tacacsrc()
+            try:
+                return tcrc.creds[device]
+            except KeyError:
+                print '\nCredentials not found for device/realm %r, prompting...' % device
+                creds = prompt_credentials(device)
+                tcrc.creds[device] = creds
+                tcrc.write()
+                return creds
+
+    def invalidate(self):
+        """Forget the cached credentials so the next get() reads the file."""
+        with self.lock:
+            self.tcrc = None
+            self.loaded = None
@@ -20,7 +20,8 @@ import struct
 import sys
 import time
 import tty
-from xml.etree.ElementTree import Element, ElementTree, XMLTreeBuilder, tostring
+from xml.etree.ElementTree import (Element, ElementTree, TreeBuilder,
+                                   XMLTreeBuilder, tostring)
 from twisted.conch.ssh.channel import SSHChannel
 from twisted.conch.ssh.common import getNS, NS
 from twisted.conch.ssh.connection import SSHConnection
@@ -36,6 +37,7 @@ from twisted.internet.error import ConnectionRefusedError
 from twisted.internet.protocol import ClientFactory, Protocol
 from twisted.protocols.policies import TimeoutMixin
 from twisted.python import log
+from twisted.python.failure import Failure
 
 from trigger.conf import settings
 from trigger.netdevices import NetDevices
@@ -47,6 +49,29 @@ from trigger.utils.cli import yesno
 if not __debug__:
     log.startLogging(sys.stdout)
 
+# Defaults
+# How much of the output already scanned for a prompt is scanned again when
+# more data arrives, in case a prompt was split across packets. Must be longer
+# than any prompt.
+PROMPT_OVERLAP = 256
+
+# Whether to log debug messages, including everything sent and received in each
+# session. Formatting those is expensive for large outputs, so this is off
+# unless settings.TWISTER_DEBUG is set or we're running with 'python -O'.
+DEBUG = getattr(settings, 'TWISTER_DEBUG', False) or not __debug__
+
+# Most sessions a SessionPool keeps open at once.
+POOL_MAX_SESSIONS = 10
+
+# Seconds an unused session is kept open by a SessionPool.
+POOL_IDLE_TIMEOUT = 5 * 60
+
+# A SessionPool checks that a session that has been unused for this many
+# seconds still answers before running a batch on it, and drops it if it
+# doesn't within POOL_PROBE_TIMEOUT seconds.
+POOL_PROBE_INTERVAL = 30
+POOL_PROBE_TIMEOUT = 10
+
 
 # Exceptions
 class TriggerTwisterError(Exception): pass
@@ -76,6 +101,41 @@ class JunoscriptCommandFailure(CommandFailure):
 
 
 # Functions
+def _debug(msg, *args):
+    """
+    Log msg % args at debug level. Nothing is formatted unless DEBUG is set,
+    so pass the arguments instead of formatting them yourself.
+    """
+    if not DEBUG:
+        return None
+    if args:
+        msg = msg % args
+    log.msg(msg, debug=True)
+
+def _new_results(on_result):
+    """Return somewhere to put results: a list, or a ResultStream."""
+    if on_result is None:
+        return []
+    return ResultStream(on_result)
+
+def _consumer_ready(protocol):
+    """
+    Check whether protocol can send its next command. If its results are
+    streamed to a consumer that asked us to wait, protocol._send_next() is
+    called again once the consumer catches up. If the consumer failed, the
+    session is dropped.
+    """
+    results = protocol.results
+    if not isinstance(results, ResultStream):
+        return True
+    if not results.ready(protocol._send_next):
+        return False
+    if results.error is not None:
+        protocol.factory.err = results.error
+        protocol.loseConnection()
+        return False
+    return True
+
 def has_junoscript_error(tag):
     """Test whether an Element contains a Junoscript xnm:error."""
     if ElementTree(tag).find('.//{http://xml.juniper.net/xnm/1.1/xnm}error'):
@@ -87,7 +147,10 @@ def has_ioslike_error(s):
     return s.startswith('%') or '\n%' in s
 
 def has_netscaler_error(s):
-    """Test whether a string seems to contain a NetScaler error."""
+    """
+    Test whether a string (or a PromptBuffer) seems to contain a NetScaler
+    error.
+    """
     return s.startswith('ERROR:')
 
 def pty_connect(device, action, creds=None, display_banner=None,
@@ -113,17 +176,17 @@ def pty_connect(device, action, creds=None, display_banner=None,
     :param init_commands: A list of commands to execute upon logging into
     the device.
     """
-    d = defer.Deferred()
+    d = defer.Deferred(lambda d: factory.disconnect())
 
     # Only proceed if ping succeeds
     if ping_test:
-        log.msg('Pinging %s' % device, debug=True)
+        _debug('Pinging %s', device)
         if not ping(device.nodeName):
-            log.msg('Ping to %s failed' % device, debug=True)
+            _debug('Ping to %s failed', device)
             return None
 
     # SSH?
-    log.msg('SSH TYPES: %s' % settings.SSH_TYPES, debug=True)
+    _debug('SSH TYPES: %s', settings.SSH_TYPES)
     if device.manufacturer in settings.SSH_TYPES:
         if hasattr(sys, 'ps1') or not sys.stderr.isatty() \
          or not sys.stdin.isatty() or not sys.stdout.isatty():
@@ -136,20 +199,21 @@ def pty_connect(device, action, creds=None, display_banner=None,
 
         factory = TriggerSSHPtyClientFactory(d, action, creds, display_banner,
                                              init_commands)
-        log.msg('Trying SSH to %s' % device, debug=True)
-        reactor.connectTCP(device.nodeName, 22, factory)
+        _debug('Trying SSH to %s', device)
+        factory.connector = reactor.connectTCP(device.nodeName, 22, factory)
 
     # or Telnet?
     else:
         factory = TriggerTelnetClientFactory(d, action, creds,
                                              init_commands=init_commands)
-        log.msg('Trying telnet to %s' % device, debug=True)
-        reactor.connectTCP(device.nodeName, 23, factory)
+        _debug('Trying telnet to %s', device)
+        factory.connector = reactor.connectTCP(device.nodeName, 23, factory)
 
     return d
 
 def execute_junoscript(device, commands, creds=None, incremental=None,
-        with_errors=False, timeout=settings.DEFAULT_TIMEOUT):
+        with_errors=False, timeout=settings.DEFAULT_TIMEOUT, pipeline=1,
+        on_result=None, handlers=None):
     """
     Connect to a Juniper and enable XML mode.  Sequentially execute
     all the XML commands in the iterable 'commands' (ElementTree.Element
@@ -180,26 +244,53 @@ def execute_junoscript(device, commands, creds=None, incremental=None,
         BEWARE: Your generator cannot block; you must immediately
         decide what next command to execute, if any.
 
+    The deferred can be cancelled, which hangs up on the device.
+
     @timeout is the command timeout in seconds or None to disable.
     The default is in settings.DEFAULT_TIMEOUT; CommandTimeout errors
     will result if a command seems to take longer than that to run.
     LoginTimeout errors are always possible and cannot be disabled.
+
+    @pipeline is the number of commands to send before waiting for their
+    results. Raising it saves a round trip per command on slow links, but
+    commands are sent before earlier ones are known to have worked, so only
+    use it for commands that are safe to run regardless, like get-* RPCs.
+    If a command fails, results for any commands sent after it are thrown
+    away. It doesn't make sense with a generator that decides what to run
+    next based on results.
+
+    @on_result (optional) streams results instead of collecting them. It is
+    called as on_result(index, result) as each command finishes, and the
+    results aren't kept, so the deferred's callback gets a ResultStream
+    that only knows how many there were. If on_result returns a Deferred, no
+    more commands are sent until it fires, so a slow consumer (say, one
+    writing to disk) holds back the device rather than piling up results
+    in memory; if it fails, the session is dropped and the errback gets the
+    failure. Keep an eye on @timeout if the consumer can be slow.
+
+    @handlers (optional) processes replies as they are parsed. It maps paths
+    below rpc-reply, e.g. 'configuration/interfaces/interface', to callables
+    that get each matching Element as soon as it's complete. Handled
+    elements are then removed from the reply, so a big get-configuration
+    doesn't have to fit in memory all at once. See ReplyTreeBuilder.
     """
 
     assert device.manufacturer == 'JUNIPER'
-    d = defer.Deferred()
+    d = defer.Deferred(lambda d: factory.disconnect())
     channel = TriggerSSHJunoscriptChannel
     factory = TriggerSSHChannelFactory(d, commands, creds, incremental,
                                       with_errors, timeout, channel,
-                                      command_interval=0)
+                                      command_interval=0, pipeline=pipeline,
+                                      on_result=on_result, handlers=handlers)
 
-    log.msg('Trying Junoscript SSH to %s' % device, debug=True)
-    reactor.connectTCP(device.nodeName, 22, factory)
+    _debug('Trying Junoscript SSH to %s', device)
+    factory.connector = reactor.connectTCP(device.nodeName, 22, factory)
     return d
 
 def execute_ioslike(device, commands, creds=None, incremental=None,
                     with_errors=False, timeout=settings.DEFAULT_TIMEOUT,
-                    loginpw=None, enablepw=None, command_interval=0):
+                    loginpw=None, enablepw=None, command_interval=0,
+                    on_result=None):
     """
     Connect to a Cisco/IOS-like device over telnet. See execute_junoscript().
     """
@@ -207,17 +298,18 @@ def execute_ioslike(device, commands, creds=None, incremental=None,
     # TODO (jathan): This execute function should support SSH.
     assert device.manufacturer in settings.IOSLIKE_VENDORS
 
-    d = defer.Deferred()
+    d = defer.Deferred(lambda d: factory.disconnect())
     action = IoslikeSendExpect(device, commands, incremental, with_errors,
-                               timeout, command_interval)
+                               timeout, command_interval, on_result)
     factory = TriggerTelnetClientFactory(d, action, creds, loginpw, enablepw)
 
-    log.msg('Trying IOS-like scripting to %s' % device, debug=True)
-    reactor.connectTCP(device.nodeName, 23, factory)
+    _debug('Trying IOS-like scripting to %s', device)
+    factory.connector = reactor.connectTCP(device.nodeName, 23, factory)
     return d
 
 def execute_netscreen(device, commands, creds=None, incremental=None,
-                      with_errors=False, timeout=settings.DEFAULT_TIMEOUT):
+                      with_errors=False, timeout=settings.DEFAULT_TIMEOUT,
+                      on_result=None):
     """
     Connect to a NetScreen device. See execute_junoscript().
     """
@@ -227,31 +319,32 @@ def execute_netscreen(device, commands, creds=None, incremental=None,
     if not creds:
         creds = tacacsrc.get_device_password(str(device))
 
-    d = defer.Deferred()
+    d = defer.Deferred(lambda d: factory.disconnect())
     channel = TriggerSSHNetscreenChannel
     factory = TriggerSSHChannelFactory(d, commands, creds, incremental,
-                                      with_errors, timeout, channel)
+                                      with_errors, timeout, channel,
+                                      on_result=on_result)
 
-    log.msg('Trying Netscreen SSH to %s' % device, debug=True)
-    reactor.connectTCP(device.nodeName, 22, factory)
+    _debug('Trying Netscreen SSH to %s', device)
+    factory.connector = reactor.connectTCP(device.nodeName, 22, factory)
     return d
 
 def execute_netscaler(device, commands, creds=None, incremental=None,
                       with_errors=False, timeout=settings.DEFAULT_TIMEOUT,
-                      command_interval=0):
+                      command_interval=0, on_result=None):
     """
     Connect to a NetScaler device. See execute_junoscript().
     """
     assert device.is_netscaler()
 
-    d = defer.Deferred()
+    d = defer.Deferred(lambda d: factory.disconnect())
     channel = TriggerSSHNetscalerChannel
     factory = TriggerSSHChannelFactory(d, commands, creds, incremental,
                                       with_errors, timeout, channel,
-                                      command_interval)
+                                      command_interval, on_result=on_result)
 
-    log.msg('Trying NetScaler SSH to %s' % device, debug=True)
-    reactor.connectTCP(device.nodeName, 22, factory)
+    _debug('Trying NetScaler SSH to %s', device)
+    factory.connector = reactor.connectTCP(device.nodeName, 22, factory)
     return d
 
 
@@ -259,6 +352,188 @@ def execute_netscaler(device, commands, creds=None, incremental=None,
 #==================
 # Client Basics
 #==================
+class PromptBuffer(object):
+    """
+    Accumulates output from a device and looks for a prompt in it.
+
+    Output is kept as a list of chunks, and each time more arrives only the
+    new data (plus up to ``overlap`` bytes before it, in case the prompt was
+    split across packets) is searched, so collecting a large output costs
+    time linear in its size rather than quadratic. Where possible the
+    re-scanned part starts at the beginning of a line so that patterns can
+    match the whole prompt.
+
+    :param prompt: A compiled regular expression matching the prompt
+    :param overlap: Number of bytes of old output to search again
+    """
+    def __init__(self, prompt, overlap=PROMPT_OVERLAP):
+        self.prompt = prompt
+        self.overlap = overlap
+        self.clear()
+
+    def __len__(self):
+        return self.length
+
+    def clear(self):
+        """Throw away all output."""
+        self.chunks = []
+        self.length = 0
+        self.tail = ''
+        self.match = None
+
+    def feed(self, bytes):
+        """
+        Add bytes to the buffer. Returns the offset within getvalue() at
+        which the prompt starts, or None if there is no prompt yet. The match
+        object is left in self.match.
+
+        :param bytes: Newly received data
+        """
+        self.chunks.append(bytes)
+        window = self.tail + bytes
+        window_start = self.length - len(self.tail)
+        self.length += len(bytes)
+
+        self.match = self.prompt.search(window)
+
+        # Keep the end of what we just searched for next time, starting at
+        # the end of a line if there is one close enough. The newline itself
+        # is kept, since prompt patterns may match it (e.g. NetScaler's \s).
+        tail = window[-self.overlap:]
+        nl = tail.find('\n')
+        if nl != -1 and len(window) > self.overlap:
+            tail = tail[nl:]
+        self.tail = tail
+
+        if self.match is None:
+            return None
+        return window_start + self.match.start()
+
+    def getvalue(self):
+        """Return everything received since the last clear()."""
+        if len(self.chunks) > 1:
+            self.chunks = [''.join(self.chunks)]
+        return self.chunks and self.chunks[0] or ''
+
+    def startswith(self, prefix):
+        """Like str.startswith(), without joining all of the chunks."""
+        head = ''
+        for chunk in self.chunks:
+            head += chunk
+            if len(head) >= len(prefix):
+                break
+        return head.startswith(prefix)
+
+class SessionStats(object):
+    """
+    Counts the data sent and received in a session, as seen by the protocol
+    (after decryption for SSH). Each factory has one as its ``stats``
+    attribute, and if DEBUG is set it is logged along with the event key
+    ``session_stats`` when the connection is closed.
+    """
+    def __init__(self):
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.packets_received = 0
+        self.packets_sent = 0
+        self.started = time.time()
+
+    def __repr__(self):
+        return ('<%s: received %d bytes in %d packets, sent %d bytes in %d '
+                'packets, %.2fs>' % (self.__class__.__name__,
+                                     self.bytes_received, self.packets_received,
+                                     self.bytes_sent, self.packets_sent,
+                                     self.elapsed))
+
+    @property
+    def elapsed(self):
+        """Seconds since the session started."""
+        return time.time() - self.started
+
+    def received(self, bytes):
+        """Count bytes that came in."""
+        self.bytes_received += len(bytes)
+        self.packets_received += 1
+
+    def sent(self, bytes):
+        """Count bytes that went out."""
+        self.bytes_sent += len(bytes)
+        self.packets_sent += 1
+
+class ResultStream(object):
+    """
+    Takes the place of the list of results when they are streamed to a
+    callback (see on_result in execute_junoscript()). Results are passed on
+    as they are appended and not kept.
+
+    :param callback: Called as callback(index, result) for each result. If
+        it returns a Deferred, the session waits for it to fire before
+        sending the next command.
+    """
+    def __init__(self, callback):
+        self.callback = callback
+        self.count = 0
+        self.pending = 0
+        self.error = None
+        self.waiter = None
+
+    def __repr__(self):
+        return '<%s: %d results>' % (self.__class__.__name__, self.count)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter([])
+
+    def append(self, result):
+        """Pass result on to the callback."""
+        index = self.count
+        self.count += 1
+        d = self.callback(index, result)
+        if isinstance(d, defer.Deferred):
+            self.pending += 1
+            d.addBoth(self._consumed)
+
+    def ready(self, waiter):
+        """
+        Return True if the callback is done with every result so far.
+        Otherwise return False and call waiter() once it is.
+        """
+        if self.pending:
+            self.waiter = waiter
+            return False
+        return True
+
+    def _consumed(self, result):
+        self.pending -= 1
+        if isinstance(result, Failure) and self.error is None:
+            self.error = result
+        if not self.pending and self.waiter is not None:
+            waiter, self.waiter = self.waiter, None
+            waiter()
+        return None
+
+class PacedSendMixin(object):
+    """
+    Spaces out the commands a session sends by its command_interval. Mixed
+    into sessions that have a buffer, a pending_send for the scheduled call
+    (which they cancel when they go away), a _send_next() method and a
+    callLater() from TimeoutMixin.
+    """
+    def _pace_next(self):
+        """
+        Send the next command after command_interval seconds. The wait is
+        scheduled with the reactor rather than slept, so other sessions carry
+        on in the meantime.
+        """
+        if self.command_interval > 0:
+            self.buffer.clear()
+            self.pending_send = self.callLater(self.command_interval,
+                                               self._send_next)
+        else:
+            self._send_next()
+
 class TriggerClientFactory(ClientFactory):
     """
     Factory for all clients. Subclass me.
@@ -266,35 +541,69 @@ class TriggerClientFactory(ClientFactory):
 
     def __init__(self, deferred, creds=None, init_commands=None):
         self.d = deferred
-        self.tcrc = tacacsrc.Tacacsrc()
         if creds is None:
-            log.msg('creds not defined, fetching...', debug=True)
-            realm = settings.DEFAULT_REALM
-            creds = self.tcrc.creds.get(realm, tacacsrc.get_device_password(realm))
+            _debug('creds not defined, fetching...')
+            creds = tacacsrc.get_device_password(settings.DEFAULT_REALM)
         self.creds = creds
 
         self.results = None
         self.err = None
+        self.stats = SessionStats()
+        self.session = None # Set if a SessionPool owns this connection
+        self.connector = None # Set by whoever connects us
+        self.cancelled = False
 
         # Setup and run the initial commands
         if init_commands is None:
             init_commands = [] # We need this to be a list
         self.init_commands = init_commands
-        log.msg('INITIAL COMMANDS: %r' % self.init_commands, debug=True)
+        _debug('INITIAL COMMANDS: %r', self.init_commands)
         self.initialized = False
 
+    def disconnect(self):
+        """
+        Stop connecting, or hang up if we're connected. Used to cancel the
+        Deferred, so that a cancelled session doesn't stay connected. The
+        Deferred fails with CancelledError rather than with however the
+        connection ends.
+        """
+        self.cancelled = True
+        if self.connector is not None:
+            _debug('Cancelled, disconnecting...')
+            self.connector.disconnect()
+
     def clientConnectionFailed(self, connector, reason):
         """Do this when the connection fails."""
-        self.d.errback(reason)
+        if not self.cancelled:
+            self.d.errback(reason)
 
     def clientConnectionLost(self, connector, reason):
         """Do this when the connection is lost."""
-        log.msg('Client connection lost', debug=True)
+        _debug('Client connection lost')
+        if DEBUG:
+            log.msg('Session stats: %r' % self.stats, debug=True,
+                    session_stats=self.stats)
+        if self.cancelled:
+            return None
         if self.err:
             self.d.errback(self.err)
         else:
             self.d.callback(self.results)
 
+    def commands_done(self, protocol):
+        """
+        Called by the protocol once it has run all of its commands. Hangs up,
+        unless the connection belongs to a SessionPool, which keeps it open
+        for the next batch of commands.
+
+        :param protocol: The protocol (channel or action) that is done
+        """
+        if self.session is None:
+            _debug('Out of commands, disconnecting...')
+            protocol.loseConnection()
+        else:
+            self.session.batch_done(protocol)
+
     def _init_commands(self, protocol):
         """
         Execute any initial commands specified.
@@ -303,10 +612,10 @@ class TriggerClientFactory(ClientFactory):
         the commands.
         """
         if not self.initialized:
-            log.msg('Not initialized, sending init commands', debug=True)
+            _debug('Not initialized, sending init commands')
             while self.init_commands:
                 next_init = self.init_commands.pop(0)
-                log.msg('Sending: %r' % next_init, debug=True)
+                _debug('Sending: %r', next_init)
                 protocol.write(next_init + '\n')
             else:
                 self.initialized = True
@@ -332,7 +641,7 @@ class TriggerSSHTransport(SSHClientTransport, object):
 
     def sendDisconnect(self, reason, desc):
         """Trigger disconnect of the transport."""
-        log.msg('Got disconnect request, reason: %r, desc: %r' % (reason, desc), debug=True)
+        _debug('Got disconnect request, reason: %r, desc: %r', reason, desc)
         if reason != DISCONNECT_CONNECTION_LOST:
             self.factory.err = SSHConnectionLost(reason, desc)
         super(TriggerSSHTransport, self).sendDisconnect(reason, desc)
@@ -346,7 +655,7 @@ class TriggerSSHUserAuth(SSHUserAuthClient):
     def getPassword(self, prompt=None):
         """Send along the password."""
         #self.getPassword()
-        log.msg('Performing password authentication', debug=True)
+        _debug('Performing password authentication')
         return defer.succeed(self.transport.factory.creds.password)
 
     def getGenericAnswers(self, name, information, prompts):
@@ -356,8 +665,8 @@ class TriggerSSHUserAuth(SSHUserAuthClient):
         when configured within self.preferredOrder, does not work using default
         getPassword() method.
         """
-        log.msg('Performing interactive authentication', debug=True)
-        log.msg('Prompts: %r' % prompts, debug=True)
+        _debug('Performing interactive authentication')
+        _debug('Prompts: %r', prompts)
 
         # The response must always a sequence, and the length must match that
         # of the prompts list
@@ -365,8 +674,7 @@ class TriggerSSHUserAuth(SSHUserAuthClient):
         for idx, prompt_tuple in enumerate(prompts):
             prompt, echo = prompt_tuple # e.g. [('Password: ', False)]
             if 'assword' in prompt:
-                log.msg("Got password prompt: %r, sending password!" % prompt,
-                        debug=True)
+                _debug("Got password prompt: %r, sending password!", prompt)
                 response[idx] = self.transport.factory.creds.password
 
         return defer.succeed(response)
@@ -388,7 +696,7 @@ class TriggerSSHUserAuth(SSHUserAuthClient):
         """
         canContinue, partial = getNS(packet)
         partial = ord(partial)
-        log.msg('Previous method: %r ' % self.lastAuth, debug=True)
+        _debug('Previous method: %r ', self.lastAuth)
 
         # If the last method succeeded, track it. If network devices ever start
         # doing second-factor authentication this might be useful.
@@ -396,7 +704,7 @@ class TriggerSSHUserAuth(SSHUserAuthClient):
             self.authenticatedWith.append(self.lastAuth)
         # If it failed, track that too...
         else:
-            log.msg('Previous method failed, skipping it...', debug=True)
+            _debug('Previous method failed, skipping it...')
             self.authenticatedWith.append(self.lastAuth)
 
         def orderByPreference(meth):
@@ -421,7 +729,7 @@ class TriggerSSHUserAuth(SSHUserAuthClient):
                              key=orderByPreference)
 
         log.msg('can continue with: %s' % canContinue)
-        log.msg('Already tried: %s' % self.authenticatedWith, debug=True)
+        _debug('Already tried: %s', self.authenticatedWith)
         return self._cbUserauthFailure(None, iter(canContinue))
 
     def _cbUserauthFailure(self, result, iterator):
@@ -447,11 +755,20 @@ class TriggerSSHConnection(SSHConnection, object):
 
     def serviceStarted(self):
         """Open the channel once we start."""
-        self.openChannel(self.transport.factory.channel(conn=self))
+        factory = self.transport.factory
+        if isinstance(factory, TriggerSSHMultiplexFactory):
+            factory.mux.connected(self)
+        else:
+            self.openChannel(factory.channel(conn=self))
 
     def channelClosed(self, channel):
-        """Close the channel when we're done."""
-        self.transport.loseConnection()
+        """
+        Close the channel when we're done. Unless we're multiplexing, that
+        was the only channel, so hang up as well.
+        """
+        SSHConnection.channelClosed(self, channel)
+        if not isinstance(self.transport.factory, TriggerSSHMultiplexFactory):
+            self.transport.loseConnection()
 
 #==================
 # SSH PTY Stuff
@@ -470,7 +787,7 @@ class Interactor(Protocol):
 
     def dataReceived(self, data):
         """And write data to the terminal."""
-        log.msg('Interactor.dataReceived: %r' % data, debug=True)
+        _debug('Interactor.dataReceived: %r', data)
         self.stdio.write(data)
 
 class TriggerSSHPtyChannel(SSHChannel):
@@ -547,6 +864,49 @@ class IncrementalXMLTreeBuilder(XMLTreeBuilder):
         """Do this when we're out of XML!"""
         return self._endhandler(XMLTreeBuilder._end(self, tag))
 
+class ReplyTreeBuilder(TreeBuilder):
+    """
+    TreeBuilder for a JunoScript session that doesn't hang on to what it has
+    already handed out.
+
+    Finished rpc-reply elements are taken off the session's root element, so
+    a long session doesn't build up every reply in memory. Optionally,
+    elements at given paths below each rpc-reply are passed to handlers as
+    soon as they are complete and then removed from the reply, so a huge
+    reply (like a get-configuration) never has to be held in full.
+
+    :param handlers: Optional dict mapping paths below rpc-reply, such as
+        ``'configuration/interfaces/interface'``, to callables that are
+        given each matching Element. Paths use tag names without namespaces.
+    """
+    def __init__(self, handlers=None):
+        TreeBuilder.__init__(self)
+        self.handlers = {}
+        for path, func in (handlers or {}).iteritems():
+            self.handlers[tuple(path.strip('/').split('/'))] = func
+        self.stack = []
+        self.path = []
+
+    def start(self, tag, attrs):
+        elem = TreeBuilder.start(self, tag, attrs)
+        self.stack.append(elem)
+        self.path.append(tag.split('}')[-1])
+        return elem
+
+    def end(self, tag):
+        elem = TreeBuilder.end(self, tag)
+        self.stack.pop()
+        path = self.path
+        if len(path) == 2 and path[1] == 'rpc-reply':
+            self.stack[0].remove(elem)
+        elif self.handlers and len(path) > 2 and path[1] == 'rpc-reply':
+            func = self.handlers.get(tuple(path[2:]))
+            if func is not None:
+                func(elem)
+                self.stack[-1].remove(elem)
+        path.pop()
+        return elem
+
 #==================
 # SSH Channels
 #==================
@@ -557,7 +917,8 @@ class TriggerSSHChannelFactory(TriggerClientFactory):
     """
 
     def __init__(self, deferred, commands, creds=None, incremental=None,
-            with_errors=False, timeout=None, channel=None, command_interval=0):
+            with_errors=False, timeout=None, channel=None, command_interval=0,
+            pipeline=1, on_result=None, handlers=None):
         if channel is None:
             raise TriggerTwisterError('You must specify an SSH channel class')
 
@@ -569,14 +930,22 @@ class TriggerSSHChannelFactory(TriggerClientFactory):
         self.timeout = timeout
         self.channel = channel
         self.command_interval = command_interval
+        self.pipeline = pipeline
+        self.on_result = on_result
+        self.handlers = handlers
         TriggerClientFactory.__init__(self, deferred, creds)
 
 class TriggerSSHChannelBase(SSHChannel, TimeoutMixin):
     """
     Base class for SSH Channels. setup_channelOpen() should be called by
     channelOpen() in the child class.
+
+    The channel's commands and settings come from its factory, which is the
+    transport's factory unless the channel was opened by an SSHMultiplexer.
     """
     name = 'session'
+    factory = None
+    multiplexed = False
 
     def setup_channelOpen(self, data):
         """
@@ -587,20 +956,57 @@ class TriggerSSHChannelBase(SSHChannel, TimeoutMixin):
                 self.conn.sendRequest(self, 'shell', '')
                 # etc.
         """
-        self.factory = self.conn.transport.factory
+        if self.factory is None:
+            self.factory = self.conn.transport.factory
         self.commanditer = iter(self.factory.commands)
-        self.results = self.factory.results = []
+        self.on_result = self.factory.on_result
+        self.results = self.factory.results = _new_results(self.on_result)
         self.with_errors = self.factory.with_errors
         self.incremental = self.factory.incremental
         self.command_interval = self.factory.command_interval
+        self.stats = self.factory.stats
+        self.pending_send = None
+        self.setTimeout(self.factory.timeout)
+
+    def write(self, data):
+        """Send data to the channel, counting it."""
+        self.stats.sent(data)
+        SSHChannel.write(self, data)
+
+    def next_batch(self, commands):
+        """
+        Start running another set of commands once the last ones are done.
+        Used by SessionPool to reuse the channel.
+
+        :param commands: An iterable of commands
+        """
+        self.commanditer = iter(commands)
+        self.results = self.factory.results = _new_results(self.on_result)
         self.setTimeout(self.factory.timeout)
+        self._send_next()
 
     def loseConnection(self):
         """
         Terminate the connection. Link this to the transport method of the same
-        name.
+        name. Multiplexed channels only close themselves.
         """
-        self.conn.transport.loseConnection()
+        if self.multiplexed:
+            SSHChannel.loseConnection(self)
+        else:
+            self.conn.transport.loseConnection()
+
+    def openFailed(self, reason):
+        """Fail a multiplexed channel's Deferred if it can't be opened."""
+        SSHChannel.openFailed(self, reason)
+        if self.multiplexed:
+            self.factory.clientConnectionFailed(None, reason)
+
+    def closed(self):
+        """Don't send anything else once the channel is closed."""
+        if self.pending_send is not None and self.pending_send.active():
+            self.pending_send.cancel()
+        if self.multiplexed:
+            self.factory.channel_closed()
 
     def timeoutConnection(self):
         """
@@ -614,6 +1020,10 @@ class TriggerSSHJunoscriptChannel(TriggerSSHChannelBase):
     Run Junoscript commands on a Juniper router. This completely assumes that
     we are the only channel in the factory (a TriggerJunoscriptFactory) and
     walks all the way back up to the factory for its arguments.
+
+    If the factory's pipeline is more than 1, up to that many RPCs are sent
+    before waiting for replies. Replies come back in the order the RPCs were
+    sent, so each one is matched up with the oldest RPC still waiting.
     """
 
     def channelOpen(self, data):
@@ -623,53 +1033,80 @@ class TriggerSSHJunoscriptChannel(TriggerSSHChannelBase):
         _xml = '<?xml version="1.0" encoding="us-ascii"?>\n'
         _xml += '<junoscript version="1.0" hostname="%s" release="7.6R2.9">\n' % socket.getfqdn()
         self.write(_xml)
-        self.xmltb = IncrementalXMLTreeBuilder(self._endhandler)
+        self.xmltb = IncrementalXMLTreeBuilder(self._endhandler,
+                target=ReplyTreeBuilder(self.factory.handlers))
+
+        # What we're waiting on, oldest first: True for an RPC, or None for a
+        # None command whose result has to wait for the RPCs before it.
+        self.pipeline = max(self.factory.pipeline, 1)
+        self.waiting = []
+        self.rpcs_waiting = 0
+        # Set once an error reply has dropped the session, so that replies
+        # to RPCs already pipelined behind it are ignored.
+        self.aborted = False
 
         self._send_next()
 
     def dataReceived(self, data):
         """Do this when we receive data."""
-        #log.msg('BYTES: %r' % data, debug=True)
+        self.stats.received(data)
         self.xmltb.feed(data)
 
     def _send_next(self):
-        """Send the next command in the stack."""
+        """Send commands until the pipeline is full."""
+        if self.aborted or not _consumer_ready(self):
+            return None
         self.resetTimeout()
-        #log.msg('CHANNEL: timeout=%s' % self.factory.timeout, debug=True)
 
         if self.incremental:
             self.incremental(self.results)
 
-        try:
-            next = self.commanditer.next()
-            log.msg('COMMAND: next command=%s' % next, debug=True)
+        while self.rpcs_waiting < self.pipeline:
+            try:
+                next = self.commanditer.next()
+                _debug('COMMAND: next command=%s', next)
 
-        except StopIteration:
-            log.msg('CHANNEL: out of commands, closing...', debug=True)
-            self.loseConnection()
-            return None
+            except StopIteration:
+                if not self.waiting:
+                    _debug('CHANNEL: out of commands')
+                    self.factory.commands_done(self)
+                return None
 
-        if next is None:
-            self.results.append(None)
-            self._send_next()
-        else:
-            rpc = Element('rpc')
-            rpc.append(next)
-            ElementTree(rpc).write(self)
+            if next is None:
+                if self.waiting:
+                    self.waiting.append(None)
+                else:
+                    self.results.append(None)
+                    if self.incremental:
+                        self.incremental(self.results)
+            else:
+                rpc = Element('rpc')
+                rpc.append(next)
+                ElementTree(rpc).write(self)
+                self.waiting.append(True)
+                self.rpcs_waiting += 1
 
     def _endhandler(self, tag):
         """Do this when the XML stream ends."""
         if tag.tag != '{http://xml.juniper.net/xnm/1.1/xnm}rpc-reply':
             return  None # hopefully it's interior to an <rpc-reply>
+        if self.aborted:
+            return None
+        self.waiting.pop(0)
+        self.rpcs_waiting -= 1
         self.results.append(tag)
         if has_junoscript_error(tag) and not self.with_errors:
+            self.aborted = True
             self.factory.err = JunoscriptCommandFailure(tag)
             self.loseConnection()
             return None
-        else:
-            self._send_next()
 
-class TriggerSSHNetscalerChannel(TriggerSSHChannelBase):
+        while self.waiting and self.waiting[0] is None:
+            self.waiting.pop(0)
+            self.results.append(None)
+        self._send_next()
+
+class TriggerSSHNetscalerChannel(TriggerSSHChannelBase, PacedSendMixin):
     """
     Same as TriggerSSHJunoscriptChannel but for NetScreen. Mostly
     copy-pasted, and probably needs refactoring but it works.
@@ -679,8 +1116,8 @@ class TriggerSSHNetscalerChannel(TriggerSSHChannelBase):
         """Do this when channel opens."""
         self.setup_channelOpen(data)
         self.initialized = False
-        self.data = ''
         self.prompt = re.compile('\sDone\n$') # ' Done \n'  only
+        self.buffer = PromptBuffer(self.prompt)
         self.conn.sendRequest(self, 'shell', '')
         self.initialize = [] # A command to run at startup e.g. ['enable\n']
 
@@ -689,15 +1126,17 @@ class TriggerSSHNetscalerChannel(TriggerSSHChannelBase):
 
     def dataReceived(self, bytes):
         """Do this when we receive data."""
-        self.data += bytes
-        log.msg('BYTES: %r' % bytes, debug=True)
-        log.msg('BYTES: (left: %r, max: %r, bytes: %r, data: %r)' %
-                (self.remoteWindowLeft, self.localMaxPacket, len(bytes), len(self.data)))
+        self.stats.received(bytes)
+        end = self.buffer.feed(bytes)
+        _debug('BYTES: %r', bytes)
+        _debug('BYTES: (left: %r, max: %r, bytes: %r, data: %r)',
+               self.remoteWindowLeft, self.localMaxPacket, len(bytes),
+               len(self.buffer))
 
         # We have to check for errors first, because a prompt is not returned
         # when an error is received like on other systems.
-        if has_netscaler_error(self.data):
-            err = self.data
+        if has_netscaler_error(self.buffer):
+            err = self.buffer.getvalue()
             if not self.with_errors:
                 self.factory.err = NetscalerCommandFailure(err)
                 self.loseConnection()
@@ -705,26 +1144,25 @@ class TriggerSSHNetscalerChannel(TriggerSSHChannelBase):
             else:
                 self.results.append(err)
                 self._send_next()
+                return None
 
-        m = self.prompt.search(self.data)
-        if not m:
-            log.msg('STATE: prompt match failure', debug=True)
+        if end is None:
+            _debug('STATE: prompt match failure')
             return None
-        log.msg('STATE: prompt %r' % m.group(), debug=True)
+        _debug('STATE: prompt %r', self.buffer.match.group())
 
-        result = self.data[:m.start()] # Strip ' Done\n' from results.
+        result = self.buffer.getvalue()[:end] # Strip ' Done\n' from results.
 
         if self.initialized:
             self.results.append(result)
 
-        if self.command_interval > 0:
-            time.sleep(self.command_interval)
-
-        self._send_next()
+        self._pace_next()
 
     def _send_next(self):
         """Send the next command in the stack."""
-        self.data = ''
+        if not _consumer_ready(self):
+            return None
+        self.buffer.clear()
         self.resetTimeout()
 
         if not self.initialized:
@@ -740,15 +1178,15 @@ class TriggerSSHNetscalerChannel(TriggerSSHChannelBase):
         try:
             next = self.commanditer.next()
         except StopIteration:
-            log.msg('CHANNEL: out of commands, closing...', debug=True)
-            self.loseConnection()
+            _debug('CHANNEL: out of commands')
+            self.factory.commands_done(self)
             return None
 
         if next is None:
             self.results.append(None)
             self._send_next()
         else:
-            log.msg('sending NetScaler command: %r' % next, debug=True)
+            _debug('sending NetScaler command: %r', next)
             self.write(next + '\n')
 
 class TriggerSSHNetscreenChannel(TriggerSSHChannelBase):
@@ -761,19 +1199,18 @@ class TriggerSSHNetscreenChannel(TriggerSSHChannelBase):
         """Do this when the channel opens."""
         self.setup_channelOpen(data)
         self.initialized = False
-        self.data = ''
         self.prompt = re.compile('(\w+?:|)[\w().-]*\(?([\w.-])?\)?\s*->\s*$')
+        self.buffer = PromptBuffer(self.prompt)
         self.conn.sendRequest(self, 'shell', '')
 
     def dataReceived(self, bytes):
         """Do this when we receive data."""
-        self.data += bytes
-
-        m = self.prompt.search(self.data)
-        if not m:
+        self.stats.received(bytes)
+        end = self.buffer.feed(bytes)
+        if end is None:
             return None
 
-        result = self.data[:m.start()]
+        result = self.buffer.getvalue()[:end]
         result = result[result.find('\n')+1:]
 
         if self.initialized:
@@ -783,7 +1220,9 @@ class TriggerSSHNetscreenChannel(TriggerSSHChannelBase):
 
     def _send_next(self):
         """Send the next command in the stack."""
-        self.data = ''
+        if not _consumer_ready(self):
+            return None
+        self.buffer.clear()
         if not self.initialized:
             self.initialized = True
 
@@ -793,13 +1232,13 @@ class TriggerSSHNetscreenChannel(TriggerSSHChannelBase):
         try:
             next = self.commanditer.next()
         except StopIteration:
-            self.loseConnection()
+            self.factory.commands_done(self)
             return None
         if next is None:
             self.results.append(None)
             self._send_next()
         else:
-            log.msg('sending Netscreen command %s' % next, debug=True)
+            _debug('sending Netscreen command %s', next)
             self.write(next + '\n')
 
 #==================
@@ -846,17 +1285,27 @@ class TriggerTelnet(Telnet, ProtocolTransportMixin, TimeoutMixin):
         Arista Networks hardware is the only vendor that needs this method
         right now.
         """
-        log.msg('TriggerTelnet.enableRemote option: %r' % option, debug=True)
+        _debug('TriggerTelnet.enableRemote option: %r', option)
         return True
 
+    def dataReceived(self, data):
+        """Count data as it is read, then process telnet commands."""
+        self.factory.stats.received(data)
+        Telnet.dataReceived(self, data)
+
+    def write(self, data):
+        """Send data to the device, counting it."""
+        self.factory.stats.sent(data)
+        ProtocolTransportMixin.write(self, data)
+
     def login_state_machine(self, bytes):
         """Track user login state."""
         self.data += bytes
-        log.msg('STATE:  got data %r' % self.data, debug=True)
+        _debug('STATE:  got data %r', self.data)
         for (text, next_state) in self.waiting_for:
-            log.msg('STATE:  possible matches %r' % text, debug=True)
+            _debug('STATE:  possible matches %r', text)
             if self.data.endswith(text):
-                log.msg('Entering state %r' % next_state.__name__, debug=True)
+                _debug('Entering state %r', next_state.__name__)
                 self.resetTimeout()
                 next_state()
                 self.data = ''
@@ -890,7 +1339,7 @@ class TriggerTelnet(Telnet, ProtocolTransportMixin, TimeoutMixin):
         """
         self.setTimeout(None)
         data = self.data.lstrip('\n')
-        log.msg('state_logged_in, DATA: %r' % data, debug=True)
+        _debug('state_logged_in, DATA: %r', data)
         del self.waiting_for, self.data
 
         # Run init_commands
@@ -912,7 +1361,7 @@ class TriggerTelnet(Telnet, ProtocolTransportMixin, TimeoutMixin):
         TACACS by default. Use 'aaa authentication login privilege-mode'.
         Also, why no space after the Password: prompt here?
         """
-        log.msg("ENABLE: Sending command: enable\n", debug=True)
+        _debug("ENABLE: Sending command: enable\n")
         self.write('enable\n')
         self.waiting_for = [
             ('Password: ', self.state_enable_pw), # Foundry
@@ -931,7 +1380,7 @@ class TriggerTelnet(Telnet, ProtocolTransportMixin, TimeoutMixin):
         if pw is None:
             pw = ''
 
-        log.msg('Sending password %s' % pw, debug=True)
+        _debug('Sending password %s', pw)
         self.write(pw + '\n')
         self.waiting_for = [('>', self.state_enable),
                             ('#', self.state_logged_in),
@@ -944,7 +1393,7 @@ class TriggerTelnet(Telnet, ProtocolTransportMixin, TimeoutMixin):
             pw = self.factory.enablepw
         else:
             pw = NetDevices().find(self.transport.connector.host).enablePW
-        log.msg('Sending password %s' % pw, debug=True)
+        _debug('Sending password %s', pw)
         self.write(pw + '\n')
         self.waiting_for = [('#', self.state_logged_in),
                             ('\n% ', self.state_percent_error),
@@ -968,20 +1417,22 @@ class TriggerTelnet(Telnet, ProtocolTransportMixin, TimeoutMixin):
         self.factory.err = LoginTimeout('Timed out while logging in')
         self.loseConnection()
 
-class IoslikeSendExpect(Protocol, TimeoutMixin):
+class IoslikeSendExpect(Protocol, TimeoutMixin, PacedSendMixin):
     """
     Action for use with TriggerTelnet. Take a list of commands, and send them
     to the device until we run out or one errors. Wait for a prompt after each.
     """
 
     def __init__(self, dev, commands, incremental=None, with_errors=False,
-                 timeout=None, command_interval=0):
+                 timeout=None, command_interval=0, on_result=None):
         self.dev = dev
         self.commanditer = iter(commands)
         self.incremental = incremental
+        self.on_result = on_result
         self.with_errors = with_errors
         self.timeout = timeout
         self.command_interval = command_interval
+        self.pending_send = None
 
         # Match prompt for IOS-like in (config), (config-if), (config-line).
         #self.prompt =  re.compile('^[a-zA-Z0-9-_]+(@[a-zA-Z0-9-_]+)?(\(config(-[a-z]+)?\))?#', re.M)
@@ -992,58 +1443,74 @@ class IoslikeSendExpect(Protocol, TimeoutMixin):
                             'BROCADE': 'skip-page-display\n',
                             'DELL': 'terminal datadump\n',
                            }[dev.manufacturer]]
-        log.msg('My initialize commands: %r' % self.initialize, debug=True)
+        _debug('My initialize commands: %r', self.initialize)
         self.initialized = False
 
     def connectionMade(self):
         """Do this when we connect."""
         self.setTimeout(self.timeout)
-        self.results = self.factory.results = []
-        self.data = ''
-        log.msg('connectionMade, data: %r' % self.data, debug=True)
+        self.results = self.factory.results = _new_results(self.on_result)
+        self.buffer = PromptBuffer(self.prompt)
+        _debug('connectionMade')
         # Don't call _send_next, since we expect to see a prompt, which
         # will kick off initialization.
 
+    def connectionLost(self, reason):
+        """Don't send anything else once we're disconnected."""
+        if self.pending_send is not None and self.pending_send.active():
+            self.pending_send.cancel()
+
+    def next_batch(self, commands):
+        """
+        Start running another set of commands once the last ones are done.
+        Used by SessionPool to reuse the session.
+
+        :param commands: An iterable of commands
+        """
+        self.commanditer = iter(commands)
+        self.results = self.factory.results = _new_results(self.on_result)
+        self.setTimeout(self.timeout)
+        self._send_next()
+
     def dataReceived(self, bytes):
         """Do this when we get data."""
-        log.msg('dataReceived, got bytes: %r' % bytes, debug=True)
-        self.data += bytes
-        log.msg('dataReceived, got data: %r' % self.data, debug=True)
-        m = self.prompt.search(self.data)
-        if not m:
+        _debug('dataReceived, got bytes: %r', bytes)
+        end = self.buffer.feed(bytes)
+        _debug('dataReceived, have %d bytes', len(self.buffer))
+        if end is None:
             return None
 
-        result = self.data[:m.start()]
+        result = self.buffer.getvalue()[:end]
         # Trim off the echoed-back command.  This should *not* be necessary
         # since the telnet session is in WONT ECHO.  This is confirmed with
         # a packet trace, and running self.transport.dont(ECHO) from
         # connectionMade() returns an AlreadyDisabled error.  What's up?
-        log.msg('IoslikeSendExpect.dataReceived result BEFORE: %r' % result, debug=True)
+        _debug('IoslikeSendExpect.dataReceived result BEFORE: %r', result)
         result = result[result.find('\n')+1:]
-        log.msg('IoslikeSendExpect.dataReceived result AFTER: %r' % result, debug=True)
+        _debug('IoslikeSendExpect.dataReceived result AFTER: %r', result)
 
         if self.initialized:
             self.results.append(result)
 
         if has_ioslike_error(result) and not self.with_errors:
-            log.msg('Got some kind of error: %r' % result, debug=True)
+            _debug('Got some kind of error: %r', result)
             self.factory.err = IoslikeCommandFailure(result)
             self.loseConnection()
         else:
-            if self.command_interval > 0:
-                time.sleep(self.command_interval)
-            self._send_next()
+            self._pace_next()
 
     def _send_next(self):
         """Send the next command in the stack."""
-        self.data = ''
+        if not _consumer_ready(self):
+            return None
+        self.buffer.clear()
         self.resetTimeout()
 
         if not self.initialized:
-            log.msg('Not initialized, sending init commands', debug=True)
+            _debug('Not initialized, sending init commands')
             if self.initialize:
                 next_init = self.initialize.pop(0)
-                log.msg('Sending: %r' % next_init, debug=True)
+                _debug('Sending: %r', next_init)
                 self.write(next_init)
                 return None
             else:
@@ -1055,18 +1522,491 @@ class IoslikeSendExpect(Protocol, TimeoutMixin):
         try:
             next_command = self.commanditer.next()
         except StopIteration:
-            log.msg('No more commands to send, disconnecting...', debug=True)
-            self.loseConnection()
+            _debug('No more commands to send')
+            self.factory.commands_done(self)
             return None
 
         if next_command is None:
             self.results.append(None)
             self._send_next()
         else:
-            log.msg('Sending command: %r' % next_command, debug=True)
+            _debug('Sending command: %r', next_command)
             self.write(next_command + '\n')
 
     def timeoutConnection(self):
         """Do this when we timeout."""
         self.factory.err = CommandTimeout('Timed out while sending commands')
         self.loseConnection()
+
+#==================
+# Session Pool
+#==================
+class PooledSession(object):
+    """
+    A logged in session to one device, kept open by a SessionPool and used
+    for one batch of commands after another. Batches are run in the order
+    they are submitted.
+
+    :param pool: The SessionPool this belongs to
+    :param device: A NetDevice object
+    """
+    def __init__(self, pool, device):
+        self.pool = pool
+        self.device = device
+        self.protocol = None # Set once we're logged in
+        self.queue = []
+        self.current = None
+        self.idle_call = None
+        self.closed = False
+        self.last_used = pool.clock.seconds()
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.device)
+
+    @property
+    def idle(self):
+        """True if we're logged in and not running anything."""
+        return self.protocol is not None and self.current is None
+
+    def submit(self, commands, d=None):
+        """
+        Queue a batch of commands. Returns a Deferred that fires with the
+        list of results.
+
+        :param commands: An iterable of commands
+        :param d: Optional Deferred to use
+        """
+        if d is None:
+            d = defer.Deferred()
+        self.queue.append((commands, d))
+        if self.protocol is not None and self.current is None:
+            self._run_next()
+        return d
+
+    def batch_done(self, protocol):
+        """Called by the factory when the protocol runs out of commands."""
+        self.protocol = protocol
+        self.last_used = self.pool.clock.seconds()
+        protocol.setTimeout(None)
+
+        d, self.current = self.current, None
+        results = protocol.results
+        self._run_next()
+        if d is not None:
+            d.callback(results)
+
+    def close(self):
+        """
+        Hang up once the running batch is done. Anything still queued is sent
+        to a new session.
+        """
+        self._cancel_idle()
+        if not self.closed:
+            self.closed = True
+            if self.idle:
+                self.protocol.loseConnection()
+
+    def _run_next(self):
+        """Start the next queued batch, or wait for one."""
+        if self.closed:
+            self.protocol.loseConnection()
+            return None
+        if not self.queue:
+            self.idle_call = self.pool.clock.callLater(self.pool.idle_timeout,
+                                                       self.close)
+            self.pool._session_idle(self)
+            return None
+
+        self._cancel_idle()
+        if self._needs_probe():
+            self._probe()
+            return None
+        commands, self.current = self.queue.pop(0)
+        _debug('Running %d queued batches on %s', len(self.queue) + 1,
+               self.device)
+        self.protocol.next_batch(commands)
+
+    def _needs_probe(self):
+        """True if we've been idle long enough to check we're still alive."""
+        interval = self.pool.probe_interval
+        return (interval is not None and
+                self.pool.clock.seconds() - self.last_used >= interval)
+
+    def _probe(self):
+        """
+        Send the pool's probe commands, giving them probe_timeout seconds to
+        answer. The queued batches are run once they do; if they time out,
+        the session is dropped and the batches go to a new one.
+        """
+        _debug('Checking that the session to %s is alive', self.device)
+        probe = self.current = defer.Deferred()
+        probe.addErrback(self._probe_failed)
+        self.protocol.next_batch(self.pool._probe_commands(self.device))
+        # Unless it has already answered.
+        if self.current is probe:
+            self.protocol.setTimeout(self.pool.probe_timeout)
+
+    def _probe_failed(self, failure):
+        log.msg('Dropping session to %s: %s' % (self.device,
+                                                failure.getErrorMessage()))
+        return None
+
+    def _cancel_idle(self):
+        if self.idle_call is not None and self.idle_call.active():
+            self.idle_call.cancel()
+        self.idle_call = None
+
+    def _connection_lost(self, result):
+        """
+        Called with the factory's result when the connection closes. The
+        batch that was running fails; batches that hadn't started are handed
+        back to the pool, unless we never managed to log in.
+        """
+        self.closed = True
+        self._cancel_idle()
+        if isinstance(result, Failure):
+            err = result
+        else:
+            err = Failure(ConnectionDone('Session to %s closed' % self.device))
+
+        current, self.current = self.current, None
+        queue, self.queue = self.queue, []
+        self.pool._session_closed(self)
+
+        if current is not None:
+            current.errback(err)
+        for commands, d in queue:
+            if self.protocol is None:
+                d.errback(err)
+            else:
+                self.pool.execute(self.device, commands, d)
+        return None
+
+class SessionPool(object):
+    """
+    Keeps logged in sessions to devices open so that they can be used for
+    more than one batch of commands, saving the cost of connecting and
+    logging in each time.
+
+    There is at most one session per device, and batches for the same device
+    are run one after another. Sessions are closed after idle_timeout
+    seconds without use, or sooner if another device needs a session and
+    max_sessions are already open. Sessions that are closing still count
+    towards max_sessions until their connection is gone. Sessions that drop
+    are thrown away and a new one is opened for the next batch.
+
+    Before a batch is run on a session that has been unused for
+    probe_interval seconds, a probe command is sent to check that the device
+    still answers. If it doesn't within probe_timeout seconds, the session
+    is dropped and the batch is run on a new one.
+
+    >>> pool = SessionPool(max_sessions=50)
+    >>> d = pool.execute(dev, ['show version'])
+    >>> d.addCallback(handle_results)
+
+    :param max_sessions: Most sessions to keep open at once
+    :param idle_timeout: Seconds to keep an unused session open
+    :param creds: Optional (username, password); see execute_junoscript()
+    :param with_errors: If set, command errors are returned in the results
+        rather than closing the session and failing the batch
+    :param timeout: Command timeout in seconds
+    :param probe_interval: Seconds a session can be unused before it is
+        checked; None to never check
+    :param probe_timeout: Seconds to wait for the probe to answer
+    :param clock: Object providing callLater() and seconds(), for testing
+    """
+    def __init__(self, max_sessions=POOL_MAX_SESSIONS,
+                 idle_timeout=POOL_IDLE_TIMEOUT, creds=None,
+                 with_errors=False, timeout=settings.DEFAULT_TIMEOUT,
+                 probe_interval=POOL_PROBE_INTERVAL,
+                 probe_timeout=POOL_PROBE_TIMEOUT, clock=None):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.creds = creds
+        self.with_errors = with_errors
+        self.timeout = timeout
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        if clock is None:
+            clock = reactor
+        self.clock = clock
+        self.sessions = {}
+        # Sessions that have been replaced, but are still connected.
+        self.closing = []
+        self.waiting = []
+
+    def __len__(self):
+        """Number of connections, including those of closing sessions."""
+        return len(self.sessions) + len(self.closing)
+
+    def execute(self, device, commands, d=None):
+        """
+        Run commands on device, using an open session if there is one.
+        Returns a Deferred that fires with the list of results, as with the
+        execute_*() functions.
+
+        :param device: A NetDevice object
+        :param commands: An iterable of commands
+        :param d: Optional Deferred to use
+        """
+        if d is None:
+            d = defer.Deferred()
+        session = self.sessions.get(device.nodeName)
+        if session is None or session.closed:
+            if len(self) >= self.max_sessions:
+                self._evict()
+            if len(self) >= self.max_sessions:
+                _debug('Pool full, waiting for a session to %s', device)
+                self.waiting.append((device, commands, d))
+                return d
+            session = self._open(device)
+        return session.submit(commands, d)
+
+    def close(self):
+        """
+        Close all of the sessions once their running batches are done.
+        Batches that haven't started yet fail.
+        """
+        err = ConnectionDone('Session pool closed')
+        waiting, self.waiting = self.waiting, []
+        for device, commands, d in waiting:
+            d.errback(err)
+        for session in self.sessions.values():
+            queue, session.queue = session.queue, []
+            for commands, d in queue:
+                d.errback(err)
+            session.close()
+
+    def _evict(self):
+        """Close the least recently used idle session, if any."""
+        idle = [s for s in self.sessions.itervalues()
+                if s.idle and not s.closed]
+        if idle:
+            min(idle, key=lambda s: s.last_used).close()
+
+    def _open(self, device):
+        """Start a new session to device."""
+        _debug('Opening pooled session to %s', device)
+        old = self.sessions.get(device.nodeName)
+        if old is not None:
+            self.closing.append(old)
+        session = PooledSession(self, device)
+        self.sessions[device.nodeName] = session
+        factory, port = self._factory(device)
+        factory.session = session
+        factory.d.addBoth(session._connection_lost)
+        self._connect(device, port, factory)
+        return session
+
+    def _factory(self, device):
+        """
+        Return a client factory that logs in to device and runs no commands,
+        and the port to connect to.
+        """
+        d = defer.Deferred()
+        creds = self.creds
+        if device.manufacturer == 'JUNIPER' and not device.is_firewall():
+            return TriggerSSHChannelFactory(d, [], creds, None,
+                                            self.with_errors, self.timeout,
+                                            TriggerSSHJunoscriptChannel), 22
+        if device.is_netscaler():
+            return TriggerSSHChannelFactory(d, [], creds, None,
+                                            self.with_errors, self.timeout,
+                                            TriggerSSHNetscalerChannel), 22
+        if device.manufacturer in ('JUNIPER', 'NETSCREEN TECHNOLOGIES'):
+            if not creds:
+                creds = tacacsrc.get_device_password(str(device))
+            return TriggerSSHChannelFactory(d, [], creds, None,
+                                            self.with_errors, self.timeout,
+                                            TriggerSSHNetscreenChannel), 22
+        if device.manufacturer in settings.IOSLIKE_VENDORS:
+            action = IoslikeSendExpect(device, [], None, self.with_errors,
+                                       self.timeout)
+            return TriggerTelnetClientFactory(d, action, creds), 23
+        raise TriggerTwisterError("Can't pool sessions to %s devices" %
+                                  device.manufacturer)
+
+    def _probe_commands(self, device):
+        """Return the commands used to check that a session is alive."""
+        if device.manufacturer == 'JUNIPER' and not device.is_firewall():
+            return [Element('get-system-uptime-information')]
+        # A NetScaler doesn't say Done for an empty line.
+        if device.is_netscaler():
+            return ['show ns version']
+        return ['']
+
+    def _connect(self, device, port, factory):
+        reactor.connectTCP(device.nodeName, port, factory)
+
+    def _session_idle(self, session):
+        """Give up an idle session if something is waiting for a slot."""
+        for idx, (device, commands, d) in enumerate(self.waiting):
+            if device.nodeName == session.device.nodeName:
+                del self.waiting[idx]
+                session.submit(commands, d)
+                return None
+        if self.waiting:
+            session.close()
+
+    def _session_closed(self, session):
+        """Forget a closed session and start anything waiting for a slot."""
+        if self.sessions.get(session.device.nodeName) is session:
+            del self.sessions[session.device.nodeName]
+        elif session in self.closing:
+            self.closing.remove(session)
+        waiting, self.waiting = self.waiting, []
+        for device, commands, d in waiting:
+            self.execute(device, commands, d)
+
+#==================
+# SSH Multiplexing
+#==================
+class TriggerSSHMultiplexFactory(TriggerClientFactory):
+    """
+    Factory for an SSH connection that carries the channels of an
+    SSHMultiplexer.
+    """
+
+    def __init__(self, deferred, mux, creds=None):
+        self.protocol = TriggerSSHTransport
+        self.display_banner = None
+        self.mux = mux
+        TriggerClientFactory.__init__(self, deferred, creds)
+
+class TriggerSSHMultiplexChannelFactory(TriggerSSHChannelFactory):
+    """
+    Holds the commands, settings and results of one channel opened by an
+    SSHMultiplexer. It is never used to connect; its Deferred fires when the
+    channel closes.
+    """
+    done = False
+
+    def commands_done(self, protocol):
+        """Close the channel, but not the connection, when we're done."""
+        self.done = True
+        protocol.loseConnection()
+
+    def channel_closed(self):
+        """Fire the Deferred once the channel is closed."""
+        if not self.done and self.err is None:
+            self.err = ConnectionLost('Channel closed before all commands '
+                                      'were run')
+        self.clientConnectionLost(None, None)
+
+class SSHMultiplexer(object):
+    """
+    Runs any number of independent batches of commands on one device at the
+    same time, each on its own channel of a single SSH connection, so that
+    concurrent jobs to a device only log in once.
+
+    Each call to execute() opens a new channel and returns a Deferred for its
+    results, just like the execute_*() functions. The connection is made on
+    the first call and stays up until close() is called, after which it is
+    dropped once the open channels finish.
+
+    >>> mux = SSHMultiplexer(dev)
+    >>> d1 = mux.execute(acl_commands)
+    >>> d2 = mux.execute(interface_commands)
+    >>> defer.DeferredList([d1, d2]).addBoth(lambda x: mux.close())
+
+    :param device: A NetDevice object
+    :param creds: Optional (username, password); see execute_junoscript()
+    :param channel: SSH channel class to use; picked based on the device if
+        not given
+    """
+    def __init__(self, device, creds=None, channel=None):
+        self.device = device
+        if channel is None:
+            if device.is_netscaler():
+                channel = TriggerSSHNetscalerChannel
+            elif device.manufacturer == 'JUNIPER' and \
+                 not device.is_firewall():
+                channel = TriggerSSHJunoscriptChannel
+            elif device.manufacturer in ('JUNIPER', 'NETSCREEN TECHNOLOGIES'):
+                channel = TriggerSSHNetscreenChannel
+                if not creds:
+                    creds = tacacsrc.get_device_password(str(device))
+            else:
+                raise TriggerTwisterError("Can't multiplex SSH to %s devices"
+                                          % device.manufacturer)
+        self.channel = channel
+        self.creds = creds
+        self.conn = None
+        self.factory = None
+        self.pending = []
+        self.open_channels = 0
+        self.closing = False
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.device)
+
+    def execute(self, commands, incremental=None, with_errors=False,
+                timeout=settings.DEFAULT_TIMEOUT, command_interval=0,
+                pipeline=1, on_result=None):
+        """
+        Run commands on a new channel. Returns a Deferred that fires with the
+        list of results when the channel is done. See execute_junoscript()
+        for the arguments.
+        """
+        if self.factory is None:
+            self._connect()
+        d = defer.Deferred()
+        factory = TriggerSSHMultiplexChannelFactory(d, commands,
+                                                    self.factory.creds,
+                                                    incremental, with_errors,
+                                                    timeout, self.channel,
+                                                    command_interval, pipeline,
+                                                    on_result)
+        self.open_channels += 1
+        d.addBoth(self._channel_done)
+        if self.conn is None:
+            self.pending.append(factory)
+        else:
+            self._open_channel(factory)
+        return d
+
+    def close(self):
+        """Hang up once all of the open channels are done."""
+        self.closing = True
+        if self.conn is not None and not self.open_channels:
+            self.conn.transport.loseConnection()
+
+    def connected(self, conn):
+        """Called by the connection once we're logged in."""
+        self.conn = conn
+        pending, self.pending = self.pending, []
+        for factory in pending:
+            self._open_channel(factory)
+        if self.closing:
+            self.close()
+
+    def _connect(self):
+        d = defer.Deferred()
+        d.addBoth(self._connection_lost)
+        self.factory = TriggerSSHMultiplexFactory(d, self, self.creds)
+        _debug('Trying multiplexed SSH to %s', self.device)
+        reactor.connectTCP(self.device.nodeName, 22, self.factory)
+
+    def _open_channel(self, factory):
+        channel = self.channel(conn=self.conn)
+        channel.factory = factory
+        channel.multiplexed = True
+        self.conn.openChannel(channel)
+
+    def _channel_done(self, result):
+        self.open_channels -= 1
+        if self.closing:
+            self.close()
+        return result
+
+    def _connection_lost(self, result):
+        """Fail any channels that never got opened, and start over."""
+        if not isinstance(result, Failure):
+            result = Failure(ConnectionDone('Connection to %s closed' %
+                                            self.device))
+        self.conn = self.factory = None
+        self.closing = False
+        pending, self.pending = self.pending, []
+        for factory in pending:
+            factory.clientConnectionFailed(None, result)
+        return None